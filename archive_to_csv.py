@@ -0,0 +1,22 @@
+from core.run_archive import read_archive, export_csv
+import os
+import sys
+
+# 使用示例：python archive_to_csv.py 归档文件 [表名 | 波形名称 行号]
+# 不指定表名时把所有表格各导出为一个 CSV；指定波形名称和行号时导出该次波形
+if __name__ == "__main__":
+    path = sys.argv[1]
+    base = os.path.splitext(path)[0]
+    metadata, tables, waveforms = read_archive(path)
+    print(f"元数据: {metadata}")
+
+    if len(sys.argv) > 3:
+        name, index = sys.argv[2], int(sys.argv[3])
+        csv_path = f"{base}_{name}_{index}.csv"
+        export_csv(path, csv_path, waveform=name, index=index)
+        print(f"波形 {name}[{index}] 已导出至: {csv_path}")
+    else:
+        for table in ([sys.argv[2]] if len(sys.argv) > 2 else tables):
+            csv_path = f"{base}_{table}.csv"
+            export_csv(path, csv_path, table=table)
+            print(f"表格 {table} ({len(next(iter(tables[table].values())))} 行) 已导出至: {csv_path}")
@@ -0,0 +1,40 @@
+from core import simulator
+from core.instrument import InstrumentCommunicator
+from core.ptnhp_con import PTNhpController, ptnhp_address
+import sys
+import time
+
+# 使用示例：python bench_acquisition.py [次数] [延迟缩放]
+# 在模拟后端上测量流强采集吞吐量和 SCPI 通信量，不需要真实示波器和电源
+if __name__ == "__main__":
+    SHOTS = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    LATENCY_SCALE = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+
+    backend = simulator.enable(particle_type='D', latency_scale=LATENCY_SCALE)
+
+    # 1. 流强采集吞吐量
+    communicator = InstrumentCommunicator(ip_address="192.168.1.100", channel=1)
+    t0 = time.perf_counter()
+    for _ in range(SHOTS):
+        off_data, on_data = communicator.acquire_beam_data(1e-4, 100)
+    elapsed = time.perf_counter() - t0
+    scope = backend.scopes[-1]
+    print(f"流强采集: {SHOTS} 次, {elapsed:.3f} s, {SHOTS / elapsed:.2f} 次/s")
+    print(f"示波器命令统计: {dict(scope.stats)}")
+    print(f"传输字节数: {scope.bytes_transferred / 1e6:.2f} MB")
+    communicator.disconnect()
+
+    # 2. 电源设定与回读
+    controller = PTNhpController(*ptnhp_address(), timeout=5, terminator='\n')
+    if controller.connect():
+        controller.set_voltage(70)
+        controller.start_output()
+        t0 = time.perf_counter()
+        controller.set_current(5.0)
+        while abs((controller.measure_current() or 0.0) - 5.0) > 0.01:
+            time.sleep(0.01)
+        print(f"电源 0 -> 5 A 稳定时间: {time.perf_counter() - t0:.3f} s")
+        print(f"电源命令统计: {dict(backend.ptnhp_server.stats)}")
+        controller.close()
+
+    simulator.disable()
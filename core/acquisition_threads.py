@@ -1,51 +1,131 @@
-from PyQt5.QtCore import QThread, pyqtSignal
+from PyQt5.QtCore import QObject, QThread, QTimer, pyqtSignal
 from .instrument import InstrumentCommunicator
 from .data_processor import DataProcessor
 import numpy as np
+import heapq
+import queue
+import time
+
+
+class BeamAnalysisWorker(QThread):
+    """流强分析线程：在 GUI 线程之外计算峰值、半高全宽和粒子数"""
+    result_ready = pyqtSignal(str, int, int, float, np.ndarray, np.ndarray, np.ndarray, np.ndarray,
+                              float, float, float)
+    error_occurred = pyqtSignal(str)
+
+    def __init__(self, ip_address="", max_pending=4):
+        super().__init__()
+        self.ip_address = ip_address
+        # 有界队列：分析跟不上时反压采集线程，避免内存堆积
+        self.queue = queue.Queue(maxsize=max_pending)
+
+    def submit(self, run_number, channel, timestamp, time_data, off_data, on_data, beam_data):
+        """提交一次采集结果，队列满时阻塞"""
+        self.queue.put((run_number, channel, timestamp, time_data, off_data, on_data, beam_data))
+
+    def finish(self):
+        """处理完队列中剩余的数据后退出"""
+        self.queue.put(None)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            run_number, channel, timestamp, time_data, off_data, on_data, beam_data = item
+            try:
+                peak_value, fwhm = DataProcessor.calculate_peak_and_fwhm(time_data, beam_data)
+                particle_number = DataProcessor.calculate_particle_count(beam_data, time_data)
+            except Exception as e:
+                self.error_occurred.emit(f"示波器 {self.ip_address} 第 {run_number} 次数据分析失败: {e}")
+                continue
+            self.result_ready.emit(self.ip_address, run_number, channel, timestamp,
+                                   time_data, off_data, on_data, beam_data,
+                                   float(peak_value), float(fwhm), float(particle_number))
 
 
 class AcquisitionThread(QThread):
-    """流强数据采集线程"""
-    data_acquired = pyqtSignal(int, np.ndarray, np.ndarray, np.ndarray, np.ndarray)
+    """
+    流强数据采集线程
+
+    采集（示波器 I/O）与分析流水线执行：本线程只负责触发和传输，
+    传输完成后立即交给 BeamAnalysisWorker 并开始下一次触发，
+    data_acquired 只发出已分析完成的结果。
+    channels 给出多个通道时，每次触发依次读取所有通道，每个通道单独发出一次结果。
+    """
+    data_acquired = pyqtSignal(str, int, int, float, np.ndarray, np.ndarray, np.ndarray, np.ndarray,
+                               float, float, float)
+    error_occurred = pyqtSignal(str)
     finished = pyqtSignal()
 
+    MAX_CONSECUTIVE_FAILURES = 10  # 连续采集失败达到该次数时放弃并结束线程
+
     # 新增ip_address和channel参数
-    def __init__(self, time_scal, gain, count=0, ip_address=None, channel=None):
+    def __init__(self, time_scal, gain, count=0, ip_address=None, channel=None, target_rate=0.0, channels=None):
         super().__init__()
         self.time_scal = time_scal
         self.gain = gain
         self.count = count
         self.ip_address = ip_address  # 存储IP地址
         self.channel = channel  # 存储通道信息
+        self.channels = list(channels) if channels else [channel]
+        self.target_rate = target_rate  # 目标采集速率（次/秒），0 表示由示波器决定
         self.running = False
         # 将参数传递给仪器通信器
         self.instrument = InstrumentCommunicator(
             ip_address=ip_address,
             channel=channel
         )
+        self.worker = BeamAnalysisWorker(ip_address or "")
+        self.worker.result_ready.connect(self.data_acquired)
+        self.worker.error_occurred.connect(self.error_occurred)
     
     def run(self):
         self.running = True
         run_number = 1
+        failures = 0
+        self.worker.start()
         
         try:
             while self.running and (self.count == 0 or run_number <= self.count):
+                shot_start = time.monotonic()
+                timestamp = time.time()
                 # 采集数据
-                off_data, on_data = self.instrument.acquire_beam_data(
-                    self.time_scal, self.gain
+                acquired = self.instrument.acquire_beam_data_multi(
+                    self.time_scal, self.gain, self.channels
                 )
-                beam_data = on_data - off_data
-                rows = len(beam_data)
-                time_data = np.arange(rows) * 12 * self.time_scal / rows * 1e6
+                for channel, (off_data, on_data) in acquired.items():
+                    beam_data = on_data - off_data
+                    rows = len(beam_data)
+                    time_data = np.arange(rows) * 12 * self.time_scal / rows * 1e6
                 
-                if time_data.size > 0:
-                    self.data_acquired.emit(run_number, time_data, off_data, on_data, beam_data)
+                    if time_data.size > 0:
+                        self.worker.submit(run_number, channel, timestamp, time_data, off_data, on_data, beam_data)
                 
+                if not acquired:
+                    # 采集失败时报告并退避，避免对故障示波器反复重连；运行序号只在成功时递增，
+                    # 连续失败过多（示波器不可达）时结束线程，避免有限次数采集永不结束
+                    failures += 1
+                    if failures >= self.MAX_CONSECUTIVE_FAILURES:
+                        self.error_occurred.emit(
+                            f"示波器 {self.ip_address} 连续 {failures} 次采集失败，停止采集")
+                        break
+                    self.error_occurred.emit(f"示波器 {self.ip_address} 采集失败，1 s 后重试")
+                    if self.running:
+                        self.msleep(1000)
+                    continue
+                failures = 0
                 run_number += 1
-                self.msleep(200)  # 短暂休眠
+                # 按目标速率补足剩余时间
+                if self.target_rate > 0:
+                    remaining = 1.0 / self.target_rate - (time.monotonic() - shot_start)
+                    if remaining > 0:
+                        self.msleep(int(remaining * 1000))
         
         finally:
             self.instrument.disconnect()
+            self.worker.finish()
+            self.worker.wait()
             self.finished.emit()
     
     def stop(self):
@@ -53,6 +133,105 @@ class AcquisitionThread(QThread):
         self.wait()
 
 
+class MultiScopeAcquisition(QObject):
+    """
+    多台示波器并行采集
+
+    每台示波器一个 AcquisitionThread（各自独立的 I/O 和分析线程），
+    结果按触发时间戳合并成一个有序的数据流。合并时只等待仍在正常出数的示波器：
+    超过 max_lag 秒没有新结果（变慢或故障）的示波器不再阻塞其它示波器的结果。
+    """
+    data_acquired = pyqtSignal(str, int, int, float, np.ndarray, np.ndarray, np.ndarray, np.ndarray,
+                               float, float, float)
+    error_occurred = pyqtSignal(str)
+    finished = pyqtSignal()
+
+    def __init__(self, ip_addresses, time_scal, gain, count=0, channels=None, target_rate=0.0, max_lag=2.0):
+        super().__init__()
+        self.max_lag = max_lag
+        self.threads = {}
+        for ip in ip_addresses:
+            thread = AcquisitionThread(time_scal, gain, count, ip_address=ip,
+                                       channel=channels[0] if channels else 1,
+                                       target_rate=target_rate, channels=channels)
+            thread.data_acquired.connect(self._on_result)
+            thread.error_occurred.connect(self.error_occurred)
+            thread.finished.connect(lambda ip=ip: self._on_thread_finished(ip))
+            self.threads[ip] = thread
+        self._pending = []       # (时间戳, 序号, 结果) 小根堆
+        self._sequence = 0
+        self._latest = {}        # 每台示波器最新结果的时间戳
+        self._last_seen = {}     # 每台示波器最近一次出结果的时刻
+        self._active = set()
+        self._stopped = False    # stop() 之后仍在队列中的结果直接丢弃
+        self._flush_timer = QTimer(self)
+        self._flush_timer.setInterval(200)
+        self._flush_timer.timeout.connect(self._flush)
+
+    def start(self):
+        self._stopped = False
+        now = time.monotonic()
+        for ip, thread in self.threads.items():
+            self._active.add(ip)
+            self._last_seen[ip] = now
+            thread.start()
+        self._flush_timer.start()
+
+    def isRunning(self):
+        return any(thread.isRunning() for thread in self.threads.values())
+
+    def stop(self):
+        # 先丢弃未发出的结果并停止定时器，使停止（或清空数据）之后不再有旧结果发出；
+        # 再通知所有线程停止并逐个等待，总等待时间取决于最慢的一台
+        self._stopped = True
+        self._flush_timer.stop()
+        self._pending.clear()
+        self._latest.clear()
+        self._last_seen.clear()
+        for thread in self.threads.values():
+            thread.running = False
+        for thread in self.threads.values():
+            thread.wait()
+
+    def _on_result(self, ip, *result):
+        if self._stopped:
+            return
+        timestamp = result[2]
+        heapq.heappush(self._pending, (timestamp, self._sequence, (ip,) + result))
+        self._sequence += 1
+        self._latest[ip] = max(timestamp, self._latest.get(ip, timestamp))
+        self._last_seen[ip] = time.monotonic()
+        self._flush()
+
+    def _on_thread_finished(self, ip):
+        self._active.discard(ip)
+        if self._stopped:
+            if not self._active:
+                self.finished.emit()
+        elif not self._active:
+            self._flush_timer.stop()
+            self._flush(force=True)
+            self.finished.emit()
+        else:
+            self._flush()
+
+    def _flush(self, force=False):
+        """发出所有不晚于水位线的结果；水位线为仍在等待的示波器中最新时间戳的最小值"""
+        if self._stopped:
+            return
+        now = time.monotonic()
+        waiting = [ip for ip in self._active if now - self._last_seen[ip] <= self.max_lag]
+        if force or not waiting:
+            watermark = float('inf')
+        elif any(ip not in self._latest for ip in waiting):
+            watermark = float('-inf')
+        else:
+            watermark = min(self._latest[ip] for ip in waiting)
+        while self._pending and self._pending[0][0] <= watermark:
+            _, _, result = heapq.heappop(self._pending)
+            self.data_acquired.emit(*result)
+
+
 class PolarizationAcquisitionThread(QThread):
     """极化率数据采集线程"""
     data_acquired = pyqtSignal(int, np.ndarray, np.ndarray, float)
@@ -5,11 +5,114 @@ class DataProcessor:
     """数据处理工具类，提供各类数据计算方法"""
     
     @staticmethod
-    def moving_average(data, window_size):
-        """计算移动平均值"""
-        weights = np.repeat(1.0, window_size) / window_size
-        return np.convolve(data, weights, 'valid')
+    def moving_average(data, window_size, dtype=np.float64, out=None):
+        """
+        计算移动平均值（累加和实现，O(n)，输出与 np.convolve(..., 'valid') 一致）
+
+        参数:
+        data: 输入数据
+        window_size: 窗口长度
+        dtype: 输出类型，可选 np.float32 以减少内存和带宽（累加仍使用 float64）
+        out: 可选的输出缓冲区，长度为 len(data) - window_size + 1，结果原地写入
+
+        返回:
+        长度为 len(data) - window_size + 1 的平滑结果
+        """
+        data = np.asarray(data)
+        n = len(data)
+        if window_size < 1:
+            raise ValueError("窗口长度必须为正整数")
+        if n < window_size:
+            # 数据比窗口短时保持 np.convolve 的原有行为
+            weights = np.repeat(1.0, window_size) / window_size
+            return np.convolve(data, weights, 'valid').astype(dtype, copy=False)
+        n_out = n - window_size + 1
+        if out is None:
+            out = np.empty(n_out, dtype=dtype)
+        elif len(out) != n_out:
+            raise ValueError(f"输出缓冲区长度应为 {n_out}")
+
+        # 减去首个采样值再累加，降低长记录下累加和的舍入误差
+        offset = float(data[0])
+        csum = np.empty(n + 1, dtype=np.float64)
+        csum[0] = 0.0
+        np.subtract(data, offset, out=csum[1:])
+        np.cumsum(csum[1:], out=csum[1:])
+        np.subtract(csum[window_size:], csum[:n_out], out=out)
+        out /= window_size
+        out += offset
+        return out
     
+    @staticmethod
+    def decimate_minmax(x, y, n_bins):
+        """
+        最小/最大值包络抽取，用于显示：每个区间保留最小值和最大值两个点（按原顺序），
+        峰值不会因抽取而丢失
+
+        参数:
+        x, y: 原始数据（x 按升序排列）
+        n_bins: 区间数，输出点数约为 2 * n_bins
+
+        返回:
+        抽取后的 x, y
+        """
+        x = np.asarray(x)
+        y = np.asarray(y)
+        n = len(y)
+        n_bins = int(n_bins)
+        if n_bins < 1 or n <= 2 * n_bins:
+            return x, y
+
+        k = n // n_bins
+        main = y[:k * n_bins].reshape(n_bins, k)
+        offsets = np.arange(n_bins) * k
+        idx_min = np.argmin(main, axis=1) + offsets
+        idx_max = np.argmax(main, axis=1) + offsets
+        pairs = [np.stack([idx_min, idx_max], axis=1)]
+        if k * n_bins < n:
+            # 末尾不足一个区间的剩余点单独作为一个区间
+            tail = y[k * n_bins:]
+            pairs.append(np.array([[np.argmin(tail), np.argmax(tail)]]) + k * n_bins)
+        idx = np.sort(np.concatenate(pairs), axis=1).ravel()
+        return x[idx], y[idx]
+
+    @staticmethod
+    def decimate_mean(data, factor):
+        """
+        按块求平均抽取（与示波器高分辨率抽取等效），末尾不足一块的数据丢弃
+
+        参数:
+        data: 输入数据
+        factor: 抽取因子
+
+        返回:
+        长度为 len(data) // factor 的数组
+        """
+        data = np.asarray(data, dtype=float)
+        factor = max(int(factor), 1)
+        n = len(data) // factor
+        return data[:n * factor].reshape(n, factor).mean(axis=1)
+
+    @staticmethod
+    def waveform_stats(data):
+        """
+        波形的紧凑统计量
+
+        参数:
+        data: 输入数据
+
+        返回:
+        (平均值, 标准差, 漂移)，漂移为线性拟合斜率乘以记录长度，即首尾之间的变化量
+        """
+        data = np.asarray(data, dtype=float)
+        n = len(data)
+        if n < 2:
+            return (float(data.mean()) if n else np.nan), 0.0, 0.0
+        x = np.arange(n) - (n - 1) / 2
+        mean = data.mean()
+        slope = np.dot(x, data - mean) / np.dot(x, x)
+        return float(mean), float(data.std(ddof=1)), float(slope * (n - 1))
+
     @staticmethod
     def calculate_averages(data):
         """计算两个区间的平均值"""
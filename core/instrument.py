@@ -1,6 +1,94 @@
+import sys
 from RsInstrument import *
 import numpy as np
 from .data_processor import DataProcessor
+from . import simulator
+
+
+def open_scope(ip_address):
+    """打开示波器会话；启用模拟后端时返回进程内模拟示波器"""
+    if simulator.is_enabled():
+        return simulator.get_backend().open_scope(ip_address)
+    return RsInstrument(f'TCPIP::{ip_address}::INSTR', True, False)
+
+
+class ScopeSession:
+    """示波器会话：连接时一次性配置数据格式，缓存已生效的设置，仅在重连或参数变化时重发"""
+
+    def __init__(self, ip_address, data_format="REAL,32", data_chunk_size=100000):
+        self.ip_address = ip_address
+        self.data_format = data_format
+        self.data_chunk_size = data_chunk_size
+        self.instrument = None
+        self._applied = {}  # 已在当前连接上生效的设置
+
+    @property
+    def is_open(self):
+        return self.instrument is not None
+
+    def open(self):
+        """建立连接并完成一次性格式配置"""
+        self.instrument = open_scope(self.ip_address)
+        self._applied = {}
+        self.configure()
+
+    def close(self):
+        """关闭连接，缓存随之失效"""
+        if self.instrument:
+            try:
+                self.instrument.close()
+            finally:
+                self.instrument = None
+                self._applied = {}
+
+    def invalidate(self):
+        """仪器状态被外部改变（如 *RST）后调用，下次 configure 时全部重发"""
+        self._applied = {}
+
+    def write_setting(self, header, value):
+        """发送 SCPI 设置命令，值未变化时跳过"""
+        if self._applied.get(header) != value:
+            self.instrument.write_str(f"{header} {value}")
+            self._applied[header] = value
+
+    def read_setting(self, header):
+        """查询设置的当前值（字符串），并记入缓存"""
+        value = self.instrument.query_str(f"{header}?").strip()
+        self._applied[header] = value
+        return value
+
+    def set_attribute(self, name, value):
+        """设置驱动端属性（如 bin_float_numbers_format），值未变化时跳过"""
+        key = f"attr:{name}"
+        if self._applied.get(key) != value:
+            setattr(self.instrument, name, value)
+            self._applied[key] = value
+
+    def configure(self, data_format=None, data_chunk_size=None):
+        """应用数据格式设置；参数变化时只重发变化的部分"""
+        if data_format is not None:
+            self.data_format = data_format
+        if data_chunk_size is not None:
+            self.data_chunk_size = data_chunk_size
+        self.write_setting("FORMat:DATA", self.data_format)
+        if self.data_format.upper().startswith("REAL"):
+            # Single_4bytes_swapped 表示与本机相反的字节序，仪器端字节序需与之对应
+            self.write_setting("FORMat:BORDer", "MSBFirst" if sys.byteorder == "little" else "LSBFirst")
+            self.set_attribute("bin_float_numbers_format", BinFloatFormat.Single_4bytes_swapped)
+        self.set_attribute("data_chunk_size", self.data_chunk_size)
+
+    def single(self, timeout=50000):
+        """单次触发并等待采集完成"""
+        self.instrument.write_str_with_opc("SINGle", timeout)
+
+    def fetch(self, channel):
+        """读取指定通道的波形数据"""
+        return np.array(self.instrument.query_bin_or_ascii_float_list(f"CHAN{channel}:DATA?"))
+
+    def fetch_channels(self, channels):
+        """同一次触发后依次读取多个通道（中间不插入其它命令），返回 {通道: 波形}"""
+        return {channel: self.fetch(channel) for channel in channels}
+
 
 class InstrumentCommunicator:
     """仪器通信类，负责与测量设备交互"""
@@ -8,53 +96,66 @@ class InstrumentCommunicator:
     def __init__(self, ip_address="192.168.1.100", channel=1):
         self.ip_address = ip_address
         self.channel = channel  # 新增：通道属性
-        self.instrument = None
+        self.session = ScopeSession(ip_address)
+
+    @property
+    def instrument(self):
+        return self.session.instrument
     
     def connect(self):
         """连接到仪器"""
         try:
-            self.instrument = RsInstrument(
-                f'TCPIP::{self.ip_address}::INSTR', True, False
-            )
+            self.session.open()
             return True
         except Exception as e:
             print(f"仪器连接失败: {e}")
+            self.session.close()
             return False
     
     def disconnect(self):
         """断开与仪器的连接"""
-        if self.instrument:
-            self.instrument.close()
-            self.instrument = None
+        self.session.close()
     
     def acquire_beam_data(self, time_scal, gain, samples=2):
         """采集束流数据（使用指定通道）"""
-        if not self.instrument:
+        result = self.acquire_beam_data_multi(time_scal, gain, [self.channel], samples)
+        return result.get(self.channel, (np.array([]), np.array([])))
+
+    def acquire_beam_data_multi(self, time_scal, gain, channels, samples=2):
+        """
+        一次触发读取多个通道的束流数据
+
+        每次 SINGle 之后依次传输所有通道，两次触发分别得到 RF-OFF/RF-ON 波形。
+
+        返回:
+        {通道: (off_data, on_data)}，采集失败时返回空字典
+        """
+        if not self.session.is_open:
             if not self.connect():
-                return np.array([]), np.array([])
+                return {}
         
         try:
-            beam_data = []
+            beam_data = {channel: [] for channel in channels}
             for _ in range(samples):
-                self.instrument.write_str_with_opc("SINGle", 50000)
-                self.instrument.write_str("FORMat:DATA REAL,32")
-                self.instrument.bin_float_numbers_format = BinFloatFormat.Single_4bytes_swapped
-                self.instrument.data_chunk_size = 100000
-                # 修改：使用指定通道获取数据
-                raw_data = self.instrument.query_bin_or_ascii_float_list(f"CHAN{self.channel}:DATA?")
-                smoothed = DataProcessor.moving_average(np.array(raw_data), 200)
-                beam_data.append(smoothed)
-            
-            # 转换为物理单位（mA）
-            off_data = np.array(beam_data[0]).reshape(-1, 1) / gain * 1e3
-            on_data = np.array(beam_data[1]).reshape(-1, 1) / gain * 1e3
-            
-            # 确保数据顺序正确（OFF <= ON）
-            if np.average(off_data) > np.average(on_data):
-                off_data, on_data = on_data, off_data
-            
-            return off_data.flatten(), on_data.flatten()
+                self.session.single()
+                raw = self.session.fetch_channels(channels)
+                for channel in channels:
+                    beam_data[channel].append(DataProcessor.moving_average(raw[channel], 200))
+
+            result = {}
+            for channel, smoothed in beam_data.items():
+                # 转换为物理单位（mA）
+                off_data = np.array(smoothed[0]) / gain * 1e3
+                on_data = np.array(smoothed[1]) / gain * 1e3
+
+                # 确保数据顺序正确（OFF <= ON）
+                if np.average(off_data) > np.average(on_data):
+                    off_data, on_data = on_data, off_data
+                result[channel] = (off_data, on_data)
+            return result
         
         except Exception as e:
             print(f"数据采集失败: {e}")
-            return np.array([]), np.array([])
+            # 断开会话，下次采集时重连并重新配置格式
+            self.disconnect()
+            return {}
@@ -0,0 +1,115 @@
+import numpy as np
+
+
+class PhotonTraceAccumulator:
+    """
+    按磁场设定值累积光子信号
+
+    每个不同的磁场值占一行，预分配 count / mean / M2 数组（Welford 算法）
+    和每遍扫描的原始值矩阵；重复访问同一磁场值时只更新统计量，不再追加新行。
+    计划外的磁场值（如自适应扫描中加密的点）按顺序插入新行。
+    每行还可以累积实测磁场（每次测量的平均值、标准差和漂移的平均）。
+    """
+
+    def __init__(self, setpoints, decimals=4):
+        """
+        参数:
+        setpoints: 计划访问的磁场值序列（可含重复），用于确定行数和最大访问次数
+        decimals: 判定磁场值相同时保留的小数位数
+        """
+        setpoints = np.round(np.asarray(setpoints, dtype=float).ravel(), decimals)
+        self.decimals = decimals
+        self.fields, visits = np.unique(setpoints, return_counts=True)
+        n = len(self.fields)
+        self.count = np.zeros(n, dtype=int)
+        self.mean = np.zeros(n)
+        self._m2 = np.zeros(n)
+        self.sweeps = np.full((n, int(visits.max()) if n else 0), np.nan)
+        # 实测磁场: 每行的测量次数和 (平均值, 标准差, 漂移) 的平均
+        self.field_count = np.zeros(n, dtype=int)
+        self.field_stats = np.zeros((n, 3))
+
+    def __len__(self):
+        return int(np.count_nonzero(self.count))
+
+    def index_of(self, setpoint, insert=False):
+        """返回磁场值所在行；insert 为 True 时计划外的磁场值插入新行，否则抛出 KeyError"""
+        value = round(float(setpoint), self.decimals)
+        idx = int(np.searchsorted(self.fields, value))
+        if idx >= len(self.fields) or self.fields[idx] != value:
+            if not insert:
+                raise KeyError(f"磁场值 {setpoint} 不在扫描计划中")
+            self.fields = np.insert(self.fields, idx, value)
+            self.count = np.insert(self.count, idx, 0)
+            self.mean = np.insert(self.mean, idx, 0.0)
+            self._m2 = np.insert(self._m2, idx, 0.0)
+            self.sweeps = np.insert(self.sweeps, idx, np.nan, axis=0)
+            self.field_count = np.insert(self.field_count, idx, 0)
+            self.field_stats = np.insert(self.field_stats, idx, 0.0, axis=0)
+        return idx
+
+    def add(self, setpoint, value, field=None):
+        """
+        加入一次测量，返回所在行
+
+        field: 本次测量的实测磁场 (平均值, 标准差, 漂移)，None 表示没有实测值
+        """
+        idx = self.index_of(setpoint, insert=True)
+        if field is not None:
+            self.field_count[idx] += 1
+            self.field_stats[idx] += (np.asarray(field, dtype=float) - self.field_stats[idx]) / self.field_count[idx]
+        k = self.count[idx]
+        if k >= self.sweeps.shape[1]:
+            # 超出计划访问次数时扩展原始值矩阵
+            self.sweeps = np.hstack((self.sweeps, np.full((len(self.fields), self.sweeps.shape[1] or 1), np.nan)))
+        self.sweeps[idx, k] = value
+        k += 1
+        self.count[idx] = k
+        delta = value - self.mean[idx]
+        self.mean[idx] += delta / k
+        self._m2[idx] += delta * (value - self.mean[idx])
+        return idx
+
+    @property
+    def std(self):
+        """每个磁场值的样本标准差（ddof=1），只测一次时为0"""
+        return np.sqrt(np.divide(self._m2, self.count - 1, out=np.zeros_like(self._m2), where=self.count > 1))
+
+    def compact(self, measured_field=False):
+        """
+        返回按磁场升序排列的紧凑结果，只包含已测量的磁场值
+
+        measured_field: 为 True 时磁场列使用实测磁场的平均值（没有实测值的行仍用设定值）
+
+        返回: shape (n, 4) 数组，列为 (磁场, 平均值, 标准差, 测量次数)
+        """
+        measured = self.count > 0
+        fields = self.fields
+        if measured_field:
+            fields = np.where(self.field_count > 0, self.field_stats[:, 0], self.fields)
+        result = np.column_stack((fields[measured], self.mean[measured],
+                                  self.std[measured], self.count[measured]))
+        return result[np.argsort(result[:, 0], kind='stable')] if measured_field else result
+
+    def field_table(self):
+        """
+        实测磁场与设定值对照
+
+        返回: shape (n, 5) 数组，列为 (设定值, 实测平均值, 标准差, 漂移, 次数)，只包含有实测值的行
+        """
+        measured = self.field_count > 0
+        return np.column_stack((self.fields[measured], self.field_stats[measured], self.field_count[measured]))
+
+    @classmethod
+    def from_data(cls, data, decimals=4):
+        """由 (磁场, 测量值) 数组构建，用于读取旧格式的逐点数据"""
+        data = np.asarray(data, dtype=float)
+        accumulator = cls(data[:, 0], decimals)
+        for setpoint, value in data[:, :2]:
+            accumulator.add(setpoint, value)
+        return accumulator
+
+
+def compact_trace(data, decimals=4):
+    """把 (磁场, 测量值) 逐点数据合并为按磁场排序的 (磁场, 平均值, 标准差, 次数)"""
+    return PhotonTraceAccumulator.from_data(data, decimals).compact()
@@ -0,0 +1,259 @@
+import numpy as np
+from .photon_trace import PhotonTraceAccumulator
+
+# 氘核三个峰的磁场范围 (Gs)
+DEUTERON_RANGES = ((560, 570), (570, 580), (580, 590))
+# 逐点数据中质子两个峰的索引范围
+PROTON_INDEX_RANGES = ((0, 100), (100, 200))
+# 峰值附近取数的半宽（点数）
+PEAK_HALF_WIDTH = 5
+
+
+def _as_stack(data):
+    """把 (n_points, k) 或 (n_scans, n_points, k) 统一为三维数组"""
+    data = np.asarray(data, dtype=float)
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    if data.ndim != 3 or data.shape[2] < 2:
+        raise ValueError("数据形状应为 (n_points, 2) 或 (n_scans, n_points, 2)")
+    return data
+
+
+def _argmax_in(values, lo, hi):
+    """每行在 [lo, hi) 索引范围内的最大值位置，范围为空时返回 -1"""
+    columns = np.arange(values.shape[1])
+    inside = (columns >= lo[:, np.newaxis]) & (columns < hi[:, np.newaxis])
+    idx = np.argmax(np.where(inside, values, -np.inf), axis=1)
+    return np.where(inside.any(axis=1), idx, -1)
+
+
+def _top_mean(values, start, stop, keep, drop_max=False):
+    """
+    每行取 values[start:stop] 中最大的 keep 个数求平均（drop_max 时先去掉最大值）
+
+    用 partition 只找出需要的几个最大值，再按升序依次求和，
+    与 np.mean(sorted(...)[-keep:]) 的结果逐位一致；没有可用数据时为 nan
+    """
+    n_scans, n_points = values.shape
+    width = 2 * PEAK_HALF_WIDTH
+    take = keep + int(drop_max)
+    positions = start[:, np.newaxis] + np.arange(width)
+    valid = (positions < stop[:, np.newaxis]) & (positions < n_points)
+    window = np.where(valid, values[np.arange(n_scans)[:, np.newaxis], np.clip(positions, 0, n_points - 1)], -np.inf)
+    top = np.sort(np.partition(window, width - take, axis=1)[:, width - take:], axis=1)
+    count = np.minimum(valid.sum(axis=1), take)
+    if drop_max:
+        top = top[:, :-1]
+        count = np.maximum(count - 1, 0)
+    total = np.zeros(n_scans)
+    for j in range(keep):
+        total = np.where(j >= keep - count, total + top[:, j], total)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan)
+
+
+def _proton_levels(values, idx):
+    """质子峰值：峰位 ±5 点窗口（起点截断到0）去掉最大值后取最大4个的平均"""
+    n_points = values.shape[1]
+    start = np.maximum(idx - PEAK_HALF_WIDTH, 0)
+    stop = np.minimum(idx + PEAK_HALF_WIDTH, n_points)
+    levels = _top_mean(values, start, stop, 4, drop_max=True)
+    return np.where(idx >= 0, levels, np.nan)
+
+
+def _deuteron_levels(values, idx):
+    """氘核峰值：峰位 ±5 点窗口（Python 切片语义）去掉窗口最后一点后取最大4个的平均"""
+    n_points = values.shape[1]
+    start = idx - PEAK_HALF_WIDTH
+    # 负起点按 Python 切片规则从末尾计数
+    start = np.where(start < 0, np.maximum(start + n_points, 0), start)
+    stop = np.minimum(idx + PEAK_HALF_WIDTH, n_points) - 1
+    levels = _top_mean(values, start, stop, 4)
+    return np.where(idx >= 0, levels, np.nan)
+
+
+def proton_peaks(data, split=None):
+    """
+    质子两个峰的位置和峰值
+
+    参数:
+    data: (n_scans, n_points, 2) 数组
+    split: 分界磁场 (Gs)，数据须按磁场升序；None 时使用 PROTON_INDEX_RANGES
+
+    返回: (峰位索引, 峰值) ，形状均为 (n_scans, 2)
+    """
+    fields, values = data[:, :, 0], data[:, :, 1]
+    n_scans, n_points = values.shape
+    if split is None:
+        (lo1, hi1), (lo2, hi2) = PROTON_INDEX_RANGES
+        bounds = [np.full(n_scans, b) for b in (lo1, hi1, lo2, hi2)]
+    else:
+        middle = np.sum(fields < split, axis=1)
+        bounds = [np.zeros(n_scans, dtype=int), middle, middle, np.full(n_scans, n_points)]
+    idx = np.column_stack((_argmax_in(values, bounds[0], bounds[1]), _argmax_in(values, bounds[2], bounds[3])))
+    levels = np.column_stack([_proton_levels(values, idx[:, k]) for k in range(2)])
+    return idx, levels
+
+
+def deuteron_peaks(data, ranges=DEUTERON_RANGES):
+    """
+    氘核三个峰的位置和峰值，峰在各磁场范围 [lo, hi) 内搜索
+
+    返回: (峰位索引, 峰值)，形状均为 (n_scans, 3)；范围内无数据时索引为 -1、峰值为 nan
+    """
+    fields, values = data[:, :, 0], data[:, :, 1]
+    idx = []
+    for lo, hi in ranges:
+        inside = (fields >= lo) & (fields < hi)
+        found = np.argmax(np.where(inside, values, -np.inf), axis=1)
+        idx.append(np.where(inside.any(axis=1), found, -1))
+    idx = np.column_stack(idx)
+    levels = np.column_stack([_deuteron_levels(values, idx[:, k]) for k in range(len(ranges))])
+    return idx, levels
+
+
+def _zero_background(n_scans, n_peaks):
+    """没有本底数据时的峰位索引（-1）和峰值（0）"""
+    return np.full((n_scans, n_peaks), -1), np.zeros((n_scans, n_peaks))
+
+
+def _fields_at(data, idx):
+    """按峰位索引取磁场，索引为 -1 或没有数据时为 nan"""
+    if data is None:
+        return np.full(idx.shape, np.nan)
+    fields = np.take_along_axis(data[:, :, 0], np.maximum(idx, 0), axis=1)
+    return np.where(idx >= 0, fields, np.nan)
+
+
+def calculate_polarization_batch(signal, background, particle_type='proton', proton_split=None,
+                                 deuteron_ranges=DEUTERON_RANGES):
+    """
+    批量计算极化度
+
+    参数:
+    signal, background: (n_scans, n_points, 2) 或 (n_points, 2)，前两列为 (磁场, 测量值)；
+                        signal 与 background 的扫描数须相同，点数可以不同；background 为 None 时按零本底计算
+    particle_type: 'proton' / 'deuteron'
+    proton_split: 见 proton_peaks
+    deuteron_ranges: 氘核三个峰的磁场范围，None 时为 DEUTERON_RANGES
+
+    返回: 字典，质子含 'polarization'，氘核含 'P_z'、'P_zz'，形状均为 (n_scans,)；
+         'peak_signal' / 'peak_background' 为 (峰位磁场, 峰值) 两个 (n_scans, 峰数) 数组
+    """
+    signal = _as_stack(signal)
+    background = None if background is None else _as_stack(background)
+    if background is not None and len(signal) != len(background):
+        raise ValueError("signal 与 background 的扫描数不一致")
+
+    result = {}
+    if particle_type.lower() in ['proton', 'p', 'h']:
+        s_idx, s_levels = proton_peaks(signal, proton_split)
+        b_idx, b_levels = (_zero_background(len(signal), 2) if background is None
+                           else proton_peaks(background, proton_split))
+        Np, Nn = s_levels.T
+        Nbp, Nbn = b_levels.T
+        result['polarization'] = ((Np - Nbp) - (Nn - Nbn)) / ((Np - Nbp) + (Nn - Nbn))
+        result['peak_signal'] = (_fields_at(signal, s_idx), s_levels)
+        result['peak_background'] = (_fields_at(background, b_idx), b_levels)
+        return result
+
+    elif particle_type.lower() in ['deuteron', 'd']:
+        s_idx, s_levels = deuteron_peaks(signal, deuteron_ranges or DEUTERON_RANGES)
+        b_idx, b_levels = (_zero_background(len(signal), 3) if background is None
+                           else deuteron_peaks(background, deuteron_ranges or DEUTERON_RANGES))
+        Np, N0, Nn = s_levels.T
+        Nbp, Nb0, Nbn = b_levels.T
+        result['P_z'] = ((Np - Nbp) - (Nn - Nbn)) / ((Np - Nbp) + (N0 - Nb0) + (Nn - Nbn))
+        result['P_zz'] = ((Np - Nbp) - 2 * (N0 - Nb0) + (Nn - Nbn)) / ((Np - Nbp) + (N0 - Nb0) + (Nn - Nbn))
+        result['peak_signal'] = (_fields_at(signal, s_idx), s_levels)
+        result['peak_background'] = (_fields_at(background, b_idx), b_levels)
+        return result
+    else:
+        raise ValueError("Unsupported particle type. Use 'proton' or 'deuteron'.")
+
+
+class OnlinePolarizationEstimator:
+    """
+    扫描过程中逐点更新的极化度估计
+
+    每来一个点就更新按磁场累积的光子信号，重新寻峰并计算极化度；
+    不确定度用蒙特卡罗传播：按每点均值的标准误差对信号和本底加噪声，
+    批量计算 samples 次取标准差。只测过一次的点用整条曲线估计的噪声。
+    """
+
+    def __init__(self, setpoints, particle_type='proton', background=None, proton_split=None,
+                 deuteron_ranges=DEUTERON_RANGES, samples=200, seed=None):
+        """
+        参数:
+        setpoints: 本次扫描计划访问的磁场值
+        particle_type: 'proton' / 'deuteron'
+        background: 本底数据 (磁场, 平均值[, 标准差, 次数])，None 时按零本底计算
+        proton_split: 见 proton_peaks
+        deuteron_ranges: 氘核三个峰的磁场范围，None 时为 DEUTERON_RANGES
+        samples: 蒙特卡罗次数
+        """
+        self.trace = PhotonTraceAccumulator(setpoints)
+        self.particle_type = particle_type
+        self.proton_split = proton_split
+        self.deuteron_ranges = deuteron_ranges
+        self.samples = samples
+        self._rng = np.random.default_rng(seed)
+        # 已完整扫过的遍数，由采集线程按扫描计划计数后设置
+        # （ROI 扫描中粗扫点只测一次，不能由每点测量次数的最小值推出）
+        self.sweeps_completed = 0
+        self.background = None if background is None else np.asarray(background, dtype=float)
+
+    def add(self, setpoint, value):
+        """加入一个点，返回 estimate()"""
+        self.trace.add(setpoint, value)
+        return self.estimate()
+
+    @staticmethod
+    def _sem(data):
+        """每点均值的标准误差；只测一次的点用相邻点差分的稳健估计（MAD）代替标准差"""
+        if data.shape[1] >= 4:
+            std, count = data[:, 2], np.maximum(data[:, 3], 1)
+        else:
+            std, count = np.zeros(len(data)), np.ones(len(data))
+        single = count < 2
+        if single.any():
+            repeated = ~single & (std > 0)
+            if repeated.any():
+                noise = np.median(std[repeated])
+            elif len(data) > 2:
+                noise = np.median(np.abs(np.diff(data[:, 1]))) / 0.6745 / np.sqrt(2)
+            else:
+                noise = 0.0
+            std = np.where(single, noise, std)
+        return std / np.sqrt(count)
+
+    def _perturbed(self, data):
+        """(samples, n_points, 2) 的加噪声数据"""
+        noise = self._rng.standard_normal((self.samples, len(data))) * self._sem(data)
+        stack = np.empty((self.samples, len(data), 2))
+        stack[:, :, 0] = data[:, 0]
+        stack[:, :, 1] = data[:, 1] + noise
+        return stack
+
+    def estimate(self):
+        """
+        返回当前估计 {名称: (数值, 不确定度)}，质子为 'polarization'，氘核为 'P_z'、'P_zz'；
+        峰还没有扫到时数值为 nan
+        """
+        signal = self.trace.compact()
+        if len(signal) == 0:
+            return {}
+        keys = ['polarization'] if self.particle_type.lower() in ['proton', 'p', 'h'] else ['P_z', 'P_zz']
+        background = self.background
+        with np.errstate(invalid='ignore', divide='ignore'):
+            central = calculate_polarization_batch(signal[:, :2], None if background is None else background[:, :2],
+                                                   self.particle_type, self.proton_split, self.deuteron_ranges)
+            spread = calculate_polarization_batch(self._perturbed(signal),
+                                                  None if background is None else self._perturbed(background),
+                                                  self.particle_type, self.proton_split, self.deuteron_ranges)
+        result = {}
+        for key in keys:
+            values = spread[key][np.isfinite(spread[key])]
+            sigma = float(np.std(values, ddof=1)) if len(values) > 1 else np.nan
+            result[key] = (float(central[key][0]), sigma)
+        return result
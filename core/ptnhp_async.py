@@ -0,0 +1,257 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .ptnhp_con import shared_ptnhp
+
+
+class EventLoopThread:
+    """
+    后台事件循环线程
+
+    GUI 线程用 submit() 把协程交给循环执行，得到 concurrent.futures.Future；
+    协程中的回调在循环线程中调用，通过 Qt 信号回到 GUI 线程。
+    """
+
+    def __init__(self, name="ptnhp-loop"):
+        self.name = name
+        self.loop = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._ready.clear()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+            self._ready.wait()
+        return self
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self._ready.set()
+        self.loop.run_forever()
+        self.loop.close()
+
+    def submit(self, coro):
+        """在循环线程中执行协程，返回 concurrent.futures.Future"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call_soon(self, callback, *args):
+        """在循环线程中调用普通函数"""
+        self.start()
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def stop(self):
+        if self._thread is not None and self._thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join(timeout=2)
+        self._thread = None
+
+
+class RampError(RuntimeError):
+    """ramp 失败：回读无效、电源未跟随设定值或未在时限内到达目标"""
+
+
+class Ramp:
+    """
+    一次闭环电流 ramp
+
+    设定值按 slew_rate (A/s) 随实际经过的时间向目标前进，命令延迟不会拖慢 ramp；
+    每隔 checkpoint 秒回读一次电流，偏离设定值超过 tolerance + slew_rate * lag
+    （电源自身响应滞后）连续 max_misses 次即判定电源未跟随并立即失败；
+    设定值到达目标后轮询回读，进入 tolerance 范围即结束。
+    目标值可以在运行中修改（retarget），所在任务被取消时电流停在当前设定值。
+    """
+
+    def __init__(self, driver, target, slew_rate, interval=0.02, checkpoint=0.2, tolerance=0.05, lag=0.5,
+                 max_misses=2, settle_timeout=2.0, on_progress=None):
+        """
+        参数:
+        driver: AsyncPTNhp
+        target: 目标电流 (A)
+        slew_rate: 允许的电流变化率 (A/s)
+        interval: 设定值更新间隔 (s)
+        checkpoint: 回读检查间隔 (s)
+        tolerance: 到达目标和跟随判断的允许偏差 (A)
+        lag: 电源响应滞后时间 (s)，跟随判断时额外允许 slew_rate * lag 的偏差
+        max_misses: 连续几次检查不合格判定为未跟随
+        settle_timeout: 设定值到达目标后等待回读到达的时限 (s)
+        on_progress: 进度回调 on_progress(设定值, 目标值, 回读值)，未回读时回读值为 None
+        """
+        self.driver = driver
+        self.target = float(target)
+        self.slew_rate = slew_rate
+        self.interval = interval
+        self.checkpoint = checkpoint
+        self.tolerance = tolerance
+        self.lag = lag
+        self.max_misses = max_misses
+        self.settle_timeout = settle_timeout
+        self.on_progress = on_progress
+        self.setpoint = None
+        self.reading = None
+
+    def retarget(self, target):
+        """修改目标值（线程安全），ramp 从当前设定值继续向新目标前进"""
+        self.driver.loop_thread.call_soon(setattr, self, 'target', float(target))
+
+    async def _read(self):
+        reading = await self.driver.measure_current()
+        self.reading = reading if isinstance(reading, float) else None
+        return self.reading
+
+    def _progress(self, reading=None):
+        if self.on_progress is not None:
+            self.on_progress(self.setpoint, self.target, reading)
+
+    def _check(self, reading, misses):
+        """检查回读是否跟随设定值，返回新的连续不合格次数"""
+        allowed = self.tolerance + self.slew_rate * self.lag
+        if reading is not None and abs(reading - self.setpoint) <= allowed:
+            return 0
+        misses += 1
+        if misses >= self.max_misses:
+            raise RampError(f"电源未跟随：设定 {self.setpoint:.3f} A，回读 {reading}，允许偏差 {allowed:.3f} A")
+        return misses
+
+    async def run(self, start=None):
+        """执行 ramp，返回到达目标后的回读值"""
+        if start is None:
+            start = await self._read()
+        if not isinstance(start, (int, float)):
+            raise RampError(f"无法读取当前电流: {start}")
+        self.setpoint = float(start)
+        loop = asyncio.get_running_loop()
+        last = loop.time()
+        next_check = last + self.checkpoint
+        misses = 0
+        while True:
+            now = loop.time()
+            step = self.slew_rate * (now - last)
+            last = now
+            delta = self.target - self.setpoint
+            self.setpoint = self.target if abs(delta) <= step else self.setpoint + (step if delta > 0 else -step)
+            if not await self.driver.set_current(self.setpoint):
+                raise RampError(f"设置电流 {self.setpoint:.3f} A 失败")
+            reading = None
+            if now >= next_check:
+                reading = await self._read()
+                next_check = now + self.checkpoint
+                misses = self._check(reading, misses)
+            self._progress(reading)
+            if self.setpoint == self.target:
+                break
+            await asyncio.sleep(self.interval)
+        return await self._settle()
+
+    async def _settle(self):
+        """设定值已到达目标：轮询回读直到进入允许偏差，超时失败"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.settle_timeout
+        while True:
+            reading = await self._read()
+            self._progress(reading)
+            if reading is not None and abs(reading - self.target) <= self.tolerance:
+                return reading
+            if loop.time() >= deadline:
+                raise RampError(f"电流未在 {self.settle_timeout:.1f} s 内到达 {self.target:.3f} A，回读 {reading}")
+            await asyncio.sleep(self.interval)
+
+
+class AsyncPTNhp:
+    """
+    PTNhp 电源的 asyncio 驱动
+
+    命令通过共享会话（见 shared_ptnhp）在单线程执行器中按顺序执行，不另开连接；
+    ramp 是可取消、可修改目标的协程，可以与回读轮询等其它协程同时等待。
+    电源操作序列（如准备、下电）用 start_task 提交，同一时刻只有一个任务：
+    开始新任务时取消正在进行的任务，不需要销毁线程。
+    """
+
+    def __init__(self, session=None, loop_thread=None):
+        self._session = session
+        self.loop_thread = loop_thread or EventLoopThread()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ptnhp-io")
+        self.task = None
+        self.ramp = None
+
+    @property
+    def session(self):
+        """未指定会话时每次取当前地址的共享会话（启用模拟后端后自动切换）"""
+        return self._session or shared_ptnhp()
+
+    async def _call(self, name, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, getattr(self.session, name), *args)
+
+    async def connect(self):
+        return await self._call("connect")
+
+    async def start_output(self):
+        return await self._call("start_output")
+
+    async def stop_output(self):
+        return await self._call("stop_output")
+
+    async def set_voltage(self, value):
+        return await self._call("set_voltage", value)
+
+    async def set_current(self, value):
+        return await self._call("set_current", value)
+
+    async def measure_current(self):
+        return await self._call("measure_current")
+
+    async def measure_voltage(self):
+        return await self._call("measure_voltage")
+
+    async def poll_current(self, interval, callback, stop=None):
+        """每 interval 秒回读一次电流并调用 callback(读数)，stop() 返回 True 或被取消时结束"""
+        while stop is None or not stop():
+            callback(await self.measure_current())
+            await asyncio.sleep(interval)
+
+    async def ramp_to(self, target, slew_rate, start=None, on_progress=None, **options):
+        """
+        闭环 ramp 到目标电流，返回到达后的回读值；失败时抛出 RampError
+        进行中的 ramp 保存在 self.ramp，可用 retarget 修改目标
+
+        参数:
+        target: 目标电流 (A)
+        slew_rate: 允许的电流变化率 (A/s)
+        start: 起始电流，None 时先回读
+        on_progress: 进度回调 on_progress(设定值, 目标值, 回读值)
+        options: 传给 Ramp 的其它参数（interval、checkpoint、tolerance 等）
+        """
+        ramp = self.ramp = Ramp(self, target, slew_rate, on_progress=on_progress, **options)
+        try:
+            return await ramp.run(start)
+        finally:
+            if self.ramp is ramp:
+                self.ramp = None
+
+    def submit(self, coro):
+        """在循环线程中执行协程（线程安全），返回 concurrent.futures.Future"""
+        return self.loop_thread.submit(coro)
+
+    def start_task(self, coro):
+        """开始独占的电源任务（线程安全），先取消正在进行的任务"""
+        self.cancel()
+        self.task = self.submit(coro)
+        return self.task
+
+    def is_busy(self):
+        return self.task is not None and not self.task.done()
+
+    def cancel(self):
+        """取消正在进行的任务，电流停在当前设定值"""
+        if self.task is not None:
+            self.task.cancel()
+
+    def close(self):
+        self.cancel()
+        self.loop_thread.stop()
+        self._executor.shutdown(wait=False)
@@ -1,12 +1,26 @@
 import socket
+import threading
 import time
 import math
 import re
+from . import simulator
+
+# PTNhp 电源默认地址
+PTNHP_IP = "192.168.1.123"
+PTNHP_PORT = 7
+
+
+def ptnhp_address():
+    """返回 PTNhp 电源地址 (ip, port)；启用模拟后端时返回本地模拟服务器地址"""
+    if simulator.is_enabled():
+        return simulator.get_backend().ptnhp_address
+    return PTNHP_IP, PTNHP_PORT
+
 
 class PTNhpController:
     """仪器控制类，封装了与仪器通信的常用功能"""
 
-    def __init__(self, ip, port, timeout=5, terminator='\n'):
+    def __init__(self, ip, port, timeout=5, terminator='\n', opc=False):
         """
         初始化仪器控制器
 
@@ -15,19 +29,25 @@ class PTNhpController:
             port: 通信端口
             timeout: 超时时间(秒)
             terminator: 命令终止符(默认换行符，部分仪器可能需要\r\n)
+            opc: 设置命令后追加 *OPC? 并等待应答，确认命令已执行且不留未读数据
         """
         self.ip = ip
         self.port = port
         self.timeout = timeout
         self.terminator = terminator
+        self.opc = opc
         self.socket = None
+        self._buffer = b''  # 已接收但尚未取走的应答数据
+        self.discarded = 0  # 查询前丢弃的未读取应答字节数（累计）
 
     def connect(self):
         """建立与仪器的TCP连接"""
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.socket.settimeout(self.timeout)
             self.socket.connect((self.ip, self.port))
+            self._buffer = b''
             print(f"已连接到仪器: {self.ip}:{self.port}")
             return True
         except Exception as e:
@@ -36,6 +56,7 @@ class PTNhpController:
 
     def close(self):
         """关闭与仪器的连接"""
+        self._buffer = b''
         if self.socket:
             self.socket.close()
             self.socket = None
@@ -54,120 +75,311 @@ class PTNhpController:
             return True
         except Exception as e:
             print(f"命令发送失败: {str(e)}")
+            # 连接已不可用，丢弃套接字以便重连
+            self.close()
             return False
 
-    def _receive_response(self, buffer_size=1024):
-        """内部方法：接收仪器响应"""
+    def _receive_response(self, buffer_size=1024, timeout=None):
+        """
+        内部方法：接收一条以换行结尾的应答
+
+        一次 recv 可能只收到半条或同时收到多条应答，按换行分帧，多余部分留在缓冲区供下一次读取；
+        timeout 为本次读取的总超时(秒)，None 时使用连接超时
+        """
         if not self.socket:
             print("未建立连接，请先调用connect()")
             return None
 
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
         try:
-            response = self.socket.recv(buffer_size)
-            if response:
-                # 解码并去除首尾空白字符(包括终止符)
-                return response.decode().strip()
-            else:
-                print("未收到响应数据")
-                return None
+            while b'\n' not in self._buffer:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout("等待应答超时")
+                self.socket.settimeout(remaining)
+                chunk = self.socket.recv(buffer_size)
+                if not chunk:
+                    # 对端已关闭连接
+                    print("未收到响应数据")
+                    self.close()
+                    return None
+                self._buffer += chunk
+            line, self._buffer = self._buffer.split(b'\n', 1)
+            # 解码并去除首尾空白字符(包括 \r)
+            return line.decode().strip()
         except Exception as e:
             print(f"接收响应失败: {str(e)}")
+            # 超时后可能还有迟到的应答留在缓冲区，重连以免与后续查询错位
+            self.close()
+            return None
+        finally:
+            if self.socket:
+                self.socket.settimeout(self.timeout)
+
+    def _discard_pending(self):
+        """内部方法：丢弃之前未被读取的应答，避免与本次查询错位；连接已失效时返回 False"""
+        stale = self._buffer
+        self._buffer = b''
+        try:
+            self.socket.setblocking(False)
+            while True:
+                chunk = self.socket.recv(4096)
+                if not chunk:
+                    break
+                stale += chunk
+        except (BlockingIOError, socket.timeout):
+            pass
+        except OSError:
+            self.close()
+            return False
+        finally:
+            if self.socket:
+                self.socket.settimeout(self.timeout)
+        self.discarded += len(stale)
+        return True
+
+    def query(self, command, timeout=None):
+        """发送查询并读取一条应答；timeout 为本次查询的超时(秒)"""
+        if not self.socket:
+            print("未建立连接，请先调用connect()")
             return None
+        if self._discard_pending() and self._send_command(command):
+            return self._receive_response(timeout=timeout)
+        return None
+
+    def query_many(self, commands, timeout=None):
+        """
+        流水线查询：一次发送多条查询，再按发送顺序依次读取应答
+
+        返回: 与 commands 一一对应的应答列表，读取失败的位置为 None
+        """
+        commands = list(commands)
+        if not self.socket:
+            print("未建立连接，请先调用connect()")
+            return [None] * len(commands)
+        if not (self._discard_pending() and self._send_command(self.terminator.join(commands))):
+            return [None] * len(commands)
+        replies = []
+        for _ in commands:
+            replies.append(self._receive_response(timeout=timeout) if self.socket else None)
+        return replies
+
+    def _write(self, command):
+        """内部方法：发送设置命令；启用 opc 时等待 *OPC? 应答确认"""
+        if self.opc:
+            return self.query(f"{command};*OPC?") == '1'
+        return self._send_command(command)
+
+    @staticmethod
+    def _parse_number(response):
+        """从应答中提取数值（如 '2.0506A'），无法解析时原样返回"""
+        if response:
+            m = re.search(r'[-+]?\d*\.?\d+(?:[eE][-+]?\d+)?', response)
+            if m:
+                try:
+                    return float(m.group(0))
+                except ValueError:
+                    pass
+            try:
+                return float(response)
+            except ValueError:
+                return response
+        return None
 
     def query_idn(self):
         """查询仪器标识(*IDN?)"""
-        if self._send_command("*IDN?"):
-            return self._receive_response()
-        return None
+        return self.query("*IDN?")
 
     def start_output(self):
-        """查询仪器标识(*IDN?)"""
-        if self._send_command("OUTP ON"):
-            return self._receive_response()
-        return None
+        """打开输出(OUTP ON)，返回仪器应答"""
+        return self.query("OUTP ON")
 
     def stop_output(self):
-        """查询仪器标识(*IDN?)"""
-        if self._send_command("OUTP OFF"):
-            return self._receive_response()
-        return None
+        """关闭输出(OUTP OFF)，返回仪器应答"""
+        return self.query("OUTP OFF")
 
     def set_voltage(self, value):
         """设置电压(VOLT命令)"""
         # 确保输入是数字
         try:
             value = float(value)
-            return self._send_command(f"VOLT {value}")
+            return self._write(f"VOLT {value}")
         except ValueError:
             print("电压值必须是数字")
             return False
 
-    def read_set_voltage(self, value):
+    def read_set_voltage(self, value=None):
         """读取设置电压(VOLT命令)"""
-        if self._send_command("VOLT?"):
-            response = self._receive_response()
-            # 尝试将响应转换为浮点数
-            try:
-                return float(response) if response else None
-            except ValueError:
-                print(f"读取设置电压格式错误: {response}")
-                return response
+        response = self.query("VOLT?")
+        # 尝试将响应转换为浮点数
+        try:
+            return float(response) if response else None
+        except ValueError:
+            print(f"读取设置电压格式错误: {response}")
+            return response
 
     def set_current(self, value):
         """设置电流(CURR命令)"""
         try:
             value = float(value)
-            return self._send_command(f"CURR {value}")
+            return self._write(f"CURR {value}")
         except ValueError:
             print("电流值必须是数字")
             return False
 
-    def read_set_current(self, value):
+    def read_set_current(self, value=None):
         """读取设置电流(CURR命令)"""
-        if self._send_command("CURR?"):
-            response = self._receive_response()
-            # 尝试将响应转换为浮点数
-            try:
-                return float(response) if response else None
-            except ValueError:
-                print(f"读取设置电流格式错误: {response}")
-                return response
+        response = self.query("CURR?")
+        # 尝试将响应转换为浮点数
+        try:
+            return float(response) if response else None
+        except ValueError:
+            print(f"读取设置电流格式错误: {response}")
+            return response
 
-    def measure_voltage(self):
+    def measure_voltage(self, timeout=None):
         """测量电压(MEAS:VOLT?)"""
-        if self._send_command("MEAS:VOLT?"):
-            response = self._receive_response()
-            if response:
-                m = re.search(r'[-+]?\d*\.?\d+(?:[eE][-+]?\d+)?', response)
-                if m:
-                    try:
-                        return float(m.group(0))
-                    except ValueError:
-                        pass
-                try:
-                    return float(response)
-                except ValueError:
-                    return response
-            return None
-        return None
+        return self._parse_number(self.query("MEAS:VOLT?", timeout))
 
-    def measure_current(self):
+    def measure_current(self, timeout=None):
         """测量电流(MEAS:CURR?)"""
-        if self._send_command("MEAS:CURR?"):
-            response = self._receive_response()
-            if response:
-                m = re.search(r'[-+]?\d*\.?\d+(?:[eE][-+]?\d+)?', response)
-                if m:
-                    try:
-                        return float(m.group(0))
-                    except ValueError:
-                        pass
+        return self._parse_number(self.query("MEAS:CURR?", timeout))
+
+    def measure_all(self, timeout=None):
+        """流水线读取 (设置电流, 实测电流, 实测电压)"""
+        set_current, current, voltage = self.query_many(["CURR?", "MEAS:CURR?", "MEAS:VOLT?"], timeout)
+        return self._parse_number(set_current), self._parse_number(current), self._parse_number(voltage)
+
+
+class PTNhpSession:
+    """
+    进程内共享的 PTNhp 电源连接
+
+    所有线程共用一个 TCP 连接，每条命令（含应答）在锁内完成，不会交错；
+    连接断开时在下一条命令前自动重连，命令失败且连接已断开时重连后重试一次；
+    后台保活线程在空闲超过 keepalive_interval 时发送 *IDN?，避免连接被设备或网络设备断开。
+    多条命令需要连续执行时用 with session.locked(): 包住。
+    """
+
+    def __init__(self, ip, port, timeout=5, terminator='\n', keepalive_interval=30.0, opc=False):
+        self.controller = PTNhpController(ip, port, timeout=timeout, terminator=terminator, opc=opc)
+        self.keepalive_interval = keepalive_interval
+        self._lock = threading.RLock()
+        self._last_used = time.monotonic()
+        self._keepalive = None
+        self._closed = threading.Event()
+
+    @property
+    def is_connected(self):
+        return self.controller.socket is not None
+
+    @property
+    def discarded(self):
+        """查询前丢弃的未读取应答字节数（累计），调用方比较前后差值判断是否有错位"""
+        return self.controller.discarded
+
+    def locked(self):
+        """返回会话锁，在 with 块内连续执行的命令不会被其它线程插入"""
+        return self._lock
+
+    def connect(self):
+        """确保连接可用（已连接时直接返回 True），并启动保活线程"""
+        with self._lock:
+            self._closed.clear()
+            if not self.is_connected and not self.controller.connect():
+                return False
+            self._last_used = time.monotonic()
+        if self.keepalive_interval and (self._keepalive is None or not self._keepalive.is_alive()):
+            self._keepalive = threading.Thread(target=self._keepalive_loop, daemon=True)
+            self._keepalive.start()
+        return True
+
+    def close(self):
+        """关闭共享连接并停止保活（程序退出时调用，各线程用完后不需要关闭）"""
+        self._closed.set()
+        with self._lock:
+            self.controller.close()
+
+    def _call(self, name, *args):
+        """在锁内执行控制器方法；连接断开时重连，命令因断线失败时重试一次"""
+        with self._lock:
+            for attempt in range(2):
+                if not self.is_connected and not self.controller.connect():
+                    return None
+                result = getattr(self.controller, name)(*args)
+                self._last_used = time.monotonic()
+                if self.is_connected or attempt:
+                    return result
+                print(f"PTNhp 连接中断，重连后重试 {name}")
+
+    def _keepalive_loop(self):
+        while not self._closed.wait(min(self.keepalive_interval, 1.0)):
+            if time.monotonic() - self._last_used < self.keepalive_interval or not self.is_connected:
+                continue
+            # 正在执行命令的线程优先，拿不到锁说明连接正在使用
+            if self._lock.acquire(blocking=False):
                 try:
-                    return float(response)
-                except ValueError:
-                    return response
-            return None
-        return None
+                    if self.controller.query_idn() is None:
+                        print("PTNhp 保活失败，下次使用时重连")
+                    self._last_used = time.monotonic()
+                finally:
+                    self._lock.release()
+
+    def query(self, command, timeout=None):
+        return self._call("query", command, timeout)
+
+    def query_many(self, commands, timeout=None):
+        return self._call("query_many", commands, timeout)
+
+    def query_idn(self):
+        return self._call("query_idn")
+
+    def start_output(self):
+        return self._call("start_output")
+
+    def stop_output(self):
+        return self._call("stop_output")
+
+    def set_voltage(self, value):
+        return self._call("set_voltage", value)
+
+    def read_set_voltage(self, value=None):
+        return self._call("read_set_voltage", value)
+
+    def set_current(self, value):
+        return self._call("set_current", value)
+
+    def read_set_current(self, value=None):
+        return self._call("read_set_current", value)
+
+    def measure_voltage(self, timeout=None):
+        return self._call("measure_voltage", timeout)
+
+    def measure_current(self, timeout=None):
+        return self._call("measure_current", timeout)
+
+    def measure_all(self, timeout=None):
+        return self._call("measure_all", timeout)
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
 
+def shared_ptnhp(timeout=5, terminator='\n', opc=False):
+    """返回当前电源地址（见 ptnhp_address）对应的进程内共享会话，首次调用时创建"""
+    address = ptnhp_address()
+    with _sessions_lock:
+        session = _sessions.get(address)
+        if session is None:
+            session = _sessions[address] = PTNhpSession(*address, timeout=timeout, terminator=terminator, opc=opc)
+        return session
 
 
+def close_shared_ptnhp():
+    """关闭所有共享会话"""
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        session.close()
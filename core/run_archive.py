@@ -0,0 +1,281 @@
+import csv
+import json
+import os
+import threading
+import zipfile
+from datetime import datetime
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:  # 没有 h5py 时使用 NPZ 格式
+    h5py = None
+
+
+class RunArchive:
+    """
+    运行数据归档
+
+    按列保存的二进制归档，采集过程中逐次追加：
+    - 元数据：运行参数（IP、通道、增益、time_scal、粒子类型等），保存为文件属性
+    - 表格 tables/<表名>/<列名>：每列一个一维数组，每次追加一行或多行
+    - 波形 waveforms/<名称>：形状 (次数, 通道数, 点数) 的 float32 数组，表格中记录波形名称和行号
+
+    文件扩展名为 .h5 / .hdf5 且安装了 h5py 时写入 HDF5（分块、gzip 压缩，可边采集边读取）；
+    否则写入 NPZ（压缩）：每次 flush 把新追加的数据作为一组新的数据块追加到 zip 中，
+    不重写已写入的部分，内存中只保留尚未写盘的数据。读取时按块号依次拼接。
+    """
+
+    def __init__(self, path, metadata=None, chunk_rows=64, flush_every=50):
+        """
+        参数:
+        path: 归档文件路径
+        metadata: 运行元数据字典
+        chunk_rows: HDF5 表格列的分块行数
+        flush_every: 每追加多少次自动写盘
+        """
+        self.chunk_rows = chunk_rows
+        self.flush_every = flush_every
+        self.use_hdf5 = h5py is not None and os.path.splitext(path)[1].lower() in ('.h5', '.hdf5')
+        if not self.use_hdf5 and os.path.splitext(path)[1].lower() != '.npz':
+            path += '.npz'
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._tables = {}      # NPZ: 尚未写盘的 {表名: {列名: [数组, ...]}}
+        self._waveforms = {}   # NPZ: 尚未写盘的 {名称: [数组, ...]}
+        self._waveform_rows = {}  # NPZ: {名称: (已追加次数, 单次波形形状)}
+        self._chunk = 0        # NPZ: 下一个数据块的块号
+        self._metadata_dirty = True
+        self._metadata = {"created": datetime.now().isoformat(timespec="seconds")}
+        if self.use_hdf5:
+            self._file = h5py.File(path, 'a')
+            self._file.attrs["created"] = self._metadata["created"]
+        elif os.path.exists(path):
+            self._resume_npz()
+        self.set_metadata(**(metadata or {}))
+
+    def _resume_npz(self):
+        """已有的 NPZ 归档：从最后一个块号之后继续追加，波形行号接着已写入的次数"""
+        with zipfile.ZipFile(self.path) as zf:
+            metadata = None
+            for member in zf.namelist():
+                key, chunk = member[:-len('.npy')].rsplit('/', 1)
+                self._chunk = max(self._chunk, int(chunk) + 1)
+                if key == "metadata":
+                    metadata = member
+                elif key.startswith("waveforms/"):
+                    # 只读取数组头得到形状，不读取数据
+                    with zf.open(member) as f:
+                        major, _ = np.lib.format.read_magic(f)
+                        read_header = np.lib.format.read_array_header_1_0 if major == 1 else \
+                            np.lib.format.read_array_header_2_0
+                        shape = read_header(f)[0]
+                    name = key.split('/', 1)[1]
+                    rows = self._waveform_rows.get(name, (0, None))[0]
+                    self._waveform_rows[name] = (rows + shape[0], tuple(shape[1:]))
+            if metadata is not None:
+                # 保留已有的元数据，新的元数据在其上更新
+                with zf.open(metadata) as f:
+                    self._metadata = {**json.loads(str(np.lib.format.read_array(f))), "created": self._metadata["created"]}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def set_metadata(self, **metadata):
+        """更新运行元数据；列表、字典等保存为 JSON 字符串"""
+        with self._lock:
+            for key, value in metadata.items():
+                if not isinstance(value, (str, int, float, bool, np.number)):
+                    value = json.dumps(value, ensure_ascii=False, default=str)
+                self._metadata[key] = value
+                if self.use_hdf5:
+                    self._file.attrs[key] = value
+            self._metadata_dirty = True
+
+    @staticmethod
+    def _column(value):
+        """把一行或多行的值转换为一维数组"""
+        array = np.atleast_1d(np.asarray(value))
+        if array.dtype.kind in 'US':
+            return array.astype(object)
+        return array
+
+    def append_rows(self, table, **columns):
+        """
+        向表格追加一行或多行
+
+        参数:
+        table: 表名
+        columns: 列名=值，值为标量（一行）或一维数组（多行），各列行数须相同
+        """
+        arrays = {name: self._column(value) for name, value in columns.items()}
+        if len({len(array) for array in arrays.values()}) > 1:
+            raise ValueError("各列的行数不一致")
+        with self._lock:
+            if self.use_hdf5:
+                group = self._group(f"tables/{table}")
+                for name, array in arrays.items():
+                    self._append_dataset(group, name, array)
+            else:
+                store = self._tables.setdefault(table, {})
+                for name, array in arrays.items():
+                    store.setdefault(name, []).append(array)
+            self._count()
+
+    def append_waveforms(self, name, waveforms):
+        """
+        追加一次采集的多通道波形，返回 (实际写入的波形名称, 行号)
+
+        参数:
+        name: 波形组名称；记录长度改变时自动写入 <名称>_<点数>
+        waveforms: 形状 (通道数, 点数) 的数组
+        """
+        waveforms = np.asarray(waveforms, dtype=np.float32)[np.newaxis]
+        with self._lock:
+            if self.use_hdf5:
+                group = self._group("waveforms")
+                if name in group and group[name].shape[1:] != waveforms.shape[1:]:
+                    name = f"{name}_{waveforms.shape[-1]}"
+                index = self._append_dataset(group, name, waveforms)
+            else:
+                rows, shape = self._waveform_rows.get(name, (0, waveforms.shape[1:]))
+                if shape != waveforms.shape[1:]:
+                    name = f"{name}_{waveforms.shape[-1]}"
+                    rows, shape = self._waveform_rows.get(name, (0, waveforms.shape[1:]))
+                index = rows
+                self._waveform_rows[name] = (rows + 1, shape)
+                self._waveforms.setdefault(name, []).append(waveforms)
+            self._count()
+        return name, index
+
+    def _group(self, name):
+        """HDF5 组，新建时按写入顺序保存列，导出 CSV 时列顺序与追加时一致"""
+        if name in self._file:
+            return self._file[name]
+        return self._file.create_group(name, track_order=True)
+
+    def _append_dataset(self, group, name, array):
+        """追加到可扩展的数据集，返回第一行的行号"""
+        if name not in group:
+            if array.dtype == object:
+                dtype = h5py.string_dtype()
+            else:
+                dtype = array.dtype
+            chunks = (self.chunk_rows,) + array.shape[1:] if array.ndim == 1 else (1,) + array.shape[1:]
+            group.create_dataset(name, shape=(0,) + array.shape[1:], maxshape=(None,) + array.shape[1:],
+                                 dtype=dtype, chunks=chunks, compression="gzip", shuffle=True)
+        dataset = group[name]
+        start = dataset.shape[0]
+        dataset.resize(start + len(array), axis=0)
+        dataset[start:] = array
+        return start
+
+    def _count(self):
+        self._pending += 1
+        if self._pending >= self.flush_every:
+            self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        self._pending = 0
+        if self.use_hdf5:
+            self._file.flush()
+            return
+        arrays = {}
+        if self._metadata_dirty:
+            arrays["metadata"] = np.array(json.dumps(self._metadata, ensure_ascii=False, default=str))
+        for table, columns in self._tables.items():
+            for name, chunks in columns.items():
+                column = np.concatenate(chunks)
+                # 字符串列保存为定长 Unicode，读取时不需要 allow_pickle
+                arrays[f"tables/{table}/{name}"] = column.astype(str) if column.dtype == object else column
+        for name, chunks in self._waveforms.items():
+            arrays[f"waveforms/{name}"] = np.concatenate(chunks)
+        if not arrays:
+            return
+        # 每个数组写为 zip 中的一个新成员 <键>/<块号>.npy，已有成员不改动
+        with zipfile.ZipFile(self.path, 'a', compression=zipfile.ZIP_DEFLATED) as zf:
+            for key, array in arrays.items():
+                with zf.open(f"{key}/{self._chunk:06d}.npy", 'w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+        self._chunk += 1
+        self._tables = {}
+        self._waveforms = {}
+        self._metadata_dirty = False
+
+    def close(self):
+        with self._lock:
+            if self.use_hdf5:
+                if self._file:
+                    self._file.close()
+                    self._file = None
+            else:
+                self._flush()
+
+
+def read_archive(path):
+    """
+    读取归档
+
+    返回: (元数据字典, {表名: {列名: 数组}}, {波形名称: 数组})
+    """
+    tables, waveforms = {}, {}
+    if os.path.splitext(path)[1].lower() == '.npz':
+        chunks = {}
+        with np.load(path) as data:
+            # 键为 <类型>/<名称>/<块号>，按块号顺序拼接；元数据取最后写入的一份
+            for key in sorted(data.files, key=lambda k: k.rsplit('/', 1)[1]):
+                chunks.setdefault(key.rsplit('/', 1)[0], []).append(data[key])
+        metadata = json.loads(str(chunks.pop("metadata")[-1]))
+        for key, arrays in chunks.items():
+            kind, _, rest = key.partition('/')
+            if kind == "tables":
+                table, name = rest.split('/', 1)
+                tables.setdefault(table, {})[name] = np.concatenate(arrays)
+            elif kind == "waveforms":
+                waveforms[rest] = np.concatenate(arrays)
+        return metadata, tables, waveforms
+
+    if h5py is None:
+        raise ImportError("读取 HDF5 归档需要安装 h5py")
+    with h5py.File(path, 'r') as f:
+        metadata = dict(f.attrs)
+        for table, group in f.get("tables", {}).items():
+            tables[table] = {name: (dataset.asstr()[()] if h5py.check_string_dtype(dataset.dtype) else dataset[()])
+                             for name, dataset in group.items()}
+        for name, dataset in f.get("waveforms", {}).items():
+            waveforms[name] = dataset[()]
+    return metadata, tables, waveforms
+
+
+def export_csv(path, csv_path, table=None, waveform=None, index=0):
+    """
+    把归档中的表格或一次波形导出为 CSV
+
+    参数:
+    path: 归档文件
+    csv_path: 输出 CSV 文件
+    table: 表名，导出整张表
+    waveform, index: 波形名称和行号，导出该次波形（每个通道一列）
+    """
+    metadata, tables, waveforms = read_archive(path)
+    with open(csv_path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        if table is not None:
+            columns = tables[table]
+            writer.writerow(list(columns))
+            writer.writerows(zip(*columns.values()))
+        elif waveform is not None:
+            shot = waveforms[waveform][index]
+            writer.writerow([f"CH{k}" for k in range(len(shot))])
+            writer.writerows(shot.T)
+        else:
+            raise ValueError("需要指定 table 或 waveform")
@@ -0,0 +1,92 @@
+from collections import deque
+import math
+
+
+class RunningStatistics:
+    """增量统计量：Welford 算法计算均值/方差，记录最值，可选滑动窗口统计"""
+
+    def __init__(self, window=None):
+        """
+        参数:
+        window: 滑动窗口长度，None 表示只统计全部数据
+        """
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        """清空所有统计量"""
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self._window_values = deque()
+        self._window_mean = 0.0
+        self._window_m2 = 0.0
+
+    def add(self, value):
+        """加入一个新数据点，O(1)"""
+        value = float(value)
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+        if self.window:
+            self._window_values.append(value)
+            k = len(self._window_values)
+            delta = value - self._window_mean
+            self._window_mean += delta / k
+            self._window_m2 += delta * (value - self._window_mean)
+            if k > self.window:
+                # 反向 Welford：移除窗口外最旧的数据点
+                old = self._window_values.popleft()
+                k -= 1
+                delta = old - self._window_mean
+                self._window_mean -= delta / k
+                self._window_m2 = max(self._window_m2 - delta * (old - self._window_mean), 0.0)
+
+    @property
+    def variance(self):
+        """样本方差（ddof=1），数据量不足时返回0"""
+        if self.count < 2:
+            return 0.0
+        return self._m2 / (self.count - 1)
+
+    @property
+    def std(self):
+        """样本标准差，与 DataProcessor.calculate_sigma 一致"""
+        return math.sqrt(self.variance)
+
+    @property
+    def window_count(self):
+        return len(self._window_values) if self.window else self.count
+
+    @property
+    def window_mean(self):
+        """滑动窗口内的均值，未设置窗口时等于总体均值"""
+        return self._window_mean if self.window else self.mean
+
+    @property
+    def window_std(self):
+        """滑动窗口内的样本标准差"""
+        if not self.window:
+            return self.std
+        k = len(self._window_values)
+        if k < 2:
+            return 0.0
+        return math.sqrt(self._window_m2 / (k - 1))
+
+    @property
+    def window_min(self):
+        if not self.window:
+            return self.min
+        return min(self._window_values) if self._window_values else math.inf
+
+    @property
+    def window_max(self):
+        if not self.window:
+            return self.max
+        return max(self._window_values) if self._window_values else -math.inf
@@ -0,0 +1,204 @@
+import numpy as np
+
+# 磁场 (Gs) 与电源电流 (A) 的换算，与 DataAcquisitionThread 一致
+AMPS_PER_GAUSS = 2 / 103.6
+
+# 扫描顺序
+ORDER_FILE = "file"              # 按磁场表原顺序，重复 repeats 次
+ORDER_SERPENTINE = "serpentine"  # 往返扫描：升序、降序交替，总电流变化最小
+ORDER_MONOTONIC = "monotonic"    # 单向扫描：每次都升序，磁滞条件一致
+
+
+class ScanPlanner:
+    """
+    磁场扫描规划
+
+    根据磁场表和重复次数生成访问顺序，并按
+    每点耗时 = settle_base + settle_per_amp * |ΔI| + point_time
+    预测扫描总时间；模型参数可用上一次扫描的实测记录校准。
+    """
+
+    def __init__(self, settle_base=0.3, settle_per_amp=0.3, point_time=0.3):
+        """
+        参数:
+        settle_base: 每次改变电流的固定稳定时间 (s)
+        settle_per_amp: 每安培步长增加的稳定时间 (s/A)
+        point_time: 每点触发、读取和积分的时间 (s)
+        """
+        self.settle_base = settle_base
+        self.settle_per_amp = settle_per_amp
+        self.point_time = point_time
+
+    @staticmethod
+    def sweep_count(bfields):
+        """磁场表中每个磁场值的最大出现次数，即表内已包含的扫描遍数"""
+        _, counts = np.unique(bfields, return_counts=True)
+        return int(counts.max()) if len(counts) else 0
+
+    def plan(self, bfields, repeats=1, order=ORDER_FILE, start_current=None):
+        """
+        生成访问顺序
+
+        参数:
+        bfields: 磁场表 (Gs)，可以已经包含多遍往返扫描
+        repeats: 重复次数
+        order: ORDER_FILE / ORDER_SERPENTINE / ORDER_MONOTONIC
+        start_current: 扫描开始前的电源电流 (A)，往返扫描从离它较近的一端开始
+
+        返回: 按访问顺序排列的磁场数组；每个磁场值的访问次数为它在原表中的出现次数 × repeats，
+              往返/单向扫描的第 k 遍只包含访问次数多于 k 的磁场值
+        """
+        bfields = np.asarray(bfields, dtype=float).ravel()
+        repeats = max(int(repeats), 1)
+        if order == ORDER_FILE or len(bfields) == 0:
+            return np.tile(bfields, repeats)
+
+        points, counts = np.unique(bfields, return_counts=True)
+        visits = counts * repeats
+        sweeps = [points[visits > k] for k in range(int(visits.max()))]
+        if order == ORDER_SERPENTINE:
+            first = 0
+            if start_current is not None:
+                currents = points[[0, -1]] * AMPS_PER_GAUSS
+                first = int(abs(currents[1] - start_current) < abs(currents[0] - start_current))
+            return np.concatenate([sweep if (k + first) % 2 == 0 else sweep[::-1] for k, sweep in enumerate(sweeps)])
+        if order == ORDER_MONOTONIC:
+            return np.concatenate(sweeps)
+        raise ValueError(f"不支持的扫描顺序: {order}")
+
+    def step_times(self, bfields, start_current=None):
+        """每一点的预测耗时 (s)；与前一点磁场相同时不需要等待稳定"""
+        currents = np.asarray(bfields, dtype=float) * AMPS_PER_GAUSS
+        previous = np.concatenate(([currents[0] if start_current is None else start_current], currents[:-1]))
+        steps = np.abs(currents - previous)
+        settle = np.where(steps > 0, self.settle_base + self.settle_per_amp * steps, 0.0)
+        if start_current is None and len(settle):
+            settle[0] = self.settle_base
+        return settle + self.point_time
+
+    def predict(self, bfields, start_current=None):
+        """返回 (预测总耗时 s, 总电流变化 A)"""
+        bfields = np.asarray(bfields, dtype=float)
+        if len(bfields) == 0:
+            return 0.0, 0.0
+        currents = bfields * AMPS_PER_GAUSS
+        slew = float(np.abs(np.diff(currents)).sum())
+        if start_current is not None:
+            slew += abs(currents[0] - start_current)
+        return float(self.step_times(bfields, start_current).sum()), slew
+
+    def calibrate(self, settle_history=None, point_times=None):
+        """
+        用实测数据校准模型
+
+        参数:
+        settle_history: SettleController.history，元素为 (目标值, 步长, 耗时, 是否稳定, 读数)
+        point_times: 每点采集耗时列表 (s)
+        """
+        if settle_history:
+            steps = np.abs(np.array([item[1] for item in settle_history], dtype=float))
+            durations = np.array([item[2] for item in settle_history], dtype=float)
+            if len(steps) >= 2 and np.ptp(steps) > 0:
+                slope, intercept = np.polyfit(steps, durations, 1)
+                self.settle_per_amp = max(float(slope), 0.0)
+                self.settle_base = max(float(intercept), 0.0)
+            else:
+                self.settle_base = float(np.median(durations))
+        if point_times:
+            self.point_time = float(np.median(point_times))
+
+
+class RoiScan:
+    """
+    ROI 自适应扫描
+
+    先按磁场表隔点粗扫一遍定位各峰，再把剩余的点数预算集中在峰附近的加密点上；
+    分析用的峰窗口也由粗扫得到的峰位给出，不再使用固定范围。
+    """
+
+    def __init__(self, n_peaks, coarse_every=3, half_width=5.0, spacing=0.5):
+        """
+        参数:
+        n_peaks: 峰的个数，质子为 2，氘核为 3
+        coarse_every: 粗扫时每隔几个磁场点取一个
+        half_width: 峰附近加密区域的半宽 (Gs)，不超过相邻峰间距的一半
+        spacing: 加密点间距 (Gs)
+        """
+        self.n_peaks = n_peaks
+        self.coarse_every = coarse_every
+        self.half_width = half_width
+        self.spacing = spacing
+
+    def coarse(self, bfields):
+        """粗扫点：磁场表去重排序后隔点抽取，保留两端"""
+        points = np.unique(np.asarray(bfields, dtype=float))
+        coarse = points[::self.coarse_every]
+        if coarse[-1] != points[-1]:
+            coarse = np.append(coarse, points[-1])
+        return coarse
+
+    def locate(self, trace):
+        """
+        由粗扫结果定位各峰
+
+        参数:
+        trace: 按磁场升序的 (磁场, 测量值, ...) 数组
+
+        返回: 升序的峰位磁场 (Gs)，用三点抛物线插值细化
+        """
+        fields, values = trace[:, 0], trace[:, 1]
+        n = len(values)
+        # 局部极大值（含两端），按高度取前 n_peaks 个
+        left = np.concatenate(([-np.inf], values[:-1]))
+        right = np.concatenate((values[1:], [-np.inf]))
+        candidates = np.flatnonzero((values >= left) & (values >= right))
+        if len(candidates) < self.n_peaks:
+            candidates = np.arange(n)
+        top = np.sort(candidates[np.argsort(values[candidates])[::-1][:self.n_peaks]])
+
+        peaks = []
+        for i in top:
+            if 0 < i < n - 1:
+                x, y = fields[i - 1:i + 2], values[i - 1:i + 2]
+                a, b, _ = np.polyfit(x, y, 2)
+                vertex = -b / (2 * a) if a < 0 else fields[i]
+                peaks.append(float(np.clip(vertex, x[0], x[-1])))
+            else:
+                peaks.append(float(fields[i]))
+        return np.array(peaks)
+
+    def _half_width(self, peaks):
+        if len(peaks) > 1:
+            return min(self.half_width, float(np.min(np.diff(peaks))) / 2)
+        return self.half_width
+
+    def windows(self, peaks):
+        """各峰的分析窗口 [lo, hi)：相邻峰以中点为界，两端各向外延伸半个峰间距"""
+        peaks = np.asarray(peaks, dtype=float)
+        if len(peaks) > 1:
+            gaps = np.diff(peaks)
+            edges = np.concatenate(([peaks[0] - gaps[0] / 2], peaks[:-1] + gaps / 2, [peaks[-1] + gaps[-1] / 2]))
+        else:
+            edges = np.array([peaks[0] - self.half_width, peaks[0] + self.half_width])
+        return [(float(lo), float(hi)) for lo, hi in zip(edges[:-1], edges[1:])]
+
+    def split(self, peaks):
+        """质子两峰之间的分界磁场"""
+        return float(np.mean(peaks[:2]))
+
+    def dense(self, peaks, budget, start_current=None):
+        """
+        峰附近的加密扫描顺序
+
+        参数:
+        peaks: 峰位 (Gs)
+        budget: 可用的点数预算
+        start_current: 加密扫描开始前的电流 (A)，往返扫描从离它较近的一端开始
+
+        返回: 往返扫描的磁场数组，遍数 = 预算 // 加密点数（至少 1 遍）
+        """
+        half = self._half_width(peaks)
+        offsets = np.arange(-half, half + self.spacing / 2, self.spacing)
+        points = np.unique(np.round(np.concatenate([p + offsets for p in peaks]), 2))
+        sweeps = max(int(budget) // len(points), 1)
+        return ScanPlanner().plan(np.tile(points, sweeps), order=ORDER_SERPENTINE, start_current=start_current)
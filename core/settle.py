@@ -0,0 +1,130 @@
+import time
+
+
+class SettleController:
+    """
+    电源设定后的自适应稳定检测
+
+    设定电流后轮询回读值（默认 MEAS:CURR?），连续 stable_count 次读数彼此之差不超过
+    tolerance（回读不再变化）且都落在期望回读值附近即认为已稳定。回读相对设定值的偏差
+    （零点偏移、增益误差）不要求为零：期望回读值 = 目标值 + 上一个稳定点学到的偏差，
+    允许范围为 2 * tolerance + gain_tolerance * |步长|（容纳读数噪声和偏差估计本身的误差）；尚未学到偏差时允许范围为 max_offset。
+    超时时间按步长缩放：timeout = base_timeout + timeout_per_amp * |步长|。
+    连续 max_timeouts 次超时后认为回读不可用于判稳，改为固定等待 fallback_delay。
+    """
+
+    def __init__(self, read_value, tolerance=0.005, stable_count=3, poll_interval=0.02,
+                 base_timeout=1.0, timeout_per_amp=2.0, max_timeout=5.0, min_time=0.0,
+                 offset=None, max_offset=0.1, gain_tolerance=0.01, max_timeouts=3, fallback_delay=1.0):
+        """
+        参数:
+        read_value: 无参回读函数，如 ptnhp.measure_current；返回非数字时视为无效读数
+        tolerance: 连续读数之间允许的变化 (A)
+        stable_count: 判定稳定所需的连续有效读数个数
+        poll_interval: 轮询间隔 (s)
+        base_timeout: 超时时间的固定部分 (s)
+        timeout_per_amp: 每安培步长增加的超时时间 (s/A)
+        max_timeout: 超时时间上限 (s)
+        min_time: 最短等待时间 (s)，用于回读稳定但磁场仍有滞后的情况
+        offset: 已知的回读偏差 (A)，None 表示由第一个稳定点学习
+        max_offset: 尚未学到偏差时，回读与目标值之间允许的最大偏差 (A)
+        gain_tolerance: 相邻两点偏差随步长的允许变化（相对值），用于容纳回读增益误差
+        max_timeouts: 连续超时达到该次数后改为固定等待
+        fallback_delay: 固定等待时间 (s)
+        """
+        self.read_value = read_value
+        self.tolerance = tolerance
+        self.stable_count = stable_count
+        self.poll_interval = poll_interval
+        self.base_timeout = base_timeout
+        self.timeout_per_amp = timeout_per_amp
+        self.max_timeout = max_timeout
+        self.min_time = min_time
+        self.offset = offset
+        self.max_offset = max_offset
+        self.gain_tolerance = gain_tolerance
+        self.max_timeouts = max_timeouts
+        self.fallback_delay = fallback_delay
+        self.fallback = False      # 是否已改为固定等待
+        self._timeouts = 0         # 连续超时次数
+        self.target = None
+        self.step = 0.0
+        self._start = None
+        # 每次稳定等待的记录: (目标值, 步长, 耗时, 是否稳定, 最后读数)；固定等待时是否稳定为 None
+        self.history = []
+
+    def timeout_for(self, step):
+        """按步长计算超时时间"""
+        return min(self.base_timeout + self.timeout_per_amp * abs(step), self.max_timeout)
+
+    def begin(self, target, previous=None):
+        """在下发设定值后立即调用，记录起始时间和步长"""
+        self._start = time.perf_counter()
+        self.step = 0.0 if previous is None else target - previous
+        self.target = target
+
+    def wait(self, should_stop=None):
+        """
+        阻塞直到回读稳定、超时或 should_stop() 返回 True；已改为固定等待时只等待 fallback_delay
+
+        返回: (耗时 s, 是否稳定, 最后读数)，固定等待时是否稳定为 None
+        """
+        if self.fallback:
+            return self._wait_fixed(should_stop)
+        timeout = self.timeout_for(self.step)
+        if self.offset is None:
+            expected, window = self.target, self.max_offset
+        else:
+            expected = self.target + self.offset
+            window = 2 * self.tolerance + self.gain_tolerance * abs(self.step)
+        stable = []
+        reading = None
+        settled = False
+        while True:
+            value = self.read_value()
+            elapsed = time.perf_counter() - self._start
+            if isinstance(value, (int, float)):
+                reading = float(value)
+                if abs(reading - expected) <= window:
+                    stable.append(reading)
+                    stable = stable[-self.stable_count:]
+                else:
+                    stable = []
+            if (len(stable) >= self.stable_count and max(stable) - min(stable) <= self.tolerance
+                    and elapsed >= self.min_time):
+                settled = True
+                break
+            if elapsed >= timeout or (should_stop is not None and should_stop()):
+                break
+            time.sleep(self.poll_interval)
+
+        duration = time.perf_counter() - self._start
+        if settled:
+            self.offset = sum(stable) / len(stable) - self.target
+            self._timeouts = 0
+        elif not (should_stop is not None and should_stop()):
+            self._timeouts += 1
+            self.fallback = self._timeouts >= self.max_timeouts
+        self.history.append((self.target, self.step, duration, settled, reading))
+        return duration, settled, reading
+
+    def _wait_fixed(self, should_stop=None):
+        """固定等待 fallback_delay（从下发设定值时算起），期间响应 should_stop"""
+        while time.perf_counter() - self._start < self.fallback_delay:
+            if should_stop is not None and should_stop():
+                break
+            time.sleep(self.poll_interval)
+        duration = time.perf_counter() - self._start
+        self.history.append((self.target, self.step, duration, None, None))
+        return duration, None, None
+
+    def settle(self, target, previous=None, should_stop=None):
+        """begin + wait 的简写，用于设定值已下发的场合"""
+        self.begin(target, previous)
+        return self.wait(should_stop)
+
+    def summary(self):
+        """返回 (次数, 总耗时, 超时次数)；固定等待不计为超时"""
+        total = sum(item[2] for item in self.history)
+        timeouts = sum(1 for item in self.history if item[3] is False)
+        return len(self.history), total, timeouts
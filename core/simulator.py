@@ -0,0 +1,452 @@
+import math
+import socketserver
+import sys
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+
+# 磁场与电流换算：与 DataAcquisitionThread 中 Currents = B * 2 / 103.6 保持一致
+GAUSS_PER_AMP = 103.6 / 2
+# 模拟 B 场探头灵敏度 (Gs/V)
+BFIELD_PROBE_GAUSS_PER_VOLT = 100.0
+
+# Lyman-alpha 共振峰位置 (Gs)
+PEAK_POSITIONS = {
+    'H': (540.0, 600.0),
+    'D': (565.0, 575.0, 585.0),
+}
+PEAK_WIDTHS = {'H': 4.0, 'D': 2.0}
+
+
+def _normalize_header(header):
+    """把 SCPI 命令头规范为短格式，如 FORMat:DATA -> FORM:DATA, CHANnel2 -> CHAN2"""
+    nodes = []
+    for node in header.strip().lstrip(':').split(':'):
+        digits = ''
+        while node and node[-1].isdigit():
+            digits = node[-1] + digits
+            node = node[:-1]
+        query = node.endswith('?')
+        node = node.rstrip('?')
+        if node.startswith('*'):
+            short = node.upper()
+        elif node.isupper():
+            short = node[:4]
+        else:
+            short = ''.join(c for c in node if c.isupper()) or node.upper()[:4]
+        nodes.append(short + digits + ('?' if query else ''))
+    return ':'.join(nodes)
+
+
+class SimulatedSupply:
+    """模拟 PTNhp 电源输出：电流按斜率限制并带一阶滞后跟随设定值"""
+
+    def __init__(self, slew_rate=5.0, tau=0.15, resistance=3.0, noise=0.002, seed=None):
+        self.slew_rate = slew_rate      # A/s
+        self.tau = tau                  # s
+        self.resistance = resistance    # Ω
+        self.noise = noise              # A
+        self.voltage_set = 0.0
+        self.current_set = 0.0
+        self.output = False
+        self._ramp = 0.0
+        self._current = 0.0
+        self._t = time.monotonic()
+        self._lock = threading.Lock()
+        self._rng = np.random.default_rng(seed)
+
+    def _advance(self):
+        now = time.monotonic()
+        dt_total = now - self._t
+        self._t = now
+        target = self.current_set if self.output else 0.0
+        if self.resistance > 0:
+            target = min(target, self.voltage_set / self.resistance)
+        # 以不超过 10 ms 的子步长积分，保证长时间未查询时仍然准确
+        steps = max(1, int(math.ceil(dt_total / 0.01)))
+        dt = dt_total / steps
+        for _ in range(steps):
+            delta = target - self._ramp
+            max_step = self.slew_rate * dt
+            self._ramp += max(-max_step, min(max_step, delta))
+            if self.tau > 0:
+                self._current += (self._ramp - self._current) * (1 - math.exp(-dt / self.tau))
+            else:
+                self._current = self._ramp
+
+    def set_current(self, value):
+        with self._lock:
+            self._advance()
+            self.current_set = float(value)
+
+    def set_voltage(self, value):
+        with self._lock:
+            self._advance()
+            self.voltage_set = float(value)
+
+    def set_output(self, on):
+        with self._lock:
+            self._advance()
+            self.output = bool(on)
+
+    def actual_current(self):
+        """无噪声的实际输出电流"""
+        with self._lock:
+            self._advance()
+            return self._current
+
+    def measure_current(self):
+        return self.actual_current() + self._rng.normal(0.0, self.noise)
+
+    def measure_voltage(self):
+        return self.actual_current() * self.resistance
+
+    def bfield(self):
+        """当前磁场 (Gs)"""
+        return self.actual_current() * GAUSS_PER_AMP
+
+
+class _PTNhpHandler(socketserver.StreamRequestHandler):
+    """按行解析 PTNhp 文本协议"""
+    # 与设备一样逐条立即发送应答，流水线查询时不被 Nagle 算法合并延迟
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        server = self.server
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            for command in line.decode(errors='replace').strip().split(';'):
+                command = command.strip()
+                if not command:
+                    continue
+                server.stats[command.split()[0].upper()] += 1
+                if server.latency > 0:
+                    time.sleep(server.latency)
+                reply = server.handle_command(command)
+                if reply is not None:
+                    self.wfile.write((reply + server.terminator).encode())
+                    self.wfile.flush()
+
+
+class SimulatedPTNhpServer(socketserver.ThreadingTCPServer):
+    """本地 TCP 服务器，模拟 192.168.1.123:7 上的 PTNhp 电源"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, supply=None, host='127.0.0.1', port=0, latency=0.002, terminator='\n'):
+        super().__init__((host, port), _PTNhpHandler)
+        self.supply = supply or SimulatedSupply()
+        self.latency = latency
+        self.terminator = terminator
+        self.stats = Counter()
+        self._thread = None
+
+    @property
+    def address(self):
+        return self.server_address[0], self.server_address[1]
+
+    def start(self):
+        """在后台线程中开始服务"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_command(self, command):
+        """处理单条命令，查询返回应答字符串，设置命令返回 None"""
+        parts = command.split(None, 1)
+        header = parts[0].upper()
+        arg = parts[1].strip() if len(parts) > 1 else ''
+        supply = self.supply
+
+        if header == '*IDN?':
+            return 'PTN-HP,SIMULATOR,0,1.0'
+        if header == '*OPC?':
+            return '1'
+        if header == '*RST':
+            supply.set_output(False)
+            supply.set_current(0.0)
+            supply.set_voltage(0.0)
+            return None
+        if header in ('OUTP', 'OUTPUT'):
+            supply.set_output(arg.upper() in ('ON', '1'))
+            # 实际设备对 OUTP 命令有应答，PTNhpController.start_output 会读取
+            return 'ON' if supply.output else 'OFF'
+        if header in ('OUTP?', 'OUTPUT?'):
+            return '1' if supply.output else '0'
+        if header in ('CURR', 'CURRENT'):
+            try:
+                supply.set_current(float(arg))
+            except ValueError:
+                pass
+            return None
+        if header in ('VOLT', 'VOLTAGE'):
+            try:
+                supply.set_voltage(float(arg))
+            except ValueError:
+                pass
+            return None
+        if header in ('CURR?', 'CURRENT?'):
+            return f"{supply.current_set:.4f}"
+        if header in ('VOLT?', 'VOLTAGE?'):
+            return f"{supply.voltage_set:.4f}"
+        if header in ('MEAS:CURR?', 'MEASURE:CURRENT?'):
+            return f"{supply.measure_current():.4f}A"
+        if header in ('MEAS:VOLT?', 'MEASURE:VOLTAGE?'):
+            return f"{supply.measure_voltage():.3f}V"
+        if header.endswith('?'):
+            return 'ERR'
+        return None
+
+
+class SimulatedScope:
+    """进程内 R&S 示波器模拟，实现本项目用到的 RsInstrument 接口子集"""
+
+    def __init__(self, ip_address='sim', supply=None, particle_type='D', beam_mode='polarized',
+                 polarization=0.6, record_length=20000, trigger_interval=0.1,
+                 command_latency=0.001, transfer_rate=20e6, latency_scale=1.0, seed=None):
+        self.ip_address = ip_address
+        self.supply = supply
+        self.particle_type = particle_type
+        self.beam_mode = beam_mode              # background / unpolarized / polarized
+        self.polarization = polarization
+        self.record_length = record_length
+        self.trigger_interval = trigger_interval  # 束流脉冲重复周期 (s)
+        self.command_latency = command_latency
+        self.transfer_rate = transfer_rate        # 字节/秒
+        self.latency_scale = latency_scale
+        self.bin_float_numbers_format = 'Single_4bytes'
+        self.data_chunk_size = 1E6
+        self.stats = Counter()
+        self.bytes_transferred = 0
+        self._rng = np.random.default_rng(seed)
+        self._rf_on = False
+        self._last_trigger = 0.0
+        self._captured = {}
+        self._closed = False
+        self._reset_settings()
+
+    def _reset_settings(self):
+        self.settings = {'FORM:DATA': 'ASC', 'FORM:BORD': 'LSBF', 'TIM:SCAL': '1e-4',
+                         'ACQ:POIN': str(self.record_length), 'ACQ:HRES': 'AUTO'}
+        self.settings.update({f'CHAN{ch}:DATA:POIN': 'DEF' for ch in range(1, 5)})
+
+    def _sleep(self, seconds):
+        if seconds > 0 and self.latency_scale > 0:
+            time.sleep(seconds * self.latency_scale)
+
+    # ---- 波形模型 ----
+    def _time_axis(self):
+        n = int(float(self.settings.get('ACQ:POIN', self.record_length)))
+        t_total = 12 * float(self.settings.get('TIM:SCAL', 1e-4))
+        return np.arange(n) * t_total / n, t_total
+
+    @staticmethod
+    def _pulse(t, t_total):
+        """束流脉冲包络：窗口 25%~70% 之间的梯形"""
+        start, stop, edge = 0.25 * t_total, 0.70 * t_total, 0.03 * t_total
+        rise = np.clip((t - start) / edge, 0, 1)
+        fall = np.clip((stop - t) / edge, 0, 1)
+        return np.minimum(rise, fall)
+
+    def _photon_amplitude(self, bfield):
+        peaks = PEAK_POSITIONS.get(self.particle_type, PEAK_POSITIONS['D'])
+        width = PEAK_WIDTHS.get(self.particle_type, 2.0)
+        p = self.polarization if self.beam_mode == 'polarized' else 0.0
+        if len(peaks) == 2:
+            heights = ((1 + p) / 2, (1 - p) / 2)
+        else:
+            # 纯矢量极化：n+ - n- = Pz，n0 = 1/3
+            p = min(p, 2 / 3)
+            heights = (1 / 3 + p / 2, 1 / 3, 1 / 3 - p / 2)
+        scale = 0.2 if self.beam_mode == 'background' else 1.0
+        amp = sum(h * math.exp(-(bfield - b) ** 2 / (2 * width ** 2)) for h, b in zip(heights, peaks))
+        return 0.05 + scale * amp
+
+    def _capture(self):
+        """模拟一次单次触发采集，生成所有通道波形"""
+        t, t_total = self._time_axis()
+        n = len(t)
+        pulse = self._pulse(t, t_total)
+        bfield = self.supply.bfield() if self.supply is not None else 0.0
+        self._rf_on = not self._rf_on
+        beam_amp = 0.10 if self._rf_on else 0.08
+        noise = self._rng.normal
+        self._captured = {
+            1: beam_amp * pulse + noise(0, 0.002, n),
+            2: self._photon_amplitude(bfield) * pulse + noise(0, 0.005, n),
+            3: bfield / BFIELD_PROBE_GAUSS_PER_VOLT + noise(0, 0.002, n),
+            4: 0.5 * beam_amp * pulse + noise(0, 0.002, n),
+        }
+
+    def _single(self):
+        # 等待下一个束流脉冲触发，再加上一个采集窗口的时间
+        now = time.monotonic()
+        period = self.trigger_interval * self.latency_scale
+        wait = 0.0
+        if period > 0:
+            wait = period - ((now - self._last_trigger) % period) if self._last_trigger else period
+        _, t_total = self._time_axis()
+        if wait > 0:
+            time.sleep(wait)
+        self._sleep(t_total)
+        self._last_trigger = time.monotonic()
+        self._capture()
+
+    def _encode(self, values):
+        """按当前 FORMat:DATA / FORMat:BORDer 设置编码数据（REAL,32 为 IEEE488.2 定长二进制块）"""
+        if self.settings.get('FORM:DATA', 'ASC').upper().startswith('REAL'):
+            order = '>' if self.settings.get('FORM:BORD', 'LSBF').upper().startswith('MSB') else '<'
+            payload = np.asarray(values, dtype=f'{order}f4').tobytes()
+            length = str(len(payload))
+            return f"#{len(length)}{length}".encode() + payload
+        return ','.join(f"{v:.6e}" for v in values).encode()
+
+    def _decode(self, raw):
+        if raw[:1] == b'#':
+            digits = int(raw[1:2])
+            length = int(raw[2:2 + digits])
+            payload = raw[2 + digits:2 + digits + length]
+            # 与 RsInstrument 一致：Single_4bytes 按本机字节序解析，*_swapped 按相反字节序
+            fmt = getattr(self.bin_float_numbers_format, 'name', str(self.bin_float_numbers_format))
+            native = '<' if sys.byteorder == 'little' else '>'
+            swapped = '>' if native == '<' else '<'
+            order = swapped if fmt.endswith('swapped') else native
+            return np.frombuffer(payload, dtype=f'{order}f4').astype(float).tolist()
+        return [float(v) for v in raw.decode().split(',') if v]
+
+    # ---- RsInstrument 接口 ----
+    def write_str(self, cmd):
+        if self._closed:
+            raise RuntimeError("模拟示波器会话已关闭")
+        self._sleep(self.command_latency)
+        for part in cmd.split(';'):
+            part = part.strip()
+            if not part:
+                continue
+            pieces = part.split(None, 1)
+            header = _normalize_header(pieces[0])
+            self.stats[header] += 1
+            if header == '*RST':
+                self._reset_settings()
+            elif header in ('SING', 'RUNS'):
+                self._single()
+            elif len(pieces) > 1:
+                self.settings[header] = pieces[1].strip()
+
+    def write_str_with_opc(self, cmd, timeout=None):
+        self.write_str(cmd)
+        self.query_opc()
+
+    def write(self, cmd):
+        self.write_str(cmd)
+
+    def query_opc(self, timeout=0):
+        self.stats['*OPC?'] += 1
+        self._sleep(self.command_latency)
+        return 1
+
+    def query_str(self, query):
+        header = _normalize_header(query)
+        self.stats[header] += 1
+        self._sleep(self.command_latency)
+        if header == '*IDN?':
+            return 'Rohde&Schwarz,SIMULATED-SCOPE,000000/000,1.0'
+        if header == '*OPC?':
+            return '1'
+        return self.settings.get(header.rstrip('?'), '0')
+
+    def query(self, query):
+        return self.query_str(query)
+
+    def query_bin_or_ascii_float_list(self, query):
+        header = _normalize_header(query)
+        self.stats[header] += 1
+        if not header.endswith(':DATA?'):
+            return [float(self.query_str(query))]
+        if not self._captured:
+            self._capture()
+        channel = int(header.split(':')[0][len('CHAN'):] or 1)
+        raw = self._encode(self._captured.get(channel, np.zeros(1)))
+        self.bytes_transferred += len(raw)
+        self._sleep(self.command_latency + len(raw) / self.transfer_rate)
+        return self._decode(raw)
+
+    def close(self):
+        self._closed = True
+
+
+class SimulationBackend:
+    """模拟后端：一个共享的模拟电源、一个 PTNhp 模拟服务器，按需创建模拟示波器"""
+
+    def __init__(self, particle_type='D', latency_scale=1.0, supply=None, **scope_kwargs):
+        self.particle_type = particle_type
+        self.latency_scale = latency_scale
+        self.supply = supply or SimulatedSupply()
+        self.scope_kwargs = scope_kwargs
+        self.scopes = []
+        self.ptnhp_server = SimulatedPTNhpServer(self.supply, latency=0.002 * latency_scale).start()
+
+    def open_scope(self, ip_address):
+        scope = SimulatedScope(ip_address, supply=self.supply, particle_type=self.particle_type,
+                               latency_scale=self.latency_scale, **self.scope_kwargs)
+        self.scopes.append(scope)
+        return scope
+
+    def configure(self, particle_type=None, beam_mode=None):
+        """切换模拟的粒子类型和束流状态，之后打开的示波器和已打开的示波器都使用新设置"""
+        if particle_type is not None:
+            self.particle_type = particle_type
+        if beam_mode is not None:
+            self.scope_kwargs['beam_mode'] = beam_mode
+        for scope in self.scopes:
+            scope.particle_type = self.particle_type
+            scope.beam_mode = self.scope_kwargs.get('beam_mode', scope.beam_mode)
+
+    @property
+    def ptnhp_address(self):
+        return self.ptnhp_server.address
+
+    def shutdown(self):
+        self.ptnhp_server.stop()
+
+
+_backend = None
+
+
+def enable(particle_type='D', latency_scale=1.0, **scope_kwargs):
+    """启用模拟后端，之后 open_scope / ptnhp_address 均指向模拟设备"""
+    global _backend
+    if _backend is None:
+        _backend = SimulationBackend(particle_type, latency_scale, **scope_kwargs)
+    return _backend
+
+
+def configure(particle_type=None, beam_mode=None):
+    """模拟后端已启用时切换粒子类型和束流状态（background / unpolarized / polarized），否则不做任何事"""
+    if _backend is not None:
+        _backend.configure(particle_type, beam_mode)
+
+
+def disable():
+    """关闭模拟后端，恢复真实仪器地址"""
+    global _backend
+    if _backend is not None:
+        _backend.shutdown()
+        _backend = None
+
+
+def is_enabled():
+    return _backend is not None
+
+
+def get_backend():
+    return _backend
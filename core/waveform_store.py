@@ -0,0 +1,150 @@
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+
+
+# 未指定深度时内存缓冲区的默认上限 (字节)
+DEFAULT_MEMORY_BUDGET = 256 * 2 ** 20
+
+
+class WaveformStore:
+    """
+    波形环形缓冲区
+
+    最近 depth 次的 (off, on, beam) 波形以 float32 保存在预分配数组中，
+    时间轴是等间隔的，每次只记录 (t0, dt)，读取时再生成；
+    更早的波形自动溢出到磁盘临时目录，按索引访问时透明读取。
+    """
+
+    def __init__(self, depth=None, spill_dir=None, memory_budget=DEFAULT_MEMORY_BUDGET):
+        """
+        参数:
+        depth: 内存中保留的波形次数，None 时按 memory_budget 和记录长度计算
+        spill_dir: 溢出目录，None 时在首次溢出时创建临时目录
+        memory_budget: 未指定 depth 时内存缓冲区的上限 (字节)
+        """
+        if depth is not None and depth < 1:
+            raise ValueError("缓冲区深度必须为正整数")
+        self._depth = depth
+        self.memory_budget = memory_budget
+        self.depth = depth or 1       # 实际分配的深度，首次追加时确定
+        self._spill_dir = spill_dir
+        self._finalizer = None
+        self._buffer = None          # shape: (depth, 3, n)，float32
+        self._length = None
+        self._runs = []              # 每个全局索引对应的运行序号
+        self._sources = []           # 每个全局索引对应的数据来源（示波器/通道）
+        self._axes = []              # 每个全局索引对应的时间轴 (t0, dt)
+        self._ring_start = 0         # 仍在内存中的第一个全局索引
+
+    def __len__(self):
+        return len(self._runs)
+
+    def _ensure_spill_dir(self):
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix="spis_waveforms_")
+            self._finalizer = weakref.finalize(self, shutil.rmtree, self._spill_dir, True)
+        else:
+            os.makedirs(self._spill_dir, exist_ok=True)
+        return self._spill_dir
+
+    def _spill_path(self, index):
+        return os.path.join(self._ensure_spill_dir(), f"shot_{index:08d}.npy")
+
+    def _spill(self, index):
+        """把内存中第 index 次波形写入磁盘"""
+        np.save(self._spill_path(index), self._buffer[index % self.depth])
+
+    def _spill_all(self):
+        for index in range(self._ring_start, len(self._runs)):
+            self._spill(index)
+        self._ring_start = len(self._runs)
+
+    def _allocate(self, n):
+        """按记录长度分配缓冲区；未指定深度时取内存上限能容纳的次数"""
+        if self._depth is None:
+            self.depth = max(1, int(self.memory_budget // (3 * n * np.dtype(np.float32).itemsize)))
+        else:
+            self.depth = self._depth
+        self._buffer = np.empty((self.depth, 3, n), dtype=np.float32)
+        self._length = n
+
+    def append(self, run, time_data, off_data, on_data, beam_data, source=None):
+        """追加一次运行的波形，缓冲区满时最旧的一次溢出到磁盘"""
+        n = len(time_data)
+        if self._buffer is None or n != self._length:
+            # 记录长度变化（如修改了 time_scal）时先溢出内存中的数据，再重新分配
+            if self._buffer is not None:
+                self._spill_all()
+            self._allocate(n)
+
+        index = len(self._runs)
+        if index - self._ring_start >= self.depth:
+            self._spill(self._ring_start)
+            self._ring_start += 1
+
+        slot = self._buffer[index % self.depth]
+        slot[0] = off_data
+        slot[1] = on_data
+        slot[2] = beam_data
+        self._runs.append(run)
+        self._sources.append(source)
+        self._axes.append((float(time_data[0]), float(time_data[1] - time_data[0]) if n > 1 else 0.0))
+
+    def __getitem__(self, index):
+        """返回 (run, time, off, on, beam)，溢出的波形从磁盘读取"""
+        if index < 0:
+            index += len(self._runs)
+        if not 0 <= index < len(self._runs):
+            raise IndexError("波形索引超出范围")
+        if index >= self._ring_start:
+            # 返回副本，避免环形缓冲区覆盖后影响调用方（如已绘制的曲线）
+            waveforms = self._buffer[index % self.depth].copy()
+        else:
+            waveforms = np.load(self._spill_path(index))
+        t0, dt = self._axes[index]
+        time_data = t0 + np.arange(waveforms.shape[1]) * dt
+        return (self._runs[index], time_data, waveforms[0], waveforms[1], waveforms[2])
+
+    def source_of(self, index):
+        """返回第 index 次波形的数据来源"""
+        return self._sources[index]
+
+    def resize(self, depth):
+        """修改内存深度（None 表示按内存上限计算），现有内存数据先溢出到磁盘"""
+        if depth == self._depth:
+            return
+        if depth is not None and depth < 1:
+            raise ValueError("缓冲区深度必须为正整数")
+        if self._buffer is not None:
+            self._spill_all()
+        self._depth = depth
+        self.depth = depth or 1
+        self._buffer = None
+        self._length = None
+
+    def clear(self):
+        """清空所有波形并删除溢出文件"""
+        if self._spill_dir is not None and os.path.isdir(self._spill_dir):
+            for index in range(self._ring_start):
+                path = os.path.join(self._spill_dir, f"shot_{index:08d}.npy")
+                if os.path.exists(path):
+                    os.remove(path)
+        self._buffer = None
+        self._length = None
+        self._runs = []
+        self._sources = []
+        self._axes = []
+        self._ring_start = 0
+
+    def close(self):
+        """清空数据并删除自动创建的临时目录"""
+        self.clear()
+        if self._finalizer is not None:
+            self._finalizer()
+            self._finalizer = None
+            self._spill_dir = None
+    
\ No newline at end of file
@@ -17,6 +17,11 @@ def main():
                   }
     plt.rcParams.update(params)
     plt.grid = True
+
+    # --sim：不连接真实示波器和电源，使用本地模拟后端；粒子类型和束流状态由每次测量设置
+    if "--sim" in sys.argv:
+        from core import simulator
+        simulator.enable()
     
     # 创建应用实例
     app = QApplication(sys.argv)
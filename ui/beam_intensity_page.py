@@ -1,11 +1,13 @@
 from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QLabel, 
                             QLineEdit, QPushButton, QFileDialog, QMessageBox,
-                            QComboBox, QTableWidgetItem)
-from PyQt5.QtCore import Qt
+                            QTableWidgetItem, QCheckBox, QTextBrowser)
+from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
 from .widgets.plot_canvas import BeamHistoryPlot, BeamResultPlot
 from .widgets.copyable_table import CopyableTable
-from core.acquisition_threads import AcquisitionThread
-from core.data_processor import DataProcessor
+from core.acquisition_threads import MultiScopeAcquisition
+from core.running_stats import RunningStatistics
+from core.waveform_store import WaveformStore
+from core.run_archive import RunArchive
 from datetime import datetime
 import matplotlib.pyplot as plt
 import numpy as np
@@ -18,13 +20,23 @@ class BeamIntensityPage(QWidget):
         super().__init__()
         self.time_scal = 1e-4
         self.gain = 100
+        self.target_rate = 0.0
         # 新增：默认IP和通道
         self.selected_ip = "192.168.1.100"
+        self.selected_ips = [self.selected_ip]
         self.selected_channel = 1
+        self.selected_channels = [1]
         self.thread = None
         self.run_count = 0
-        self.results = []
+        self._last_run_number = None
+        # 最近 result_depth 次波形保存在内存中，更早的自动写入磁盘；None 时按内存上限计算
+        self.result_depth = None
+        self.results = WaveformStore(depth=self.result_depth)
         self.current_result_idx = -1
+        # 增量统计：每个通道一组，每次运行更新一次，标签直接读取
+        self.source_stats = {}
+        # 归档文件：打开后每次运行的波形和结果连续写入
+        self.archive = None
         self.init_ui()
     
     def init_ui(self):
@@ -39,8 +51,8 @@ class BeamIntensityPage(QWidget):
         self.sigma_label = QLabel("标准差: 0")
         
         # 统计表格
-        headers = ["运行次数", "束流流强 (mA)", "半高全宽 (μs)", "粒子数 (ppp)",]
-        self.stat_table = CopyableTable(headers=headers)
+        headers = ["运行次数", "示波器/通道", "束流流强 (mA)", "半高全宽 (μs)", "粒子数 (ppp)",]
+        self.stat_table = CopyableTable(cols=len(headers), headers=headers)
         
         left_layout.addWidget(self.history_plot)
         left_layout.addWidget(self.avg_label)
@@ -58,16 +70,27 @@ class BeamIntensityPage(QWidget):
         self.run_input = QLineEdit("1")
         self.time_scal_input = QLineEdit(str(self.time_scal))
         self.gain_input = QLineEdit(str(self.gain))
+        self.depth_input = QLineEdit("")
+        self.depth_input.setPlaceholderText("自动（按内存上限）")
+        self.rate_input = QLineEdit(str(self.target_rate))
         
-        # 新增：IP选择下拉框
-        self.ip_combo = QComboBox()
-        self.ip_combo.addItems(["192.168.1.99", "192.168.1.100"])
-        self.ip_combo.setCurrentText(self.selected_ip)
+        # 示波器选择：可同时勾选多台示波器并行采集
+        self.ip_checks = {}
+        ip_layout = QHBoxLayout()
+        for ip in ["192.168.1.99", "192.168.1.100"]:
+            check = QCheckBox(ip)
+            check.setChecked(ip in self.selected_ips)
+            self.ip_checks[ip] = check
+            ip_layout.addWidget(check)
         
-        # 新增：通道选择下拉框
-        self.channel_combo = QComboBox()
-        self.channel_combo.addItems(["1", "2", "3", "4"])
-        self.channel_combo.setCurrentText(str(self.selected_channel))
+        # 通道选择：可同时勾选多个通道，一次触发依次读取
+        self.channel_checks = {}
+        channel_layout = QHBoxLayout()
+        for channel in range(1, 5):
+            check = QCheckBox(f"CH{channel}")
+            check.setChecked(channel in self.selected_channels)
+            self.channel_checks[channel] = check
+            channel_layout.addWidget(check)
         
         btn_start = QPushButton("开始")
         btn_stop = QPushButton("停止")
@@ -79,18 +102,26 @@ class BeamIntensityPage(QWidget):
         
         # 更新控制面板布局，添加IP和通道选择
         ctrl_layout.addWidget(QLabel("示波器IP地址:"))
-        ctrl_layout.addWidget(self.ip_combo)
+        ctrl_layout.addLayout(ip_layout)
         ctrl_layout.addWidget(QLabel("示波器通道:"))
-        ctrl_layout.addWidget(self.channel_combo)
+        ctrl_layout.addLayout(channel_layout)
         ctrl_layout.addWidget(QLabel("运行次数 (0=无限):"))
         ctrl_layout.addWidget(self.run_input)
         ctrl_layout.addWidget(QLabel("Time Scale:"))
         ctrl_layout.addWidget(self.time_scal_input)
         ctrl_layout.addWidget(QLabel("Gain:"))
         ctrl_layout.addWidget(self.gain_input)
+        ctrl_layout.addWidget(QLabel("目标速率 (次/s, 0=不限):"))
+        ctrl_layout.addWidget(self.rate_input)
+        ctrl_layout.addWidget(QLabel("内存保留波形数:"))
+        ctrl_layout.addWidget(self.depth_input)
         ctrl_layout.addWidget(btn_start)
         ctrl_layout.addWidget(btn_stop)
         ctrl_layout.addWidget(btn_clear)
+        # 采集和分析线程的错误信息
+        self.log_browser = QTextBrowser()
+        self.log_browser.setMaximumHeight(80)
+        ctrl_layout.addWidget(self.log_browser)
         
         ctrl_widget.setLayout(ctrl_layout)
         
@@ -100,24 +131,30 @@ class BeamIntensityPage(QWidget):
         
         self.result_label = QLabel("运行: -")
         self.result_plot = BeamResultPlot()
+        # 工具栏用于缩放/平移，缩放后曲线按可见范围重新抽取
+        self.result_toolbar = NavigationToolbar(self.result_plot, self)
         
         btn_prev = QPushButton("上一个")
         btn_next = QPushButton("下一个")
         btn_save = QPushButton("保存图片")
         btn_savedata = QPushButton("保存数据")
+        self.btn_archive = QPushButton("开始归档")
         
         btn_prev.clicked.connect(self.show_prev_result)
         btn_next.clicked.connect(self.show_next_result)
         btn_save.clicked.connect(self.save_result_image)
         btn_savedata.clicked.connect(self.save_result_data)
+        self.btn_archive.clicked.connect(self.toggle_archive)
         
         btn_layout = QHBoxLayout()
         btn_layout.addWidget(btn_prev)
         btn_layout.addWidget(btn_next)
         btn_layout.addWidget(btn_save)
         btn_layout.addWidget(btn_savedata)
+        btn_layout.addWidget(self.btn_archive)
 
         result_layout.addWidget(self.result_label)
+        result_layout.addWidget(self.result_toolbar)
         result_layout.addWidget(self.result_plot)
         result_layout.addLayout(btn_layout)
         
@@ -156,68 +193,135 @@ class BeamIntensityPage(QWidget):
         except ValueError:
             self.gain = 100
             self.gain_input.setText(str(self.gain))
+
+        try:
+            self.target_rate = max(0.0, float(self.rate_input.text()))
+        except ValueError:
+            self.target_rate = 0.0
+            self.rate_input.setText(str(self.target_rate))
+
+        try:
+            self.result_depth = max(1, int(self.depth_input.text()))
+        except ValueError:
+            self.result_depth = None
+            self.depth_input.setText("")
+        self.results.resize(self.result_depth)
         
         # 新增：获取选中的IP和通道
-        self.selected_ip = self.ip_combo.currentText()
-        self.selected_channel = int(self.channel_combo.currentText())
+        self.selected_ips = [ip for ip, check in self.ip_checks.items() if check.isChecked()]
+        if not self.selected_ips:
+            QMessageBox.warning(self, "提示", "请至少选择一台示波器")
+            return
+        self.selected_ip = self.selected_ips[0]
+        self.selected_channels = [ch for ch, check in self.channel_checks.items() if check.isChecked()]
+        if not self.selected_channels:
+            QMessageBox.warning(self, "提示", "请至少选择一个示波器通道")
+            return
+        self.selected_channel = self.selected_channels[0]
+        self._last_run_number = None
         
-        # 创建并启动线程（需要确保线程能接收IP和通道参数）
-        self.thread = AcquisitionThread(
+        # 每台示波器一个采集线程，结果按时间戳合并
+        self.thread = MultiScopeAcquisition(
+            self.selected_ips,
             self.time_scal, 
             self.gain, 
             count,
-            ip_address=self.selected_ip,  # 传递IP
-            channel=self.selected_channel  # 传递通道
+            channels=self.selected_channels,
+            target_rate=self.target_rate
         )
+        if self.archive is not None:
+            self.archive.set_metadata(**self._run_metadata())
         self.thread.data_acquired.connect(self.update_ui)
+        self.thread.error_occurred.connect(self.log_error)
         self.thread.finished.connect(self.acquisition_finished)
         self.thread.start()
     
-    # 以下方法保持不变，但需要确保AcquisitionThread类也做相应修改
     def stop_acquisition(self):
         """停止数据采集"""
         if self.thread and self.thread.isRunning():
             self.thread.stop()
     
+    def log_error(self, message):
+        """在输出区记录采集或分析错误"""
+        self.log_browser.append(f"{datetime.now().strftime('%H:%M:%S')} {message}")
+
     def acquisition_finished(self):
         """采集完成回调"""
-        pass
+        if self.archive is not None:
+            self.archive.flush()
+
+    def _run_metadata(self):
+        return {"time_scal": self.time_scal, "gain": self.gain, "ips": self.selected_ips,
+                "channels": self.selected_channels, "target_rate": self.target_rate}
+
+    def toggle_archive(self):
+        """开始或结束归档：之后每次运行的波形和峰值、半高全宽、粒子数连续写入归档文件"""
+        if self.archive is not None:
+            self.close_archive()
+            return
+        file_path, _ = QFileDialog.getSaveFileName(
+            self, "归档文件", f"beam_run_{datetime.now().strftime('%Y%m%d_%H%M%S')}.h5",
+            "HDF5文件 (*.h5);;NPZ文件 (*.npz)"
+        )
+        if file_path:
+            self.archive = RunArchive(file_path, metadata=self._run_metadata())
+            self.btn_archive.setText("结束归档")
+
+    def close_archive(self):
+        if self.archive is not None:
+            path = self.archive.path
+            self.archive.close()
+            self.archive = None
+            self.btn_archive.setText("开始归档")
+            QMessageBox.information(self, "成功", f"数据已归档至: {path}")
     
-    def update_ui(self, run_number, time_data, off_data, on_data, beam_data):
-        """更新UI显示"""
-        self.run_count += 1
+    def _stats_for(self, source):
+        """返回数据来源对应的 (峰值, 半高全宽, 粒子数) 统计量"""
+        if source not in self.source_stats:
+            self.source_stats[source] = (RunningStatistics(), RunningStatistics(), RunningStatistics())
+        return self.source_stats[source]
+
+    def update_ui(self, ip_address, run_number, channel, timestamp, time_data, off_data, on_data, beam_data,
+                  peak_value, fwhm, particle_number):
+        """更新UI显示（峰值、半高全宽和粒子数已在分析线程中算好，结果已按时间戳排序）"""
+        # 同一台示波器同一次触发的多个通道共用一个运行序号
+        if (ip_address, run_number) != self._last_run_number:
+            self._last_run_number = (ip_address, run_number)
+            self.run_count += 1
+        # 多台示波器时用 "IP 通道" 区分数据来源
+        source = f"{ip_address} CH{channel}" if len(self.selected_ips) > 1 else f"CH{channel}"
 
         # 更新历史趋势图
-        self.history_plot.add_data(self.run_count, beam_data)
+        self.history_plot.add_data(self.run_count, beam_data, series=source)
 
         # 更新统计表格
-        peak_value, fwhm = DataProcessor.calculate_peak_and_fwhm(time_data, beam_data)
-        particle_number = DataProcessor.calculate_particle_count(beam_data,time_data)
-
-
         row = self.stat_table.rowCount()
         self.stat_table.insertRow(row)
         self.stat_table.setItem(row, 0, QTableWidgetItem(str(self.run_count)))
-        self.stat_table.setItem(row, 1, QTableWidgetItem(f"{peak_value:.2f}"))
-        self.stat_table.setItem(row, 2, QTableWidgetItem(f"{fwhm:.2f}"))
-        self.stat_table.setItem(row, 3, QTableWidgetItem(f"{particle_number:.2e}"))
-
+        self.stat_table.setItem(row, 1, QTableWidgetItem(source))
+        self.stat_table.setItem(row, 2, QTableWidgetItem(f"{peak_value:.2f}"))
+        self.stat_table.setItem(row, 3, QTableWidgetItem(f"{fwhm:.2f}"))
+        self.stat_table.setItem(row, 4, QTableWidgetItem(f"{particle_number:.2e}"))
 
         # 更新流强平均值
-        all_1 = [float(self.stat_table.item(i, 1).text()) for i in range(self.stat_table.rowCount())]
-        all_2 = [float(self.stat_table.item(i, 2).text()) for i in range(self.stat_table.rowCount())]
-        all_3 = [float(self.stat_table.item(i, 3).text()) for i in range(self.stat_table.rowCount())]
-        overall_avg1 = np.mean(all_1)
-        sigma2 = DataProcessor.calculate_sigma(all_1)
-        overall_avg2 = np.mean(all_2)
-        overall_avg3 = np.mean(all_3)
-        self.avg_label.setText(f"流强平均值：{overall_avg1:.2f} mA, 流强标准差 {sigma2:.4f} mA, 半高全宽平均值：{overall_avg2:.2f} μs, 单脉冲粒子数平均值：{overall_avg3:.2e} ppp")
-
-
-
+        peak_stats, fwhm_stats, particle_stats = self._stats_for(source)
+        peak_stats.add(peak_value)
+        fwhm_stats.add(fwhm)
+        particle_stats.add(particle_number)
+        self.avg_label.setText("\n".join(
+            f"{src} 流强平均值：{p.mean:.2f} mA, 流强标准差 {p.std:.4f} mA, 半高全宽平均值：{f.mean:.2f} μs, 单脉冲粒子数平均值：{n.mean:.2e} ppp"
+            for src, (p, f, n) in sorted(self.source_stats.items())))
 
         # 保存结果并显示
-        self.results.append((self.run_count, time_data, off_data, on_data, beam_data))
+        self.results.append(self.run_count, time_data, off_data, on_data, beam_data, source=source)
+        if self.archive is not None:
+            # 波形为 (ABS-Off, ABS-On, 流强) 三行；时间轴等间隔，只记录起点 t0 和间隔 dt (μs)
+            name, index = self.archive.append_waveforms("beam", np.vstack((off_data, on_data, beam_data)))
+            self.archive.append_rows("shots", run=self.run_count, ip=ip_address, channel=channel,
+                                     timestamp=timestamp, peak=peak_value, fwhm=fwhm, particles=particle_number,
+                                     gain=self.gain, time_scal=self.time_scal, t0=time_data[0],
+                                     dt=time_data[1] - time_data[0] if len(time_data) > 1 else 0.0,
+                                     waveform_set=name, waveform=index)
         self.current_result_idx = len(self.results) - 1
         self.show_current_result()
     
@@ -225,7 +329,8 @@ class BeamIntensityPage(QWidget):
         """显示当前结果"""
         if 0 <= self.current_result_idx < len(self.results):
             run, time_data, off_data, on_data, beam_data = self.results[self.current_result_idx]
-            self.result_label.setText(f"运行: {run}")
+            source = self.results.source_of(self.current_result_idx)
+            self.result_label.setText(f"运行: {run} ({source})")
             self.result_plot.plot_data(time_data, off_data, on_data, beam_data)
     
     def show_prev_result(self):
@@ -245,7 +350,7 @@ class BeamIntensityPage(QWidget):
         if 0 <= self.current_result_idx < len(self.results):
             options = QFileDialog.Options()
             file_path, _ = QFileDialog.getSaveFileName(
-                self, "保存图像", f"beam_result_{self.results[self.current_result_idx][0]}.png",
+                self, "保存图像", f"beam_result_{self.results[self.current_result_idx][0]}_{self.results.source_of(self.current_result_idx).replace(' ', '_')}.png",
                 "PNG文件 (*.png);;JPEG文件 (*.jpg)", options=options
             )
             
@@ -285,7 +390,7 @@ class BeamIntensityPage(QWidget):
         if 0 <= self.current_result_idx < len(self.results):
             options = QFileDialog.Options()
             file_path, _ = QFileDialog.getSaveFileName(
-                self, "保存数据", f"beam_data_{self.results[self.current_result_idx][0]}.csv",
+                self, "保存数据", f"beam_data_{self.results[self.current_result_idx][0]}_{self.results.source_of(self.current_result_idx).replace(' ', '_')}.csv",
                 "CSV文件 (*.csv)", options=options
             )
             
@@ -304,15 +409,14 @@ class BeamIntensityPage(QWidget):
         """清空所有数据"""
         self.stop_acquisition()
         self.run_count = 0
-        self.results = []
+        self._last_run_number = None
+        self.results.clear()
         self.current_result_idx = -1
         
-        self.history_plot.run_data = []
-        self.history_plot.update_plot()
+        self.history_plot.clear()
         
         self.stat_table.setRowCount(0)
+        self.source_stats = {}
         self.avg_label.setText("总体平均值: 0")
         self.result_label.setText("运行: -")
-        self.result_plot.ax1.clear()
-        self.result_plot.ax2.clear()
-        self.result_plot.draw()
\ No newline at end of file
+        self.result_plot.clear()
\ No newline at end of file
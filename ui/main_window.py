@@ -2,6 +2,7 @@ from PyQt5.QtWidgets import (QMainWindow, QTabWidget, QMenu, QAction,
                             QFileDialog, QMessageBox)
 from .beam_intensity_page import BeamIntensityPage
 from .polarization_page import PolarizationPage
+from core.ptnhp_con import close_shared_ptnhp
 
 class MainWindow(QMainWindow):
     """主窗口类"""
@@ -140,8 +141,18 @@ class MainWindow(QMainWindow):
         # 停止所有运行中的线程
         if self.beam_intensity_page.thread and self.beam_intensity_page.thread.isRunning():
             self.beam_intensity_page.thread.stop()
-
-        '''if self.polarization_page.thread and self.polarization_page.thread.isRunning():
-            self.polarization_page.thread.stop()'''
+        # 极化测量线程逐点写入归档，先停止并等待其退出，再关闭归档
+        acquisition_thread = self.polarization_page.acquisition_thread
+        if acquisition_thread and acquisition_thread.isRunning():
+            acquisition_thread.stop_requested = True
+            acquisition_thread.wait()
+        # 删除溢出到磁盘的波形临时文件
+        self.beam_intensity_page.results.close()
+        # 关闭归档文件
+        self.beam_intensity_page.close_archive()
+        self.polarization_page.close_archive()
+        # 电源安全下电并关闭其事件循环，之后才能关闭共享的电源连接
+        self.polarization_page.supply_ramper.shut_down()
+        close_shared_ptnhp()
         
         event.accept()
\ No newline at end of file
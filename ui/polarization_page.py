@@ -7,84 +7,52 @@ from matplotlib.figure import Figure
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit,
                              QPushButton, QFileDialog, QMessageBox, QTextBrowser,
-                             QTableWidget, QTableWidgetItem, QComboBox, QGridLayout)
-from PyQt5.QtCore import Qt, pyqtSignal, QThread
+                             QTableWidget, QTableWidgetItem, QComboBox, QGridLayout, QCheckBox)
+from PyQt5.QtCore import Qt, pyqtSignal, QThread, QObject
 import csv
 from datetime import datetime
-from RsInstrument import RsInstrument, BinFloatFormat
 import time
+import asyncio
+from concurrent.futures import wait as wait_futures
 from scipy.signal import butter, filtfilt
-# 假设 PTNhpController 已正确实现
-from core.ptnhp_con import PTNhpController
+# 三个线程共用同一个电源连接
+from core.ptnhp_con import shared_ptnhp
+from core.ptnhp_async import AsyncPTNhp
+from core.run_archive import RunArchive
+from core.instrument import ScopeSession
+from core import simulator
+from core.data_processor import DataProcessor
+from core.settle import SettleController
+from core.photon_trace import PhotonTraceAccumulator, compact_trace
+from core.polarization import calculate_polarization_batch, OnlinePolarizationEstimator, DEUTERON_RANGES
+from core.scan_planner import ScanPlanner, RoiScan, ORDER_FILE, ORDER_SERPENTINE, ORDER_MONOTONIC
 import re
 
 
-def calculate_polarization(signal, background, particle_type='proton'):
-    def get_max_in_ranges(data, ranges):
-        max_results = []
-        for r in ranges:
-            idx = np.where((data[:, 0] >= r[0]) & (data[:, 0] < r[1]))[0]
-            if len(idx) > 0:
-                max_idx = idx[np.argmax(data[idx, 1])]
-                max_val = data[max_idx, 1]
-                max_results.append((max_idx, data[max_idx, 0], max_val))
-            else:
-                max_results.append((None, None, None))
-        return max_results
+def calculate_polarization(signal, background, particle_type='proton', proton_split=None, deuteron_ranges=None):
+    """
+    由光子信号计算极化度（单次扫描，批量计算见 core.polarization.calculate_polarization_batch）
 
+    signal / background 的前两列为 (磁场, 测量值)。
+    proton_split: 质子两个峰之间的分界磁场 (Gs)，数据须按磁场升序排列；
+                  为 None 时沿用逐点数据的索引范围 [0:100] 和 [100:200]
+    deuteron_ranges: 氘核三个峰的磁场范围，None 时为 (560,570)、(570,580)、(580,590)
+    """
+    batch = calculate_polarization_batch(signal, background, particle_type, proton_split,
+                                         deuteron_ranges or DEUTERON_RANGES)
     result = {}
-
-    if particle_type.lower() in ['proton', 'p', 'h']:
-        peak_bp_idx = np.argmax(background[:, 1][0:100])
-        peak_bn_idx = np.argmax(background[:, 1][100:200]) + 100
-        peak_p_idx = np.argmax(signal[:, 1][0:100])
-        peak_n_idx = np.argmax(signal[:, 1][100:200]) + 100
-
-        Nbp_list = sorted(background[:, 1][peak_bp_idx - 5:peak_bp_idx + 5])[:-1]
-        Nbp = np.mean(sorted(Nbp_list)[-4:])
-        Nbn_list = sorted(background[:, 1][peak_bn_idx - 5:peak_bn_idx + 5])[:-1]
-        Nbn = np.mean(sorted(Nbn_list)[-4:])
-        Np_list = sorted(signal[:, 1][peak_p_idx - 5:peak_p_idx + 5])[:-1]
-        Np = np.mean(sorted(Np_list)[-4:])
-        Nn_list = sorted(signal[:, 1][peak_n_idx - 5:peak_n_idx + 5])[:-1]
-        Nn = np.mean(sorted(Nn_list)[-4:])
-
-        polarization = ((Np - Nbp) - (Nn - Nbn)) / ((Np - Nbp) + (Nn - Nbn))
-        result['polarization'] = polarization
-        result['peak_signal'] = [[signal[peak_p_idx, 0], signal[peak_n_idx, 0]], [Np, Nn]]
-        result['peak_background'] = [[background[peak_bp_idx, 0], background[peak_bn_idx, 0]], [Nbp, Nbn]]
-        return result
-
-    elif particle_type.lower() in ['deuteron', 'd', 'D']:
-        ranges = [(560, 570), (570, 580), (580, 590)]
-        max_WFT_ON = get_max_in_ranges(signal, ranges)
-        max_Background = get_max_in_ranges(background, ranges)
-        max_WFT_ON_index = [max_WFT_ON[i][0] for i in range(3)]
-        max_Background_index = [max_Background[i][0] for i in range(3)]
-
-        Nbp_list = sorted([background[:, 1][max_Background_index[0] - 5: max_Background_index[0] + 5]])[0][:-1]
-        Nbp = np.mean(sorted(Nbp_list)[-4:])
-        Nb0_list = sorted([background[:, 1][max_Background_index[1] - 5: max_Background_index[1] + 5]])[0][:-1]
-        Nb0 = np.mean(sorted(Nb0_list)[-4:])
-        Nbn_list = sorted([background[:, 1][max_Background_index[2] - 5: max_Background_index[2] + 5]])[0][:-1]
-        Nbn = np.mean(sorted(Nbn_list)[-4:])
-
-        Np_list = sorted([signal[:, 1][max_WFT_ON_index[0] - 5: max_WFT_ON_index[0] + 5]])[0][:-1]
-        Np = np.mean(sorted(Np_list)[-4:])
-        N0_list = sorted([signal[:, 1][max_WFT_ON_index[1] - 5: max_WFT_ON_index[1] + 5]])[0][:-1]
-        N0 = np.mean(sorted(N0_list)[-4:])
-        Nn_list = sorted([signal[:, 1][max_WFT_ON_index[2] - 5: max_WFT_ON_index[2] + 5]])[0][:-1]
-        Nn = np.mean(sorted(Nn_list)[-4:])
-
-        P_z = ((Np - Nbp) - (Nn - Nbn)) / ((Np - Nbp) + (N0 - Nb0) + (Nn - Nbn))
-        P_zz = ((Np - Nbp) - 2 * (N0 - Nb0) + (Nn - Nbn)) / ((Np - Nbp) + (N0 - Nb0) + (Nn - Nbn))
-        result['P_z'] = P_z
-        result['P_zz'] = P_zz
-        result['peak_signal'] = ([max_WFT_ON[0][1], max_WFT_ON[1][1], max_WFT_ON[2][1]], [Np, N0, Nn])
-        result['peak_background'] = ([max_Background[0][1], max_Background[1][1], max_Background[2][1]], [Nbp, Nb0, Nbn])
-        return result
+    peak_signal = [list(batch['peak_signal'][0][0]), list(batch['peak_signal'][1][0])]
+    peak_background = [list(batch['peak_background'][0][0]), list(batch['peak_background'][1][0])]
+    if 'polarization' in batch:
+        result['polarization'] = batch['polarization'][0]
+        result['peak_signal'] = peak_signal
+        result['peak_background'] = peak_background
     else:
-        raise ValueError("Unsupported particle type. Use 'proton' or 'deuteron'.")
+        result['P_z'] = batch['P_z'][0]
+        result['P_zz'] = batch['P_zz'][0]
+        result['peak_signal'] = tuple(peak_signal)
+        result['peak_background'] = tuple(peak_background)
+    return result
 
 
 def integrate_waveform(data, total_time=1.2E-3, method='trapezoid'):
@@ -97,52 +65,63 @@ def integrate_waveform(data, total_time=1.2E-3, method='trapezoid'):
         raise ValueError(f"不支持的积分方法: {method}。请使用'trapz'或'cumtrapz'。")
 
 
-def moving_average(data, window_size):
-    weights = np.repeat(1.0, window_size) / window_size
-    return np.convolve(data, weights, 'valid')
-
-
-def oscilloscope_preset(instr):
-    instr.write_str('*RST')
-    time.sleep(0.01)
-
-    instr.write_str('CHAN1:STAT ON')
-    instr.write_str('CHAN3:STAT ON')
-    instr.write_str('CHAN4:STAT ON')
-    instr.write_str('CHAN2:STAT ON')
-
-    instr.write_str('TIM:ROLL:AUT OFF')
-    instr.write_str('ACQ:HRES AUTO')
-
-    instr.write_str('PROB1:SET:GAIN:MAN 0.1')
-    instr.write_str('PROB2:SET:GAIN:MAN 1')
-
-    instr.write_str('TIM:SCAL 1e-4')
-    instr.write_str('TIM:REF 8.33')
-    instr.write_str('CHAN1:SCAL 1')
-    instr.write_str('CHAN1:POS -4')
-    instr.write_str('CHAN2:SCAL 1')
-    instr.write_str('CHAN2:POL INV')
-    instr.write_str('CHAN2:POS -4')
-    instr.write_str('CHAN3:SCAL 1')
-    instr.write_str('CHAN3:POS -4')
-    instr.write_str('CHAN4:SCAL 1')
-    instr.write_str('CHAN4:POS -4')
-    instr.write_str('CHAN1:COUP DCLimit')
-    instr.write_str('CHAN2:COUP DCLimit')
-    instr.write_str('CHAN3:COUP DCLimit')
-    instr.write_str('CHAN4:COUP DCLimit')
-    instr.write_str('TRIG:A:MODE NORM')
-    instr.write_str('TRIG:A:SOUR CH3')
-    instr.write_str('TRIG:A:TYPE EDGE')
-    instr.write_str('TRIG:A:EDGE:SLOP POS')
-    instr.write_str('TRIG:A:LEV3:VAL 2')
-    instr.write_str('ACQuire:NSINgle:COUNt 1')
-    instr.write_str('TRIG:OUT:MODE TRIG')
-    instr.write_str('TRIG:OUT:PLEN 2E-4')
-    instr.write_str('TRIG:OUT:POL POS')
-
-    instr.query_opc()
+# 全分辨率（示波器当前记录长度）下光信号的平滑窗口（点数）
+PHOTON_SMOOTH_WINDOW = 200
+
+# 实测磁场与设定值允许的最大偏差 (Gs)，超出时该点使用设定值；一遍扫描中超过一半的点超出时中止测量
+FIELD_DEVIATION_LIMIT = 5.0
+
+# 采集配置：记录长度、高分辨率抽取、波形读取点范围，以及积分误差估计允许的最大相对误差
+# "full" 不修改示波器设置，使用示波器当前的记录长度
+ACQUISITION_PROFILES = {
+    "full": {"name": "全分辨率（示波器当前设置）", "record_length": None, "hres": None,
+             "data_points": None, "max_rel_error": 0.0},
+    "hres_2k": {"name": "高分辨率抽取 2k 点", "record_length": 2000, "hres": "ON",
+                "data_points": "DMAX", "max_rel_error": 2e-3},
+    "hres_1k": {"name": "高分辨率抽取 1k 点", "record_length": 1000, "hres": "ON",
+                "data_points": "DMAX", "max_rel_error": 5e-3},
+}
+
+
+def photon_integral(data_photon, full_length=None):
+    """
+    光信号积分
+
+    full_length: 抽取波形对应的全分辨率波形长度（实际传输的点数），平滑窗口按
+                 len(data_photon) / full_length 缩放，时间宽度与全分辨率下的 200 点相同；
+                 全分辨率波形传 None，不缩放
+    """
+    window = PHOTON_SMOOTH_WINDOW
+    if full_length:
+        window = max(1, round(PHOTON_SMOOTH_WINDOW * len(data_photon) / full_length))
+    temp_photon = DataProcessor.moving_average(data_photon, window)
+    return integrate_waveform(temp_photon, total_time=1.2E-3, method='trapz')
+
+
+def profile_commands(profile, channels=(2, 3)):
+    """采集配置对应的 (SCPI 头, 值) 列表，channels 为读取的通道；"full" 为空，不修改示波器设置"""
+    settings = ACQUISITION_PROFILES[profile]
+    if settings["record_length"] is None:
+        return []
+    commands = [("ACQ:POIN", settings["record_length"]), ("ACQ:HRES", settings["hres"])]
+    if settings["data_points"]:
+        commands += [(f"CHAN{ch}:DATA:POIN", settings["data_points"]) for ch in channels]
+    return commands
+
+
+def estimate_decimation_error(full_waveform, profile):
+    """
+    离线估计抽取配置的积分误差：把一次全分辨率波形按块平均，近似示波器的高分辨率抽取，
+    比较抽取前后的积分。只反映记录长度缩短对平滑和积分的影响，并不检查示波器实际抽取的数据。
+
+    返回: (积分相对误差, 是否在允许范围内)
+    """
+    settings = ACQUISITION_PROFILES[profile]
+    factor = len(full_waveform) // settings["record_length"]
+    reference = photon_integral(full_waveform)
+    reduced = photon_integral(DataProcessor.decimate_mean(full_waveform, factor), len(full_waveform))
+    error = abs(reduced - reference) / abs(reference) if reference else 0.0
+    return error, error <= settings["max_rel_error"] or factor <= 1
 
 
 class DataAcquisitionThread(QThread):
@@ -151,8 +130,22 @@ class DataAcquisitionThread(QThread):
     acquisition_finished = pyqtSignal(np.ndarray)
     error_occurred = pyqtSignal(str)
     current_updated = pyqtSignal(float)  # 新增：发送当前电流信号
-
-    def __init__(self, measurement_type, particle_type, gain_factor, bfield_array, parent, last_current=0.0):
+    peaks_located = pyqtSignal(np.ndarray)  # ROI 自适应扫描：粗扫得到的峰位
+    sweep_completed = pyqtSignal(int)  # 完成的扫描遍数
+
+    def __init__(self, measurement_type, particle_type, gain_factor, bfield_array, parent, last_current=0.0,
+                 estimator=None, target_sigma=None, roi=None, roi_budget=0, profile="full", archive=None,
+                 field_probe=None):
+        """
+        estimator / target_sigma: 收敛停止模式。每扫完一遍用 estimator 估计极化度，
+        不确定度低于 target_sigma 或连续 patience 遍改善不足 min_improvement 时提前结束，
+        结束后不回到 10 A，由页面安全下电；手动停止时同样不回到 10 A
+        roi / roi_budget: ROI 自适应扫描。bfield_array 为粗扫点，扫完后用 roi 定位峰，
+        把剩余的点数预算 (roi_budget - 粗扫点数) 用于峰附近的加密点
+        profile: ACQUISITION_PROFILES 中的采集配置，抽取配置在扫描前先用一次全分辨率采集离线估计积分误差
+        archive: RunArchive，逐点写入光信号和磁场波形及测量值，结束时写入合并后的结果
+        field_probe: 磁场探头 (示波器通道, 标定 Gs/V)，None 时不测量实测磁场，磁场列使用设定值
+        """
         super().__init__()
         self.measurement_type = measurement_type
         self.particle_type = particle_type
@@ -161,78 +154,284 @@ class DataAcquisitionThread(QThread):
         self.parent = parent
         self.last_current = last_current  # 接收上次测量的最终电流
         self.stop_requested = False
+        # 实测耗时记录，测量结束后用于校准扫描时间预测
+        self.settle_history = []
+        self.point_times = []
+        self.estimator = estimator
+        self.target_sigma = target_sigma
+        self.min_sweeps = 2
+        self.patience = 2
+        self.min_improvement = 0.05
+        self.converged = False
+        self.roi = roi
+        self.roi_budget = roi_budget
+        self.profile = profile
+        self.full_length = None  # 抽取配置生效时全分辨率波形的实际长度；全分辨率采集为 None
+        self._saved_settings = []  # 采集配置修改前的示波器设置 (SCPI 头, 值)
+        self.archive = archive
+        # 实测磁场: (设定值, 平均值, 标准差, 漂移, 次数)，测量结束后填入
+        self.field_table = None
+        self.field_rejected = 0
+        self.field_probe = field_probe
+        self.field_aborted = False
 
     def run(self):
         try:
-            ptnhp = PTNhpController(ip="192.168.1.123", port=7, timeout=5, terminator='\n')
+            ptnhp = shared_ptnhp()
             if not ptnhp.connect():
                 self.error_occurred.emit("PTNhp 电源连接失败")
                 return
 
 
-            instr = RsInstrument('TCPIP::192.168.1.99::INSTR', True, False)
+            # 模拟后端按本次测量的粒子类型和束流状态生成波形
+            simulator.configure(self.particle_type, self.measurement_type)
+            # 数据格式在建立连接时设置一次
+            session = ScopeSession("192.168.1.99")
+            session.open()
+            self._apply_profile(session)
 
-            photons = []
             # 关键修复：创建 bfield_array 的副本，避免修改原始数据
             BFields_settings = self.bfield_array.copy()
-            # measured_BFields = np.zeros_like(BFields_settings)  # 用于存储实际测量值
             Currents = BFields_settings * 2 / 103.6
-
-            for i in range(len(BFields_settings)):
+            settle = SettleController(ptnhp.measure_current)
+            discarded = ptnhp.discarded
+            # 同一磁场值的多次测量累积到同一行
+            trace = self.estimator.trace if self.estimator is not None else PhotonTraceAccumulator(BFields_settings)
+            sigmas = []
+            self.settle_history = settle.history
+
+            # ROI 自适应扫描会在粗扫结束后追加加密点，因此按索引循环
+            roi_pending = self.roi is not None
+            # 按扫描计划计数完成的遍数：下一点在本遍中已经测过（方向反转或重新开始）、
+            # 计划结束或粗扫结束时，本遍完成
+            passes = 0
+            pass_points = set()
+            pass_rejected = 0  # 本遍中实测磁场被舍弃的次数
+            i = 0
+            issued = None  # 已在上一点波形传输前提前下发电流的点
+            while i < len(BFields_settings):
                 if self.stop_requested:
                     self.error_occurred.emit("测量已被手动停止")
                     break
 
                 current = Currents[i]
                 self.current_updated.emit(current)
-                if current != Currents[i - 1] and i > 0:
-                    ptnhp.set_current(current)
-                    time.sleep(1)
-                elif i == 0:
-                    ptnhp.set_current(current)
-                    time.sleep(1)
+                if i == 0 or current != Currents[i - 1]:
+                    previous = self.last_current if i == 0 else Currents[i - 1]
+                    if issued != i:
+                        ptnhp.set_current(current)
+                        settle.begin(current, previous)
+                    # 轮询电流回读直到稳定，取代固定的 1 s 等待
+                    duration, settled, reading = settle.wait(should_stop=lambda: self.stop_requested)
+                    if settled:
+                        self.error_occurred.emit(f"稳定等待: {BFields_settings[i]:.2f} Gs, "
+                                                 f"步长 {current - previous:+.4f} A, 耗时 {duration:.3f} s")
+                    elif settle.fallback:
+                        # 只在切换为固定等待时提示一次
+                        if settled is False and not self.stop_requested:
+                            self.error_occurred.emit(
+                                f"电流回读连续 {settle.max_timeouts} 次未稳定（最后回读 {reading}），"
+                                f"改为每点固定等待 {settle.fallback_delay:g} s")
+                    elif not self.stop_requested:
+                        self.error_occurred.emit(
+                            f"{BFields_settings[i]:.2f} Gs 电流未在 {duration:.2f} s 内稳定，回读 {reading}")
 
                 BField_val = BFields_settings[i]
-
-                #measured_BFields[i] = BFields_settings[i]
-
-                instr.write_str_with_opc("SINGle", 50000)
-                instr.write_str("FORMat:DATA REAL,32")
-                instr.bin_float_numbers_format = BinFloatFormat.Single_4bytes_swapped
-                instr.data_chunk_size = 100000
-
-
-                data_photon = np.array(instr.query_bin_or_ascii_float_list("CHAN2:DATA?"))
-                data_BField = np.array(instr.query_bin_or_ascii_float_list("CHAN3:DATA?"))
+                point_start = time.perf_counter()
+
+                session.single()
+                # 采集已完成、波形在示波器内存中：立即下发下一点电流，
+                # 电源调节与本点的波形传输和积分同时进行
+                if (i + 1 < len(BFields_settings) and Currents[i + 1] != current
+                        and not self.stop_requested):
+                    ptnhp.set_current(Currents[i + 1])
+                    settle.begin(Currents[i + 1], current)
+                    issued = i + 1
+
+                # 光信号和磁场探头通道在同一次触发后连续传输，中间不插入其它命令
+                waveforms = session.fetch_channels(self._channels())
+                data_photon = waveforms[2]
+                data_BField = waveforms[self.field_probe[0]] if self.field_probe else np.empty(0)
                 self.update_oscilloscope_signal.emit(data_photon, data_BField)
 
-
-                temp_photon = moving_average(data_photon, 200)
-                photon = integrate_waveform(temp_photon, total_time=1.2E-3, method='trapz')
-                photons.append(photon)
+                photon = photon_integral(data_photon, self.full_length)
 
                 photon_val = photon * self.gain_1
+                # 探头波形压缩为 (平均值, 标准差, 漂移)，与设定值一起保存
+                field = self._measure_field(data_BField, BField_val) if self.field_probe else None
+                pass_rejected += self.field_probe is not None and field is None
+                trace.add(BField_val, photon_val, field)
+                if self.archive is not None:
+                    self._archive_point(BField_val, photon_val, field, data_photon, data_BField)
                 # 使用实际测量值更新散点图
                 self.update_scatter_signal.emit(BField_val, photon_val, self.measurement_type)
+                self.point_times.append(time.perf_counter() - point_start)
+                pass_points.add(BField_val)
+                if roi_pending and i == len(BFields_settings) - 1:
+                    # 粗扫结束：定位峰并追加加密点
+                    BFields_settings = self._append_dense(trace, BFields_settings, current)
+                    Currents = BFields_settings * 2 / 103.6
+                    roi_pending = False
+                    pass_done = True
+                else:
+                    pass_done = i + 1 == len(BFields_settings) or BFields_settings[i + 1] in pass_points
+                if pass_done:
+                    passes += 1
+                    if pass_rejected * 2 > len(pass_points):
+                        self.field_aborted = True
+                        self.error_occurred.emit(
+                            f"第 {passes} 遍 {len(pass_points)} 个磁场点中 {pass_rejected} 个实测磁场偏离设定值超过 "
+                            f"{FIELD_DEVIATION_LIMIT} Gs，请检查探头通道 CH{self.field_probe[0]} 和标定 "
+                            f"{self.field_probe[1]} Gs/V，测量中止")
+                        break
+                    pass_points.clear()
+                    pass_rejected = 0
+                    self.sweep_completed.emit(passes)
+                    if self.estimator is not None:
+                        # 每扫完一遍检查一次收敛
+                        self.estimator.sweeps_completed = passes
+                        if self._check_convergence(sigmas):
+                            break
                 time.sleep(0.001)
+                i += 1
 
 
+            count, total, timeouts = settle.summary()
+            if count:
+                self.error_occurred.emit(
+                    f"稳定等待 {count} 次，共 {total:.1f} s，平均 {total / count:.3f} s，超时 {timeouts} 次")
+            self._report_field(trace)
+            if ptnhp.discarded > discarded:
+                self.error_occurred.emit(f"电源查询前共丢弃 {ptnhp.discarded - discarded} 字节未读取的应答")
             self.error_occurred.emit(f"测量结束")
 
-            photons = np.array(photons) * self.gain_1
-            # 使用实际测量的磁场值与光子数据合并
-            merged = np.column_stack((BFields_settings, photons))
-            self.acquisition_finished.emit(merged)
-
-            ptnhp.set_current(10)
+            # 按实测磁场排序的 (磁场, 平均值, 标准差, 次数)
+            result = trace.compact(measured_field=True)
+            if self.archive is not None:
+                self.archive.append_rows(f"{self.measurement_type}_trace", bfield=result[:, 0], mean=result[:, 1],
+                                         std=result[:, 2], count=result[:, 3])
+                self.archive.flush()
+            # 电流回到 10 A（或收敛停止后下电）由页面通过 SupplyRamper 的任务队列执行
+            self.acquisition_finished.emit(result)
 
         except Exception as e:
             self.error_occurred.emit(f'发生错误: {e}')
         finally:
-            if 'instr' in locals():
-                instr.close()
-            if 'ptnhp' in locals():
-                ptnhp.close()
+            if 'session' in locals():
+                try:
+                    if session.is_open:
+                        self._restore_profile(session)
+                finally:
+                    session.close()
+
+
+    def _channels(self):
+        """每次触发读取的通道：光信号 CHAN2，以及磁场探头通道"""
+        return (2, self.field_probe[0]) if self.field_probe else (2,)
+
+    def _measure_field(self, data_BField, setpoint):
+        """由探头波形得到实测磁场 (平均值, 标准差, 漂移) (Gs)；偏离设定值过大时记录并返回 None"""
+        field = tuple(value * self.field_probe[1] for value in DataProcessor.waveform_stats(data_BField))
+        if not abs(field[0] - setpoint) <= FIELD_DEVIATION_LIMIT:
+            self.field_rejected += 1
+            self.error_occurred.emit(
+                f"{setpoint:.2f} Gs 实测磁场 {field[0]:.2f} Gs 偏差超过 {FIELD_DEVIATION_LIMIT} Gs，该点使用设定值")
+            return None
+        return field
+
+    def _archive_point(self, setpoint, photon, field, data_photon, data_BField):
+        """把一个点的光信号和磁场波形及测量值追加到归档（没有磁场探头时只有光信号波形）"""
+        shot = np.vstack((data_photon, data_BField)) if len(data_BField) else data_photon[np.newaxis]
+        name, index = self.archive.append_waveforms(self.measurement_type, shot)
+        field_mean, field_sigma, field_drift = field if field is not None else (np.nan, np.nan, np.nan)
+        self.archive.append_rows(f"{self.measurement_type}_points", timestamp=time.time(), setpoint=setpoint,
+                                 field=field_mean, field_sigma=field_sigma, field_drift=field_drift,
+                                 photon=photon, profile=self.profile, waveform_set=name, waveform=index)
+
+    def _report_field(self, trace):
+        """记录实测磁场与设定值的对照，并输出偏差和漂移的概况"""
+        self.field_table = trace.field_table()
+        if self.field_probe is None:
+            self.error_occurred.emit("未设置磁场探头标定，磁场使用设定值")
+        if len(self.field_table):
+            deviation = self.field_table[:, 1] - self.field_table[:, 0]
+            self.error_occurred.emit(
+                f"实测磁场 {len(self.field_table)} 点：与设定值偏差 {deviation.mean():+.3f} Gs"
+                f"（最大 {np.abs(deviation).max():.3f} Gs），平均波动 {self.field_table[:, 2].mean():.3f} Gs，"
+                f"最大漂移 {np.abs(self.field_table[:, 3]).max():.3f} Gs")
+        if self.field_rejected:
+            self.error_occurred.emit(
+                f"{self.field_rejected} 次实测磁场与设定值偏差超过 {FIELD_DEVIATION_LIMIT} Gs，这些点使用设定值")
+
+    def _apply_profile(self, session):
+        """
+        设置采集配置。抽取配置先用一次全分辨率采集离线估计积分误差，超出允许范围时保持全分辨率；
+        通过时以该次实际传输的波形长度作为全分辨率长度，供抽取后的平滑窗口缩放。
+        被修改的设置先读回保存，测量结束后由 _restore_profile 恢复
+        """
+        self.full_length = None
+        commands = profile_commands(self.profile, self._channels())
+        if not commands:
+            return
+        name = ACQUISITION_PROFILES[self.profile]["name"]
+        record_length = int(float(session.read_setting("ACQ:POIN")))
+        if ACQUISITION_PROFILES[self.profile]["record_length"] >= record_length:
+            self.error_occurred.emit(f"示波器记录长度 {record_length} 点，不需要抽取，{name} 改用全分辨率")
+            self.profile = "full"
+            return
+        session.single()
+        full_waveform = session.fetch(2)
+        error, ok = estimate_decimation_error(full_waveform, self.profile)
+        if not ok:
+            self.error_occurred.emit(
+                f"采集配置 {name}：离线估计积分相对误差 {error:.2e} 超出允许范围，改用全分辨率")
+            self.profile = "full"
+            return
+        self.full_length = len(full_waveform)
+        self.error_occurred.emit(f"采集配置 {name}：离线估计积分相对误差 {error:.2e}（全分辨率 {self.full_length} 点）")
+        self._saved_settings = [(header, session.read_setting(header)) for header, _ in commands]
+        for header, value in commands:
+            session.write_setting(header, value)
+
+    def _restore_profile(self, session):
+        """恢复被采集配置修改的示波器设置"""
+        for header, value in self._saved_settings:
+            session.write_setting(header, value)
+        self._saved_settings = []
+
+    def _append_dense(self, trace, bfields, current):
+        """由粗扫结果定位峰，返回追加了加密点的磁场数组"""
+        peaks = self.roi.locate(trace.compact())
+        self.peaks_located.emit(peaks)
+        if self.estimator is not None:
+            self.estimator.proton_split = self.roi.split(peaks)
+            self.estimator.deuteron_ranges = self.roi.windows(peaks)
+        dense = self.roi.dense(peaks, self.roi_budget - len(bfields), start_current=current)
+        self.error_occurred.emit(
+            f"粗扫定位峰位：{', '.join(f'{p:.2f}' for p in peaks)} Gs；加密扫描 {len(dense)} 点")
+        return np.concatenate((bfields, dense))
+
+    def _check_convergence(self, sigmas):
+        """记录本遍结束时的极化度不确定度，返回是否可以提前结束"""
+        estimate = self.estimator.estimate()
+        key = 'polarization' if 'polarization' in estimate else 'P_z'
+        value, sigma = estimate.get(key, (np.nan, np.nan))
+        sigmas.append(sigma)
+        self.error_occurred.emit(f"第 {len(sigmas)} 遍：{key} = {value:.4f} ± {sigma:.4f}")
+        if len(sigmas) < self.min_sweeps or not np.isfinite(sigma):
+            return False
+        if sigma <= self.target_sigma:
+            self.converged = True
+            self.error_occurred.emit(f"不确定度 {sigma:.4f} 已达到目标 {self.target_sigma}，第 {len(sigmas)} 遍后提前结束")
+            return True
+        recent = sigmas[-(self.patience + 1):]
+        if len(recent) == self.patience + 1 and all(
+                later > earlier * (1 - self.min_improvement) for earlier, later in zip(recent, recent[1:])):
+            self.converged = True
+            self.error_occurred.emit(f"不确定度连续 {self.patience} 遍改善不足 {self.min_improvement:.0%}，"
+                                     f"第 {len(sigmas)} 遍后提前结束")
+            return True
+        return False
 
 
 class MplCanvas(FigureCanvas):
@@ -268,14 +467,25 @@ class PolarizationPage(QWidget):
         self.last_photon_data = None
         self.last_BField_data = None
         self.bfield_array = None  # 关键：存储全局磁场表
-        self.prepare_thread = None
-        self.ramp_steps = 100
+        self.ramp_slew_rate = 4.0  # 允许的电流变化率 (A/s)
         self.ramp_target_I = 10.0
         self.ramp_start_I = 0.0
         self.stop_requested = False
-        self.stop_thread = None
         self.last_current = 0.0
+        # 电源准备和下电在后台事件循环中执行，可随时相互打断
+        self.supply_ramper = SupplyRamper(self.ramp_slew_rate, target=self.ramp_target_I)
+        self.scan_planner = ScanPlanner()
+        self.online_estimator = None
+        self.online_text = "-"
+        self.roi_peaks = None  # ROI 自适应扫描粗扫得到的峰位，之后的测量复用
+        self.archive = None  # 归档文件：打开后每次测量逐点写入
         self.init_ui()
+        self.supply_ramper.ramp_finished.connect(self.on_ramp_finished)
+        self.supply_ramper.stop_finished.connect(self.on_stop_finished)
+        self.supply_ramper.stop_cancelled.connect(self.on_stop_cancelled)
+        self.supply_ramper.error_occurred.connect(self.textBrowser.append)
+        self.supply_ramper.current_changed.connect(self._on_supply_current)
+        self.supply_ramper.progress.connect(self._on_ramp_progress)
 
     def init_ui(self):
         main_layout = QVBoxLayout(self)
@@ -300,21 +510,49 @@ class PolarizationPage(QWidget):
         self.btn_unpolarized.clicked.connect(self.measure_unpolarized)
         self.btn_polarized = QPushButton("测量极化离子")
         self.btn_polarized.clicked.connect(self.measure_polarized)
+        self.btn_converge = QPushButton("极化离子（收敛停止）")
+        self.btn_converge.clicked.connect(self.measure_polarized_until_converged)
         self.btn_clear = QPushButton("清除数据")
         self.btn_clear.clicked.connect(self.clear_data)
         self.btn_save = QPushButton("保存结果")
         self.btn_save.clicked.connect(self.save_results)
         self.btn_load = QPushButton("读取数据")
         self.btn_load.clicked.connect(self.load_results)
+        self.btn_archive = QPushButton("开始归档")
+        self.btn_archive.clicked.connect(self.toggle_archive)
         self.cb_particle = QComboBox()
         self.cb_particle.addItems(["H", "D"])
+        self.cb_particle.currentIndexChanged.connect(lambda _: setattr(self, 'roi_peaks', None))
         # 不再显示示波器通道选择或示波器图像（右下角已移除）
         self.gain_label = QLabel("光信号增益：")
         self.gain_input = QLineEdit(str(self.gain_photon))
-
-        for widget in [self.btn_background, self.btn_unpolarized, self.btn_polarized,
-                   self.btn_clear, self.btn_save, self.btn_load, self.cb_particle,
-                   self.gain_label, self.gain_input]:
+        # 扫描规划：重复次数和访问顺序
+        self.repeat_label = QLabel("重复次数：")
+        self.repeat_input = QLineEdit("1")
+        self.cb_roi = QCheckBox("ROI 自适应采样")
+        self.cb_profile = QComboBox()
+        for key, settings in ACQUISITION_PROFILES.items():
+            self.cb_profile.addItem(settings["name"], key)
+        # 磁场探头：通道和标定 (Gs/V)，标定为空时不测量实测磁场
+        self.probe_label = QLabel("磁场探头 (Gs/V)：")
+        self.cb_probe_channel = QComboBox()
+        for channel in (3, 4, 1):
+            self.cb_probe_channel.addItem(f"CH{channel}", channel)
+        self.probe_input = QLineEdit("")
+        self.probe_input.setPlaceholderText("未标定")
+        self.sigma_label = QLabel("目标不确定度：")
+        self.sigma_input = QLineEdit("0.01")
+        self.cb_order = QComboBox()
+        for text, order in [("文件顺序", ORDER_FILE), ("往返扫描", ORDER_SERPENTINE), ("单向扫描", ORDER_MONOTONIC)]:
+            self.cb_order.addItem(text, order)
+        self.repeat_input.editingFinished.connect(self.show_scan_plan)
+        self.cb_order.currentIndexChanged.connect(self.show_scan_plan)
+
+        for widget in [self.btn_background, self.btn_unpolarized, self.btn_polarized, self.btn_converge,
+                   self.btn_clear, self.btn_save, self.btn_load, self.btn_archive, self.cb_particle,
+                   self.gain_label, self.gain_input, self.repeat_label, self.repeat_input, self.cb_order,
+                   self.sigma_label, self.sigma_input, self.cb_roi, self.cb_profile,
+                   self.probe_label, self.cb_probe_channel, self.probe_input]:
             control_layout.addWidget(widget)
         control_layout.addStretch()
         main_layout.addLayout(control_layout)
@@ -329,6 +567,12 @@ class PolarizationPage(QWidget):
         self.gridLayout.addWidget(QLabel("输出"), 0, 1)
         self.textBrowser = QTextBrowser()
         self.gridLayout.addWidget(self.textBrowser, 1, 1)
+        # 扫描过程中的实时极化度估计
+        self.online_label = QLabel("实时极化度：-")
+        self.gridLayout.addWidget(self.online_label, 2, 1)
+        # 电源 ramp 进度
+        self.supply_label = QLabel("电源：-")
+        self.gridLayout.addWidget(self.supply_label, 3, 1)
 
         # 右侧不再显示示波器输出，保留文本输出区域
 
@@ -350,18 +594,16 @@ class PolarizationPage(QWidget):
             QMessageBox.warning(self, "提示", "请先定义磁场表，再准备测量。")
             return
 
-        if self.prepare_thread and self.prepare_thread.isRunning():
+        if self.supply_ramper.is_busy():
             return
-        self.textBrowser.append("准备测量中：设置电压 70 V，10 s 内电流 ramp 到目标值 …")
-        self.prepare_thread = PrepareThread(self)
-        self.prepare_thread.ramp_finished.connect(self.on_ramp_finished)
-        self.prepare_thread.error_occurred.connect(self.textBrowser.append)
-        self.prepare_thread.start()
+        self.textBrowser.append(f"准备测量中：设置电压 70 V，电流以 {self.ramp_slew_rate} A/s ramp 到目标值 …")
+        self.supply_ramper.prepare()
 
     def redefine_bfield(self):
         new_bfield = self.get_bfield_array()
         if new_bfield is not None and len(new_bfield) > 0:
             self.bfield_array = new_bfield
+            self.roi_peaks = None
             self.textBrowser.append(f"已成功导入磁场表，共 {len(self.bfield_array)} 个点。")
             self.update_bfield_status()
         else:
@@ -373,6 +615,28 @@ class PolarizationPage(QWidget):
         else:
             self.textBrowser.append(
                 f"磁场表：{len(self.bfield_array)} 点 [{self.bfield_array[0]:.1f}~{self.bfield_array[-1]:.1f} Gs]")
+            self.show_scan_plan()
+
+    def plan_scan(self):
+        """按当前重复次数和扫描顺序生成访问顺序，返回 (磁场数组, 预测耗时 s, 总电流变化 A)"""
+        try:
+            repeats = max(int(self.repeat_input.text()), 1)
+        except ValueError:
+            repeats = 1
+        bfields = self.scan_planner.plan(self.bfield_array, repeats, self.cb_order.currentData(),
+                                         start_current=self.last_current)
+        duration, slew = self.scan_planner.predict(bfields, start_current=self.last_current)
+        return bfields, duration, slew
+
+    def show_scan_plan(self):
+        """在输出区显示扫描点数、总电流变化和预测耗时"""
+        if self.bfield_array is None or len(self.bfield_array) == 0:
+            return None
+        bfields, duration, slew = self.plan_scan()
+        self.textBrowser.append(
+            f"扫描计划（{self.cb_order.currentText()}）：{len(bfields)} 点，"
+            f"总电流变化 {slew:.2f} A，预计耗时 {duration / 60:.1f} min")
+        return bfields
 
     def get_bfield_array(self):
         if self.ask_bfield_array():
@@ -420,9 +684,16 @@ class PolarizationPage(QWidget):
         btn_file.clicked.connect(load_file)
         return dlg.exec_() == QtWidgets.QDialog.Accepted
 
-    def on_stop_finished(self):
+    def on_stop_finished(self, success):
         self.stop_requested = False
-        self.textBrowser.append("已安全下电，可重新准备测量。")
+        if success:
+            self.textBrowser.append("已安全下电，可重新准备测量。")
+        else:
+            self.textBrowser.append("下电未完成，请检查电源！")
+
+    def on_stop_cancelled(self):
+        self.stop_requested = False
+        self.textBrowser.append("下电已取消，电源由新的操作接管。")
 
     def stop_measurement(self):
         self.stop_requested = True
@@ -436,14 +707,22 @@ class PolarizationPage(QWidget):
         """停止测量：中断采集 -> 电流 ramp 到 0 -> 电压设 0"""
         # 1. 立旗，让采集线程尽快退出
         self.stop_requested = True
+        if self.acquisition_thread and self.acquisition_thread.isRunning():
+            self.acquisition_thread.stop_requested = True
 
-        # 2. 禁用按钮，防止重复点击
         self.textBrowser.append("正在安全下电：电流 ramp → 0 A，电压 → 0 V …")
 
-        # 3. 启动停止线程
-        self.stop_thread = StopRampThread(self)
-        self.stop_thread.finished.connect(self.on_stop_finished)
-        self.stop_thread.start()
+        # 2. 开始下电 ramp，正在进行的准备 ramp 被立即取消
+        self.supply_ramper.stop()
+
+    def _on_supply_current(self, current):
+        self.last_current = current
+
+    def _on_ramp_progress(self, setpoint, target, reading):
+        text = f"电源：设定 {setpoint:.3f} A → {target:.3f} A"
+        if not np.isnan(reading):
+            text += f"，回读 {reading:.3f} A"
+        self.supply_label.setText(text)
 
     def on_ramp_finished(self, success):
         if success:
@@ -454,9 +733,32 @@ class PolarizationPage(QWidget):
     # 示波器显示已移除，不再有相关 UI 更新方法
 
     def handle_scatter_update(self, x, y, data_type):
-        # 已移除图表显示，采集中产生的单点更新不再绘制到 UI
-        # 如果需要，可以将点缓冲并周期性写入表格/文件以保持流畅。
-        return
+        """逐点更新实时极化度估计（不绘图），每扫完一遍在输出区记录一次"""
+        estimator = self.online_estimator
+        if estimator is None:
+            return
+        self.online_text = self._format_estimate(estimator.add(x, y))
+        self.online_label.setText(f"实时极化度（{len(estimator.trace)} 个磁场点）：{self.online_text}")
+
+    def handle_sweep_completed(self, sweeps):
+        """采集线程每完成一遍扫描时记录一次实时估计；收敛停止模式由采集线程自己记录"""
+        estimator = self.online_estimator
+        if estimator is None:
+            return
+        estimator.sweeps_completed = sweeps
+        if self.acquisition_thread.estimator is None:
+            self.textBrowser.append(f"第 {sweeps} 遍扫描完成，{self.online_text}")
+
+    @staticmethod
+    def _format_estimate(estimate):
+        names = {'polarization': "P", 'P_z': "Pz", 'P_zz': "Pzz"}
+        parts = []
+        for key, (value, sigma) in estimate.items():
+            if np.isnan(value):
+                parts.append(f"{names[key]} = -")
+            else:
+                parts.append(f"{names[key]} = {value:.3f} ± {sigma:.3f}")
+        return ", ".join(parts) if parts else "-"
 
     def measure_background(self):
         self._start_acquisition("本底", "background", lambda data: setattr(self, 'background_data', data))
@@ -468,10 +770,24 @@ class PolarizationPage(QWidget):
         # 取消在采集完成后自动计算极化度，改为仅保存测量数据
         self._start_acquisition("极化离子", "polarized", lambda data: setattr(self, 'polarized_data', data))
 
-    def _start_acquisition(self, name, data_type, data_setter, calculate_polarization=False):
+    def measure_polarized_until_converged(self):
+        """重复扫描极化离子（最多为重复次数），极化度不确定度收敛后提前结束并安全下电"""
+        try:
+            target_sigma = float(self.sigma_input.text())
+        except ValueError:
+            QMessageBox.warning(self, "提示", "目标不确定度必须是数字")
+            return
+        self._start_acquisition("极化离子", "polarized", lambda data: setattr(self, 'polarized_data', data),
+                                target_sigma=target_sigma)
+
+    def _start_acquisition(self, name, data_type, data_setter, calculate_polarization=False, target_sigma=None):
         if self.acquisition_thread and self.acquisition_thread.isRunning():
             self.textBrowser.append(f"正在进行{name}测量，请等待完成...")
             return
+        # 准备、回到 10 A 或下电的 ramp 进行中时不能开始测量，否则两者同时设置电流
+        if self.supply_ramper.is_busy():
+            self.textBrowser.append(f"电源正在 ramp，请等待完成后再开始{name}测量")
+            return
 
         # 关键：每次测量前都检查磁场表是否已定义
         if self.bfield_array is None or len(self.bfield_array) == 0:
@@ -481,35 +797,126 @@ class PolarizationPage(QWidget):
             )
             return
 
+        field_probe = None
+        if self.probe_input.text().strip():
+            try:
+                field_probe = (self.cb_probe_channel.currentData(), float(self.probe_input.text()))
+            except ValueError:
+                QMessageBox.warning(self, "提示", "磁场探头标定必须是数字 (Gs/V)，不测量实测磁场时请留空")
+                return
+
         particle_type = self.cb_particle.currentText()
         gain_factor = float(self.gain_input.text())
         self.textBrowser.append(f"开始测量{name}... (粒子类型: {particle_type})")
+        bfields = self.show_scan_plan()
+        roi, roi_budget = None, 0
+        if self.cb_roi.isChecked():
+            # 点数预算与普通扫描相同
+            roi, roi_budget = self._roi_scan(particle_type), len(bfields)
+            if self.roi_peaks is None:
+                bfields = roi.coarse(self.bfield_array)
+                self.textBrowser.append(f"ROI 自适应采样：先粗扫 {len(bfields)} 点定位峰，其余点数加密到峰附近")
+            else:
+                # 复用已定位的峰，保证本底和信号在相同的磁场点上测量
+                bfields = roi.dense(self.roi_peaks, roi_budget, start_current=self.last_current)
+                roi = None
+                self.textBrowser.append(f"ROI 自适应采样：沿用已定位的峰，加密扫描 {len(bfields)} 点")
+        # 本底测量不计算极化度；其余测量以已有本底（没有时按零本底）实时估计
+        if data_type == "background":
+            self.online_estimator = None
+            self.online_label.setText("实时极化度：-")
+        else:
+            self.online_estimator = OnlinePolarizationEstimator(
+                bfields, 'proton' if particle_type == 'H' else 'deuteron', background=self.background_data,
+                proton_split=self._proton_split(bfields), deuteron_ranges=self._deuteron_ranges())
+        estimator = None
+        if target_sigma is not None:
+            if self.background_data is None:
+                self.textBrowser.append("提示：尚未测量本底，收敛判断按零本底计算")
+            estimator = OnlinePolarizationEstimator(
+                bfields, 'proton' if particle_type == 'H' else 'deuteron', background=self.background_data,
+                proton_split=self._proton_split(bfields), deuteron_ranges=self._deuteron_ranges())
 
         self.acquisition_thread = DataAcquisitionThread(
-            data_type, particle_type, gain_factor, self.bfield_array, self,
-            last_current=self.last_current
+            data_type, particle_type, gain_factor, bfields, self,
+            last_current=self.last_current, estimator=estimator, target_sigma=target_sigma,
+            roi=roi, roi_budget=roi_budget, profile=self.cb_profile.currentData(), archive=self.archive,
+            field_probe=field_probe
         )
+        if self.archive is not None:
+            self.archive.set_metadata(particle_type=particle_type, gain=gain_factor, field_probe=field_probe,
+                                      **{f"{data_type}_started": datetime.now().isoformat(timespec="seconds")})
+        self.acquisition_thread.peaks_located.connect(self._on_peaks_located)
         self.acquisition_thread.update_scatter_signal.connect(self.handle_scatter_update)
+        self.acquisition_thread.sweep_completed.connect(self.handle_sweep_completed)
         # 不再连接示波器数据更新到 UI（避免测量期间绘图）
         self.acquisition_thread.acquisition_finished.connect(
             lambda data: self._on_acquisition_finished(data, name, data_setter, calculate_polarization))
         self.acquisition_thread.error_occurred.connect(self.textBrowser.append)
 
+        self.supply_ramper.powered_down = False  # 测量线程直接设置电流
         self.acquisition_thread.start()
 
+    def toggle_archive(self):
+        """开始或结束归档：之后每次测量的逐点波形、测量值和合并结果连续写入归档文件"""
+        if self.acquisition_thread and self.acquisition_thread.isRunning():
+            self.textBrowser.append("测量进行中，请在测量结束后再开始或结束归档")
+            return
+        if self.archive is not None:
+            self.close_archive()
+            return
+        file_path, _ = QFileDialog.getSaveFileName(
+            self, "归档文件", f"polarization_run_{datetime.now().strftime('%Y%m%d_%H%M%S')}.h5",
+            "HDF5文件 (*.h5);;NPZ文件 (*.npz)"
+        )
+        if file_path:
+            self.archive = RunArchive(file_path, metadata={"particle_type": self.cb_particle.currentText()})
+            self.btn_archive.setText("结束归档")
+            self.textBrowser.append(f"开始归档: {self.archive.path}")
+
+    def close_archive(self):
+        if self.archive is not None:
+            self.archive.close()
+            self.textBrowser.append(f"测量数据已归档至: {self.archive.path}")
+            self.archive = None
+            self.btn_archive.setText("开始归档")
+
+    def _roi_scan(self, particle_type=None):
+        return RoiScan(2 if (particle_type or self.cb_particle.currentText()) == 'H' else 3)
+
+    def _on_peaks_located(self, peaks):
+        """粗扫定位到峰后，实时估计和之后的分析都改用由峰位得到的窗口"""
+        self.roi_peaks = peaks
+        if self.online_estimator is not None:
+            self.online_estimator.proton_split = self._proton_split()
+            self.online_estimator.deuteron_ranges = self._deuteron_ranges()
+
     def _on_acquisition_finished(self, data, name, data_setter, calculate_polarization):
         self.stop_requested = False
+        thread = self.acquisition_thread
+        # 用本次实测的稳定和采集耗时校准下一次的时间预测
+        self.scan_planner.calibrate(self.acquisition_thread.settle_history, self.acquisition_thread.point_times)
         if data is not None:
             data_setter(data)
             self.textBrowser.append(f"{name}测量完成。")  # 明确提示电流未归零
             # 批量更新表格（一次性），避免测量过程中频繁 UI 操作导致卡顿
             self._update_table()
             # 取消自动极化计算——保留手动触发计算功能
+        if thread.stop_requested:
+            # 手动停止：不回到 10 A，避免与 stop_current 开始的下电 ramp 冲突
+            return
+        if thread.estimator is not None:
+            # 收敛停止模式结束后电流未回到 10 A，直接 ramp 到 0
+            self.stop_current()
+        else:
+            # 电流回到 10 A 等待下一次测量，与准备、下电在同一任务队列中依次执行
+            self.supply_ramper.park()
 
     def clear_data(self):
         self.background_data = None
         self.unpolarized_data = None
         self.polarized_data = None
+        self.roi_peaks = None
         self.last_photon_data = None
         self.last_BField_data = None
         # 不再使用绘图面板，移除对 result_canvas 的调用
@@ -543,24 +950,28 @@ class PolarizationPage(QWidget):
                 raise ValueError("CSV文件格式错误: 无法在第3行找到粒子类型。")
 
             data_rows = reader[9:]
-            background = []
-            unpolarized = []
-            polarized = []
+            columns = {0: [], 2: [], 4: []}
+            stds = {0: [], 2: [], 4: []}
 
             for row in data_rows:
-                if row[0] and row[1]:
-                    background.append([float(row[0]), float(row[1])])
-                if row[2] and row[3]:
-                    unpolarized.append([float(row[2]), float(row[3])])
-                if row[4] and row[5]:
-                    polarized.append([float(row[4]), float(row[5])])
-
-            if background:
-                self.background_data = np.array(background)
-            if unpolarized:
-                self.unpolarized_data = np.array(unpolarized)
-            if polarized:
-                self.polarized_data = np.array(polarized)
+                for column, std_column in ((0, 6), (2, 7), (4, 8)):
+                    if len(row) > column + 1 and row[column] and row[column + 1]:
+                        columns[column].append([float(row[column]), float(row[column + 1])])
+                        # 新格式在最后三列保存标准差
+                        if len(row) > std_column and row[std_column]:
+                            stds[column].append(float(row[std_column]))
+
+            # 旧格式文件按原始访问顺序逐点保存，统一合并为按磁场排序的紧凑数据
+            loaded = {}
+            for column, values in columns.items():
+                if values:
+                    data = compact_trace(values)
+                    if len(stds[column]) == len(values) == len(data):
+                        data[:, 2] = stds[column]
+                    loaded[column] = data
+            self.background_data = loaded.get(0, self.background_data)
+            self.unpolarized_data = loaded.get(2, self.unpolarized_data)
+            self.polarized_data = loaded.get(4, self.polarized_data)
 
             # 载入数据后只更新表格，不自动绘图/计算极化度
             self._update_table()
@@ -598,16 +1009,19 @@ class PolarizationPage(QWidget):
                 writer.writerow(["极化率计算结果:"])
                 if self.background_data is not None and self.polarized_data is not None:
                     if self.cb_particle.currentText() == 'H':
-                        polarization = calculate_polarization(self.polarized_data, self.background_data, 'proton')
+                        polarization = calculate_polarization(self.polarized_data, self.background_data, 'proton',
+                                                              proton_split=self._proton_split())
                         writer.writerow(["质子极化率 Pz:", f"{polarization['polarization']:.3f}"])
                     else:
-                        polarization = calculate_polarization(self.polarized_data, self.background_data, 'deuteron')
+                        polarization = calculate_polarization(self.polarized_data, self.background_data, 'deuteron',
+                                                              deuteron_ranges=self._deuteron_ranges())
                         writer.writerow(["氘极化率 Pz:", f"{polarization['P_z']:.3f}", "氘极化率 Pzz:",
                                          f"{polarization['P_zz']:.3f}"])
                 writer.writerow([])
 
                 writer.writerow(["表格数据:"])
-                headers = ["磁场", "本底测量值", "磁场", "非极化离子测量值", "磁场", "极化离子测量值"]
+                headers = ["磁场", "本底测量值", "磁场", "非极化离子测量值", "磁场", "极化离子测量值",
+                           "本底标准差", "非极化离子标准差", "极化离子标准差"]
                 writer.writerow(headers)
 
                 max_rows = max(
@@ -634,6 +1048,13 @@ class PolarizationPage(QWidget):
                     else:
                         row_data.extend(["", ""])
 
+                    # 标准差附加在最后三列，读取时前六列格式不变
+                    for data in (self.background_data, self.unpolarized_data, self.polarized_data):
+                        if data is not None and row < len(data):
+                            row_data.append(f"{data[row, 2]:.6e}")
+                        else:
+                            row_data.append("")
+
                     writer.writerow(row_data)
 
             # 同时生成并保存图像文件（不在 UI 中显示）
@@ -654,17 +1075,20 @@ class PolarizationPage(QWidget):
 
                 if self.polarized_data is not None:
                     try:
-                        ax.plot(self.polarized_data[:, 0], self.polarized_data[:, 1], ".", label="WFT-ON", color='red')
+                        ax.errorbar(self.polarized_data[:, 0], self.polarized_data[:, 1], yerr=self.polarized_data[:, 2],
+                                    fmt=".", label="WFT-ON", color='red')
                     except Exception:
                         pass
                 if self.unpolarized_data is not None:
                     try:
-                        ax.plot(self.unpolarized_data[:, 0], self.unpolarized_data[:, 1], "x", label="WFT-OFF", color='green')
+                        ax.errorbar(self.unpolarized_data[:, 0], self.unpolarized_data[:, 1], yerr=self.unpolarized_data[:, 2],
+                                    fmt="x", label="WFT-OFF", color='green')
                     except Exception:
                         pass
                 if self.background_data is not None:
                     try:
-                        ax.plot(self.background_data[:, 0], self.background_data[:, 1], "*", label="background", color='blue')
+                        ax.errorbar(self.background_data[:, 0], self.background_data[:, 1], yerr=self.background_data[:, 2],
+                                    fmt="*", label="background", color='blue')
                     except Exception:
                         pass
 
@@ -713,30 +1137,39 @@ class PolarizationPage(QWidget):
 
         self._update_table_rows(max_rows)
 
-        def set_cell(r, c, text, align=Qt.AlignRight | Qt.AlignVCenter):
+        def set_cell(r, c, text, align=Qt.AlignRight | Qt.AlignVCenter, tooltip=None):
             item = QTableWidgetItem(text)
             item.setTextAlignment(align)
+            if tooltip:
+                item.setToolTip(tooltip)
             self.tableWidget.setItem(r, c, item)
 
-        if self.background_data is not None:
-            for row, (bfield, value) in enumerate(self.background_data):
-                set_cell(row, 0, f"{bfield:.4f}")
-                set_cell(row, 1, f"{value:.6e}")
-
-        if self.unpolarized_data is not None:
-            for row, (bfield, value) in enumerate(self.unpolarized_data):
-                set_cell(row, 2, f"{bfield:.4f}")
-                set_cell(row, 3, f"{value:.6e}")
-
-        if self.polarized_data is not None:
-            for row, (bfield, value) in enumerate(self.polarized_data):
-                set_cell(row, 4, f"{bfield:.4f}")
-                set_cell(row, 5, f"{value:.6e}")
+        for column, data in ((0, self.background_data), (2, self.unpolarized_data), (4, self.polarized_data)):
+            if data is None:
+                continue
+            for row, (bfield, value, std, count) in enumerate(data):
+                set_cell(row, column, f"{bfield:.4f}")
+                set_cell(row, column + 1, f"{value:.6e}", tooltip=f"标准差 {std:.3e}，测量 {int(count)} 次")
 
         # 恢复表格更新和排序
         self.tableWidget.setSortingEnabled(sorting_enabled)
         self.tableWidget.setUpdatesEnabled(True)
 
+    def _proton_split(self, fields=None):
+        """质子两峰的分界磁场：ROI 扫描时取两峰中点，否则取磁场范围的中点"""
+        if self.roi_peaks is not None:
+            return self._roi_scan('H').split(self.roi_peaks)
+        if fields is None:
+            fields = np.concatenate([data[:, 0] for data in (self.background_data, self.polarized_data)
+                                     if data is not None])
+        return (fields.min() + fields.max()) / 2
+
+    def _deuteron_ranges(self):
+        """氘核峰窗口：ROI 扫描时由粗扫峰位给出，否则为 None（使用固定范围）"""
+        if self.roi_peaks is not None and len(self.roi_peaks) == 3:
+            return self._roi_scan('D').windows(self.roi_peaks)
+        return None
+
     def calculate_and_plot_polarization(self):
         if self.background_data is None or self.polarized_data is None:
             self.textBrowser.append("请先完成本底和极化离子测量。")
@@ -744,7 +1177,8 @@ class PolarizationPage(QWidget):
         particle_type = self.cb_particle.currentText()
 
         if particle_type == 'H':
-            polarization = calculate_polarization(self.polarized_data, self.background_data, 'proton')
+            polarization = calculate_polarization(self.polarized_data, self.background_data, 'proton',
+                                                  proton_split=self._proton_split())
             self.textBrowser.append(f"Nbp: {polarization['peak_background'][1][0]:.3e}")
             self.textBrowser.append(f"Nbn: {polarization['peak_background'][1][1]:.3e}")
             self.textBrowser.append(f"Np: {polarization['peak_signal'][1][0]:.3e}")
@@ -761,7 +1195,8 @@ class PolarizationPage(QWidget):
             msg_box.exec_()
 
         elif particle_type == 'D':
-            polarization = calculate_polarization(self.polarized_data, self.background_data, 'deuteron')
+            polarization = calculate_polarization(self.polarized_data, self.background_data, 'deuteron',
+                                                  deuteron_ranges=self._deuteron_ranges())
             self.textBrowser.append(f"Nbp: {polarization['peak_background'][1][0]:.3e}")
             self.textBrowser.append(f"Nb0: {polarization['peak_background'][1][1]:.3e}")
             self.textBrowser.append(f"Nbn: {polarization['peak_background'][1][2]:.3e}")
@@ -780,82 +1215,153 @@ class PolarizationPage(QWidget):
             msg_box.exec_()
 
 
-class PrepareThread(QThread):
+class SupplyRamper(QObject):
+    """
+    电源准备（70 V，电流 ramp 到 10 A）和安全下电（电流 ramp 到 0，电压设 0）
+
+    操作在后台事件循环中以协程执行，不占用 QThread；新的操作会立即取消正在进行的操作，
+    例如准备过程中点击下电，电流从当前值直接 ramp 回 0。信号从循环线程发出，排队到 GUI 线程处理。
+    ramp 按允许的变化率闭环执行，电源不跟随时立即报错（见 core.ptnhp_async.Ramp）。
+    """
     ramp_finished = pyqtSignal(bool)
+    stop_finished = pyqtSignal(bool)  # 下电命令是否都已发送成功
+    stop_cancelled = pyqtSignal()     # 下电被新的电源任务（如重新准备）取消，由新任务接管电源
     error_occurred = pyqtSignal(str)
-
-    def __init__(self, parent):
+    current_changed = pyqtSignal(float)
+    progress = pyqtSignal(float, float, float)  # 设定值, 目标值, 回读值（未回读时为 nan）
+
+    def __init__(self, slew_rate=4.0, target=10.0):
+        """
+        参数:
+        slew_rate: 允许的电流变化率 (A/s)
+        target: 准备测量时的目标电流 (A)
+        """
         super().__init__()
-        self.parent = parent
-
-    def run(self):
+        self.driver = AsyncPTNhp()
+        self.slew_rate = slew_rate
+        self.target = target
+        self.powered_down = True  # 电源未被操作过，或最近一次下电命令已确认
+        self._stop_task = None
+
+    def is_busy(self):
+        return self.driver.is_busy()
+
+    def prepare(self):
+        self.powered_down = False
+        self.driver.start_task(self._prepare())
+
+    def stop(self):
+        self._stop_task = self.driver.start_task(self._stop())
+
+    def park(self):
+        """测量结束后电流 ramp 回准备时的目标值，等待下一次测量"""
+        self.powered_down = False
+        self.driver.start_task(self._park())
+
+    def shut_down(self, timeout=15.0):
+        """
+        关闭程序时调用（阻塞）：电源未下电时执行安全下电并等待完成，正在下电时等待其完成；
+        超时仍未下电则取消 ramp，直接发送 CURR 0、VOLT 0。最后关闭事件循环线程和执行器，
+        须在关闭共享电源会话之前调用
+        """
+        driver = self.driver
+        if not self.powered_down:
+            if not (driver.is_busy() and driver.task is self._stop_task):
+                self.stop()
+            wait_futures([driver.task], timeout)
+            if not self.powered_down:
+                driver.cancel()
+                wait_futures([driver.submit(self._shut_down())], 5.0)
+        driver.close()
+
+    def _progress(self, setpoint, target, reading):
+        self.current_changed.emit(setpoint)
+        self.progress.emit(setpoint, target, np.nan if reading is None else reading)
+
+    async def _ramp(self, target, start=None):
+        t0 = time.perf_counter()
+        reading = await self.driver.ramp_to(target, self.slew_rate, start=start, on_progress=self._progress)
+        self.error_occurred.emit(f"电流 ramp 完成，回读 {reading:.3f} A，用时 {time.perf_counter() - t0:.2f} s")
+
+    async def _prepare(self):
+        driver = self.driver
         try:
-            ptnhp = PTNhpController(ip="192.168.1.123", port=7, timeout=5, terminator='\n')
-            if not ptnhp.connect():
+            if not await driver.connect():
                 self.error_occurred.emit("PTNhp 电源连接失败")
                 self.ramp_finished.emit(False)
                 return
-
-            if not ptnhp.set_voltage(70):
+            if not await driver.set_voltage(70):
                 self.error_occurred.emit("设置 70 V 失败")
                 self.ramp_finished.emit(False)
                 return
-            ptnhp.start_output()
-            time.sleep(0.1)
+            await driver.start_output()
+            await asyncio.sleep(0.1)
 
-            I_now = ptnhp.measure_current()
+            I_now = await driver.measure_current()
+            if not isinstance(I_now, float):
+                self.error_occurred.emit(f"无法读取当前电流：{I_now}")
+                self.ramp_finished.emit(False)
+                return
             self.error_occurred.emit(f"当前电流: {I_now:.3f} A")
-
             if 9 < I_now < 11:
                 self.error_occurred.emit(f"当前电流已接近目标值：10 A，可以测量")
-                self.parent.last_current = I_now  # 保存当前电流
+                self.current_changed.emit(I_now)
                 self.ramp_finished.emit(True)
                 return
 
-            steps = self.parent.ramp_steps
-            I_start = I_now
-            I_end = 10 # 目标电流10A
-            for i in range(steps + 1):
-                I = I_start + (I_end - I_start) * i / steps
-                if not ptnhp.set_current(I):
-                    self.error_occurred.emit(f"第 {i} 步设置电流 {I:.3f} A 失败")
-                    self.ramp_finished.emit(False)
-                    return
-                self.msleep(30)
-
-            self.parent.last_current = I_end  # 保存最终电流
+            await self._ramp(self.target, start=I_now)
             self.ramp_finished.emit(True)
+        except asyncio.CancelledError:
+            self.error_occurred.emit("准备已中断")
+            raise
         except Exception as e:
-            self.error_occurred.emit(f"PrepareThread 异常：{e}")
+            self.error_occurred.emit(f"准备过程异常：{e}")
             self.ramp_finished.emit(False)
 
-
-class StopRampThread(QThread):
-    finished = pyqtSignal()
-
-    def __init__(self, parent):
-        super().__init__()
-        self.parent = parent
-
-    def run(self):
+    async def _park(self):
         try:
-            ptnhp = PTNhpController(ip="192.168.1.123", port=7, timeout=5, terminator='\n')
-            if not ptnhp.connect():
-                self.parent.textBrowser.append("StopRamp：电源连接失败")
-                return
-
-            time.sleep(0.1)
-            steps = 100
-            I_now = ptnhp.measure_current()
-            for i in range(steps + 1):
-                I = I_now * (1 - i / steps)
-                ptnhp.set_current(I)
-                self.msleep(30)
-
-            ptnhp.set_voltage(0)
-            self.parent.last_current = 0.0  # 重置电流记录
+            await self._ramp(self.target)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error_occurred.emit(f"电流回到 {self.target} A 失败：{e}")
+
+    async def _stop(self):
+        """
+        闭环 ramp 到 0 后设置电压 0。ramp 失败（回读无效、零点偏移导致无法稳定等）时
+        同样直接发送 CURR 0 和 VOLT 0，不会停在中途的电流和 70 V；
+        只有被新的电源任务（如重新准备）取消时不发送，由新任务接管电源
+        """
+        driver = self.driver
+        cancelled = False
+        try:
+            if not await driver.connect():
+                self.error_occurred.emit("StopRamp：电源连接失败，仍尝试发送下电命令")
+            else:
+                await self._ramp(0.0)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
         except Exception as e:
-            self.parent.textBrowser.append(f"StopRamp 异常：{e}")
+            self.error_occurred.emit(f"StopRamp 异常：{e}，直接设置电流 0 A、电压 0 V")
         finally:
-            self.finished.emit()
+            if cancelled:
+                self.stop_cancelled.emit()
+            else:
+                self.stop_finished.emit(await self._shut_down())
 
+    async def _shut_down(self):
+        """开环发送 CURR 0、VOLT 0，返回两条命令是否都成功"""
+        driver = self.driver
+        try:
+            current_ok = await driver.set_current(0.0)
+            voltage_ok = await driver.set_voltage(0)
+        except Exception as e:
+            self.error_occurred.emit(f"下电命令发送失败：{e}，请手动检查电源")
+            return False
+        if not (current_ok and voltage_ok):
+            self.error_occurred.emit("下电命令未确认，请手动检查电源")
+            return False
+        self.powered_down = True
+        self.current_changed.emit(0.0)
+        return True
@@ -1,8 +1,10 @@
 from PyQt5.QtWidgets import QWidget
+from PyQt5.QtCore import QTimer
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 import matplotlib.pyplot as plt
 import numpy as np
+import time
 from core.data_processor import DataProcessor
 
 
@@ -39,52 +41,146 @@ class BasePlotCanvas(FigureCanvas):
         })'''
 
 
+class _HistorySeries:
+    """历史趋势图中的一条数据序列（如一个通道）"""
+    def __init__(self, ax, label, style):
+        self.runs = np.empty(1024)
+        self.values = np.empty(1024)
+        self.count = 0
+        self.blitted = 0           # 已画入缓存背景的点数
+        # 新增点先画在 animated 曲线上再并入背景缓存，整体重绘时由完整曲线绘制
+        self.line, = ax.plot([], [], style, label=label)
+        self.new_points, = ax.plot([], [], style, animated=True)
+
+    def append(self, run, value):
+        if self.count == len(self.runs):
+            # 容量按倍增扩展，追加均摊 O(1)
+            self.runs = np.resize(self.runs, 2 * len(self.runs))
+            self.values = np.resize(self.values, 2 * len(self.values))
+        self.runs[self.count] = run
+        self.values[self.count] = value
+        self.count += 1
+        # 完整曲线数据始终保持同步，任何整体重绘（包括窗口缩放）都会画出全部点
+        self.line.set_data(self.runs[:self.count], self.values[:self.count])
+
+    def remove(self):
+        self.line.remove()
+        self.new_points.remove()
+
+
 class BeamHistoryPlot(BasePlotCanvas):
-    """流强历史趋势图"""
-    def __init__(self, parent=None):
+    """流强历史趋势图：每个序列一条曲线增量更新，blit 局部重绘，重绘频率限制在 max_fps 以内"""
+    STYLES = ["ro", "bo", "go", "mo", "co", "yo", "ko"]
+
+    def __init__(self, parent=None, max_fps=10):
         super().__init__(parent, width=8, height=4)
         self.ax = self.fig.add_subplot(111)
-        self.run_data = []
-    
-    def update_plot(self):
-        """更新图表"""
-        self.ax.clear()
-        if not self.run_data:
-            self.ax.set_title("No Data")
-            self.draw()
-            return
-        
-        runs = [d['run'] for d in self.run_data]
-        max_vals = [d['max'] for d in self.run_data]
-        
-        self.ax.plot(runs, max_vals, "ro", label="Beam Intensity")
+        self.min_interval = 1.0 / max_fps
+        self._series = {}
+        self._background = None
+        self._needs_full_draw = True
+        self._last_redraw = 0.0
+
+        # 限制重绘频率：距上次重绘不足 min_interval 时延迟到定时器触发
+        self._redraw_timer = QTimer(self)
+        self._redraw_timer.setSingleShot(True)
+        self._redraw_timer.timeout.connect(self._redraw)
+
         self.ax.set_xlabel("Run Time")
         self.ax.set_ylabel("Beam Intensity (mA)")
         self.ax.set_ylim(0, 1.5)
-        self.ax.set_title("Beam Intensity history")
-        self.ax.legend()
+        self.ax.set_xlim(0, 10)
+        self.ax.set_title("No Data")
         self.fig.tight_layout()
-        self.draw()
-    
-    def add_data(self, run, data):
-        """添加新数据点"""
-        avg1, avg2 = DataProcessor.calculate_averages(data)
-        self.run_data.append({
-            'run': run,
-            'max': np.max(np.abs(data)),
-            'avg1': np.abs(avg1),
-            'avg2': np.abs(avg2)
-        })
-        self.run_data.append({
-            'run': run,
-            'max': np.max(np.abs(data)),
-        })
+
+        self.mpl_connect('draw_event', self._on_draw)
+        self.mpl_connect('resize_event', self._on_resize)
+
+    @property
+    def run_data(self):
+        """各序列已记录的 (运行序号, 最大流强) 数组"""
+        return {key: (series.runs[:series.count], series.values[:series.count])
+                for key, series in self._series.items()}
+
+    def _on_draw(self, event):
+        """整体重绘后缓存坐标轴背景（已包含全部数据点）"""
+        self._background = self.copy_from_bbox(self.ax.bbox)
+        for series in self._series.values():
+            series.blitted = series.count
+
+    def _on_resize(self, event):
+        """仅在尺寸变化时重新计算布局"""
+        self.fig.tight_layout()
+        self._needs_full_draw = True
+
+    def _schedule_redraw(self):
+        elapsed = time.monotonic() - self._last_redraw
+        if elapsed >= self.min_interval:
+            self._redraw()
+        elif not self._redraw_timer.isActive():
+            self._redraw_timer.start(int((self.min_interval - elapsed) * 1000) + 1)
+
+    def _redraw(self):
+        self._last_redraw = time.monotonic()
+        if self._needs_full_draw or self._background is None:
+            self._needs_full_draw = False
+            self.draw()
+            return
+        pending = [s for s in self._series.values() if s.blitted < s.count]
+        if not pending:
+            return
+        # 只绘制新增的点，绘制后并入背景缓存，单次重绘开销与历史长度无关
+        self.restore_region(self._background)
+        for series in pending:
+            series.new_points.set_data(series.runs[series.blitted:series.count],
+                                       series.values[series.blitted:series.count])
+            self.ax.draw_artist(series.new_points)
+            series.blitted = series.count
+        self.blit(self.ax.bbox)
+        self._background = self.copy_from_bbox(self.ax.bbox)
+
+    def update_plot(self):
+        """强制整体重绘"""
+        self._needs_full_draw = True
+        self._schedule_redraw()
+
+    def clear(self):
+        """清空历史数据"""
+        for series in self._series.values():
+            series.remove()
+        self._series = {}
+        legend = self.ax.get_legend()
+        if legend is not None:
+            legend.remove()
+        self.ax.set_xlim(0, 10)
+        self.ax.set_title("No Data")
         self.update_plot()
 
+    def _get_series(self, key):
+        series = self._series.get(key)
+        if series is None:
+            style = self.STYLES[len(self._series) % len(self.STYLES)]
+            label = "Beam Intensity" if key is None else str(key)
+            series = _HistorySeries(self.ax, label, style)
+            self._series[key] = series
+            self.ax.set_title("Beam Intensity history")
+            self.ax.legend()
+            self._needs_full_draw = True
+        return series
+
+    def add_data(self, run, data, series=None):
+        """添加新数据点，series 区分不同序列（如通道）"""
+        self._get_series(series).append(run, np.max(np.abs(data)))
+        # x 轴范围按倍增扩展，整体重绘的次数只随 log(运行次数) 增长
+        x_max = self.ax.get_xlim()[1]
+        if run > x_max:
+            self.ax.set_xlim(0, max(2 * x_max, run + 1))
+            self._needs_full_draw = True
+        self._schedule_redraw()
 
 
 class BeamResultPlot(BasePlotCanvas):
-    """流强结果详细图"""
+    """流强结果详细图：按画布像素宽度抽取显示，缩放时对可见范围重新抽取"""
 
     def __init__(self, parent=None):
         super().__init__(parent, width=8, height=5)
@@ -94,51 +190,73 @@ class BeamResultPlot(BasePlotCanvas):
         self.ax2.yaxis.set_label_position('right')
         self.ax2.yaxis.tick_right()
 
+        # 完整分辨率数据，抽取只影响显示
+        self._full_data = None
 
-    def plot_data(self, time_data, off_data, on_data, beam_data):
-        """绘制详细数据"""
-        self.ax1.clear()
-        self.ax2.clear()
-
-        line1 = self.ax1.plot(time_data, off_data, 'b-', label='ABS-RF-OFF')
-        line2 = self.ax1.plot(time_data, on_data, 'g-', label='ABS-RF-ON')
-
-        line3 = self.ax2.plot(time_data, beam_data, 'r-', label='Ion Beam From ABS')
-
-        lines = line1 + line2 + line3
-        labels = [_.get_label() for _ in lines]
+        line1 = self.ax1.plot([], [], 'b-', label='ABS-RF-OFF')
+        line2 = self.ax1.plot([], [], 'g-', label='ABS-RF-ON')
+        line3 = self.ax2.plot([], [], 'r-', label='Ion Beam From ABS')
+        self.lines = line1 + line2 + line3
+        labels = [_.get_label() for _ in self.lines]
 
         # 设置右侧y轴颜色
         self.ax2.spines['right'].set_color('red')
         self.ax2.tick_params(axis='y', colors='red')
 
-        # 确保右侧y轴标签位置和方向正确
-        self.ax2.yaxis.set_label_position('right')
-        self.ax2.yaxis.tick_right()
-
-        self.ax1.legend(lines, labels, frameon=False, borderaxespad=0.2, borderpad=0.2, labelspacing=0.2)
+        self.ax1.legend(self.lines, labels, frameon=False, borderaxespad=0.2, borderpad=0.2, labelspacing=0.2)
         self.ax1.set_xlabel(r'Time (μs)')
         self.ax1.set_ylabel(r'Ion Beam (mA)')
         self.ax2.set_ylabel(r'Ion Beam from ABS (mA)', color='red')
-
         self.fig.tight_layout()
-        self.draw()
 
-        '''self.ax1.plot(time_data, off_data, 'b-', label='ABS-RF-OFF')
-        self.ax1.plot(time_data, on_data, 'g-', label='ABS-RF-ON')
-        self.ax2.plot(time_data, beam_data, 'r-', label='离子束流')
-        self.ax2 = self.ax1.twinx()
-        
-        self.ax1.set_xlabel(r'Time ($\mu$s)')
-        self.ax1.set_ylabel(r'Ion Beam (mA)')
-        self.ax2.set_ylabel(r'Ion Beam from ABS (mA)', color='red')
-        
-        # 合并图例
-        lines1, labels1 = self.ax1.get_legend_handles_labels()
-        lines2, labels2 = self.ax2.get_legend_handles_labels()
-        self.ax1.legend(lines1 + lines2, labels1 + labels2, loc='upper right')
-        self.ax1.grid(True)
-        self.ax2.grid(True) 
+        self.ax1.callbacks.connect('xlim_changed', self._on_xlim_changed)
+        self.mpl_connect('resize_event', self._on_resize)
 
+    def _on_resize(self, event):
+        """尺寸变化时重新布局，并按新的像素宽度重新抽取"""
         self.fig.tight_layout()
-        self.draw()'''
+        self._update_lines()
+
+    def _on_xlim_changed(self, ax):
+        self._update_lines()
+        self.draw_idle()
+
+    def _update_lines(self):
+        """对当前可见范围按约 2 倍像素宽度做最小/最大值抽取"""
+        if self._full_data is None:
+            return
+        time_data = self._full_data[0]
+        x_min, x_max = self.ax1.get_xlim()
+        # 可见范围两侧各多取一个点，保证曲线延伸到边界
+        start = max(np.searchsorted(time_data, x_min) - 1, 0)
+        stop = min(np.searchsorted(time_data, x_max) + 1, len(time_data))
+        n_bins = max(int(self.ax1.bbox.width), 1)
+        for line, data in zip(self.lines, self._full_data[1:]):
+            line.set_data(*DataProcessor.decimate_minmax(time_data[start:stop], data[start:stop], n_bins))
+
+    def plot_data(self, time_data, off_data, on_data, beam_data):
+        """绘制详细数据"""
+        self._full_data = (np.asarray(time_data), np.asarray(off_data),
+                           np.asarray(on_data), np.asarray(beam_data))
+        if len(time_data) == 0:
+            self.clear()
+            return
+
+        # 纵轴范围按完整数据计算，抽取保留了极值，显示范围一致
+        self.ax1.set_ylim(*self._padded_range(np.concatenate((off_data, on_data))))
+        self.ax2.set_ylim(*self._padded_range(beam_data))
+        # 设置横轴范围会触发 xlim_changed，从而完成抽取
+        self.ax1.set_xlim(time_data[0], time_data[-1])
+
+    @staticmethod
+    def _padded_range(data):
+        lo, hi = float(np.min(data)), float(np.max(data))
+        pad = 0.05 * (hi - lo) if hi > lo else 0.5
+        return lo - pad, hi + pad
+
+    def clear(self):
+        """清空曲线"""
+        self._full_data = None
+        for line in self.lines:
+            line.set_data([], [])
+        self.draw_idle()